@@ -0,0 +1,38 @@
+import os
+
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+# The warehouse tables live in these schemas, see the models' db_table.
+WAREHOUSE_SCHEMAS = ('CNLYR001', 'CNLYR002')
+
+
+def attach_warehouse_schemas(sender, connection, **kwargs):
+    '''Attach a database file per warehouse schema when the seumich alias is
+    a local SQLite stand-in, so '"CNLYR002"."DM_STDNT"' style table names
+    resolve. Schema files sit next to the database file, e.g.
+    seumich.sqlite3 gets seumich.CNLYR001.sqlite3; in-memory databases get
+    in-memory schemas.'''
+    if connection.alias != 'seumich' or connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA database_list')
+    attached = set(row[1] for row in cursor.fetchall())
+    name = connection.settings_dict['NAME']
+    for schema in WAREHOUSE_SCHEMAS:
+        if schema in attached:
+            continue
+        if name == ':memory:' or name.startswith('file:'):
+            path = ':memory:'
+        else:
+            root, ext = os.path.splitext(name)
+            path = '%s.%s%s' % (root, schema, ext)
+        cursor.execute('ATTACH DATABASE %%s AS "%s"' % schema, [path])
+
+
+class SeumichConfig(AppConfig):
+    name = 'seumich'
+
+    def ready(self):
+        connection_created.connect(attach_warehouse_schemas)
@@ -0,0 +1,169 @@
+import base64
+from datetime import date
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+import numpy as np
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from seumich.cube import fact_cube
+from seumich.warehouse import data_version
+
+
+# (key, color) of the series of the two class charts.
+SCORE_SERIES = (('Student', '#255c91'), ('Class', '#F0D654'))
+EVENT_SERIES = (('Course Site Engagement', '#a9bdab'),)
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+
+def weekly_values(student, class_site):
+    '''The weekly scores and event percentile ranks of the student and the
+    weekly class scores, as dicts by week end Date id; read from the fact
+    cube when one was built for the data version.'''
+    cube = fact_cube()
+    if cube is not None:
+        return cube.weekly_values(class_site.id, student.id)
+    return (
+        dict(class_site.weeklystudentclasssitescore_set
+             .filter(student=student)
+             .values_list('week_end_date_id', 'score')),
+        dict(class_site.weeklystudentclasssiteevent_set
+             .filter(student=student)
+             .values_list('week_end_date_id', 'percentile_rank')),
+        dict(class_site.weeklyclasssitescore_set
+             .values_list('week_end_date_id', 'score')))
+
+
+def class_history(student, class_site, student_score=None, class_score=None):
+    '''The week numbers of the term of the class site and, for every week,
+    the student's score, the class score and the student's event percentile
+    or None. The current week shows `student_score` and `class_score` when
+    it has no weekly score yet.'''
+    weeks, student_values, class_values, event_values = [], [], [], []
+    try:
+        term = class_site.terms.get()
+    except (ObjectDoesNotExist, MultipleObjectsReturned):
+        return weeks, student_values, class_values, event_values
+
+    student_scores, events, class_scores = weekly_values(student, class_site)
+    todays_week_end_date = term.todays_week_end_date()
+    for week_number, week_end_date in enumerate(term.week_end_dates(), 1):
+        current = week_end_date == todays_week_end_date
+        weeks.append(week_number)
+        score = student_scores.get(week_end_date.id)
+        student_values.append(student_score if score is None and current
+                              else score)
+        score = class_scores.get(week_end_date.id)
+        class_values.append(class_score if score is None and current
+                            else score)
+        percentile_rank = events.get(week_end_date.id)
+        event_values.append(None if percentile_rank is None
+                            else round(percentile_rank * 100))
+    return weeks, student_values, class_values, event_values
+
+
+def chart_payload(weeks, series):
+    '''The columnar payload of a chart: the week numbers shared by its
+    series and, for each (key, color, values) in `series`, the values as
+    floats with 0 in place of None and a bit per week, set where the value
+    is None, packed most significant bit first.'''
+    columns = []
+    for key, color, values in series:
+        nulls = np.array([value is None for value in values], dtype=bool)
+        columns.append({
+            'key': key,
+            'color': color,
+            'values': [0.0 if value is None else float(value)
+                       for value in values],
+            'nulls': np.packbits(nulls).tostring(),
+        })
+    return {'weeks': list(weeks), 'series': columns}
+
+
+def empty_charts():
+    '''The class charts without any week, for when the warehouse is too
+    slow to answer.'''
+    return {
+        'scores': chart_payload([], [key_color + ([],) for key_color
+                                     in SCORE_SERIES]),
+        'events': chart_payload([], [EVENT_SERIES[0] + ([],)]),
+    }
+
+
+def class_charts_cache_key(student, class_site):
+    # The current week of the term depends on the date as well as the data.
+    return 'class_charts:%s:%s:%d:%d' % (
+        data_version(), date.today().isoformat(), student.id, class_site.id)
+
+
+def class_site_charts(student, summary):
+    '''The chart payloads of a student's ClassSiteSummary, by chart, cached
+    per data version and day.'''
+    def compute():
+        weeks, student_values, class_values, event_values = class_history(
+            student, summary.class_site, student_score=summary.student_score,
+            class_score=summary.class_score)
+        return {
+            'scores': chart_payload(weeks, [
+                key_color + (values,) for key_color, values
+                in zip(SCORE_SERIES, (student_values, class_values))]),
+            'events': chart_payload(weeks, [
+                EVENT_SERIES[0] + (event_values,)]),
+        }
+    return cache.get_or_set(class_charts_cache_key(student,
+                                                   summary.class_site),
+                            compute, settings.SEUMICH_FRAGMENT_CACHE_TIMEOUT)
+
+
+def _json_ready(value, key=None):
+    if isinstance(value, dict):
+        return dict((name, _json_ready(item, name))
+                    for name, item in value.items())
+    if isinstance(value, list):
+        return [_json_ready(item) for item in value]
+    if key == 'nulls':
+        return base64.b64encode(value)
+    return value
+
+
+def _msgpack_ready(value, key=None):
+    if isinstance(value, dict):
+        return dict((unicode(name), _msgpack_ready(item, name))
+                    for name, item in value.items())
+    if key == 'weeks':
+        return np.array(value, dtype='<i4').tostring()
+    if key == 'values':
+        return np.array(value, dtype='<f8').tostring()
+    if isinstance(value, list):
+        return [_msgpack_ready(item) for item in value]
+    if isinstance(value, str) and key != 'nulls':
+        return value.decode('utf-8')
+    return value
+
+
+def encode_json(charts):
+    '''Chart payloads, or dicts and lists of them, as compact JSON with the
+    null masks in base64. Uses ujson when it is installed.'''
+    charts = _json_ready(charts)
+    if ujson is not None:
+        return ujson.dumps(charts)
+    return json.dumps(charts, separators=(',', ':'))
+
+
+def encode_msgpack(charts):
+    '''Chart payloads, or dicts and lists of them, as msgpack with the weeks
+    as little endian int32 and the values as little endian float64
+    binaries. Needs msgpack.'''
+    return msgpack.packb(_msgpack_ready(charts), use_bin_type=True)
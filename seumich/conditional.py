@@ -0,0 +1,81 @@
+from datetime import date
+import hashlib
+import os
+import threading
+
+from django.conf import settings
+from django.contrib import messages
+from django.template.utils import get_app_template_dirs
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from seumich.warehouse import current_term, data_version
+
+
+_lock = threading.Lock()
+_template_version = None
+
+
+def _template_dirs():
+    dirs = []
+    for engine in settings.TEMPLATES:
+        dirs.extend(engine.get('DIRS', []))
+    dirs.extend(get_app_template_dirs('templates'))
+    return sorted(set(dirs))
+
+
+def _compute_template_version():
+    digest = hashlib.md5()
+    for template_dir in _template_dirs():
+        for root, subdirs, files in sorted(os.walk(template_dir)):
+            subdirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, template_dir))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def template_version():
+    '''A short string that changes when any template changes, for cache
+    keys and validators. SEUMICH_TEMPLATE_VERSION pins it; otherwise it is
+    a digest of the template sources, computed once per process.'''
+    global _template_version
+    if settings.SEUMICH_TEMPLATE_VERSION:
+        return settings.SEUMICH_TEMPLATE_VERSION
+    if _template_version is None:
+        with _lock:
+            if _template_version is None:
+                _template_version = _compute_template_version()
+    return _template_version
+
+
+def page_etag(request, *args, **kwargs):
+    '''The validator of a seumich page: the same user asking for the same
+    url on the same day (the class charts show the current week) gets the
+    same page as long as the warehouse data, the templates and the current
+    term did not change. Pages with pending messages are not validated,
+    they would not show the messages otherwise.'''
+    if request.method != 'GET' or len(messages.get_messages(request)):
+        return None
+    term = current_term()
+    key = '\n'.join([data_version(), template_version(),
+                     date.today().isoformat(),
+                     unicode(term.pk if term is not None else ''),
+                     request.user.get_username(), request.get_full_path()])
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+class ConditionalGetMixin(object):
+    '''Answer a GET with a matching If-None-Match with 304 Not Modified
+    before the view runs any query, and have browsers revalidate the page
+    on every visit.'''
+
+    @method_decorator(condition(etag_func=page_etag))
+    def dispatch(self, request, *args, **kwargs):
+        response = super(ConditionalGetMixin, self).dispatch(
+            request, *args, **kwargs)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from seumich.conditional import template_version
+from seumich.warehouse import data_version
+
+
+def warehouse(request):
+    '''The warehouse data and template versions, only computed when a
+    template uses them, and the timeout for template fragments cached by
+    them.'''
+    return {
+        'seumich_data_version': SimpleLazyObject(data_version),
+        'seumich_template_version': SimpleLazyObject(template_version),
+        'seumich_fragment_cache_timeout':
+            settings.SEUMICH_FRAGMENT_CACHE_TIMEOUT,
+    }
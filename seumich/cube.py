@@ -0,0 +1,278 @@
+from collections import namedtuple
+from datetime import date
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+import numpy as np
+
+from seumich.models import (ClassSiteTerm, Date, Term, WeeklyClassSiteScore,
+                            WeeklyStudentClassSiteEvent,
+                            WeeklyStudentClassSiteScore)
+from seumich.warehouse import data_version, dimensions
+
+
+# The arrays of a cube, each in its own .npy file:
+#   class_sites: sorted class site ids.
+#   offsets: rows of class_sites[i] are offsets[i]:offsets[i + 1].
+#   students: student id of every row, sorted within a class site.
+#   first_weeks: date ordinal of the first week of every class site, the
+#       first Saturday of its terms or of its facts; week j of a class site
+#       ends 7 * j days later.
+#   week_ids, week_ordinals: Date id and date ordinal of every week with
+#       facts, in date order.
+#   scores, event_percentiles: float64 (row, week of the class site), NaN
+#       where there is no fact.
+#   class_scores: float64 (class site, week of the class site).
+ARRAYS = ('class_sites', 'offsets', 'students', 'first_weeks', 'week_ids',
+          'week_ordinals', 'scores', 'event_percentiles', 'class_scores')
+
+_lock = threading.Lock()
+_cube = None
+
+ClassSiteSlice = namedtuple('ClassSiteSlice', [
+    'students', 'first_week', 'scores', 'event_percentiles', 'class_scores'])
+
+
+def _saturdays(ordinals):
+    # The Saturday ending the week of every date ordinal, the week end
+    # dates of Term.week_end_dates().
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    return ordinals + (5 - (ordinals - 1) % 7) % 7
+
+
+def _row_keys(class_site_positions, student_ids, min_student, span):
+    # Rows are sorted by class site then student, so are these keys.
+    return (class_site_positions.astype(np.int64) * span +
+            (student_ids.astype(np.int64) - min_student))
+
+
+def build_cube(directory, version):
+    '''Export the weekly student scores and event percentiles and the
+    weekly class scores to a cube in `directory`/`version` and return its
+    path. The cube is written next to it first and renamed into place, so
+    readers never see a partial one.'''
+    scores = np.array(list(WeeklyStudentClassSiteScore.objects.order_by()
+                           .fetch_size()
+                           .values_list('class_site_id', 'student_id',
+                                        'week_end_date_id', 'score')),
+                      dtype=np.float64).reshape(-1, 4)
+    events = np.array(list(WeeklyStudentClassSiteEvent.objects.order_by()
+                           .fetch_size()
+                           .values_list('class_site_id', 'student_id',
+                                        'week_end_date_id',
+                                        'percentile_rank')),
+                      dtype=np.float64).reshape(-1, 4)
+    class_scores = np.array(list(WeeklyClassSiteScore.objects.order_by()
+                                 .fetch_size()
+                                 .values_list('class_site_id',
+                                              'week_end_date_id', 'score')),
+                            dtype=np.float64).reshape(-1, 3)
+
+    week_ids = np.unique(np.r_[scores[:, 2], events[:, 2],
+                               class_scores[:, 1]]).astype(np.int64)
+    week_dates = dict(Date.objects.filter(id__in=week_ids.tolist())
+                      .values_list('id', 'date'))
+    week_ids = np.array(sorted((i for i in week_ids.tolist()
+                                if i in week_dates),
+                               key=lambda i: week_dates[i]), dtype=np.int64)
+    week_ordinals = np.array([week_dates[i].toordinal()
+                              for i in week_ids.tolist()], dtype=np.int64)
+    week_order = np.argsort(week_ids)
+    sorted_week_ids = week_ids[week_order]
+
+    def week_ordinals_of(ids):
+        # Facts of weeks missing from the Date table are left out.
+        ids = ids.astype(np.int64)
+        if not len(week_ids):
+            return (np.zeros(len(ids), dtype=np.int64),
+                    np.zeros(len(ids), dtype=bool))
+        found = np.minimum(np.searchsorted(sorted_week_ids, ids),
+                           len(week_ids) - 1)
+        return (_saturdays(week_ordinals[week_order[found]]),
+                sorted_week_ids[found] == ids)
+
+    pairs = np.r_[scores[:, :2], events[:, :2]].astype(np.int64)
+    if len(pairs):
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        pairs = pairs[np.r_[True, (np.diff(pairs, axis=0) != 0).any(axis=1)]]
+    class_sites = np.unique(np.r_[pairs[:, 0],
+                                  class_scores[:, 0].astype(np.int64)])
+    positions = np.searchsorted(class_sites, pairs[:, 0])
+    offsets = np.searchsorted(positions, np.arange(len(class_sites) + 1))
+    students = pairs[:, 1]
+
+    def class_site_positions(ids):
+        return np.searchsorted(class_sites, ids.astype(np.int64))
+
+    # The weeks of every class site span its terms and its facts.
+    first_weeks = np.full(len(class_sites), np.iinfo(np.int64).max,
+                          dtype=np.int64)
+    last_weeks = np.full(len(class_sites), np.iinfo(np.int64).min,
+                         dtype=np.int64)
+    dimension_cache = dimensions()
+    for class_site_id, term_id in (ClassSiteTerm.objects.order_by()
+                                   .values_list('class_site_id', 'term_id')):
+        i = int(np.searchsorted(class_sites, class_site_id))
+        term = dimension_cache.get(Term, term_id)
+        if (term is None or i == len(class_sites) or
+                class_sites[i] != class_site_id):
+            continue
+        first, last = _saturdays([term._begin_date.toordinal(),
+                                  term._end_date.toordinal() - 6])
+        first_weeks[i] = min(first_weeks[i], first)
+        last_weeks[i] = max(last_weeks[i], last)
+    for facts in (scores, events, class_scores):
+        weeks, known = week_ordinals_of(facts[:, -2])
+        i = class_site_positions(facts[known, 0])
+        np.minimum.at(first_weeks, i, weeks[known])
+        np.maximum.at(last_weeks, i, weeks[known])
+    spanned = first_weeks <= last_weeks
+    first_weeks[~spanned] = 0
+    width = (int(((last_weeks - first_weeks)[spanned] // 7).max()) + 1
+             if spanned.any() else 0)
+
+    min_student = int(students.min()) if len(students) else 0
+    span = int(students.max()) - min_student + 1 if len(students) else 1
+    keys = _row_keys(positions, students, min_student, span)
+
+    def fill(facts, shape_rows, row_of):
+        cube = np.full((shape_rows, width), np.nan)
+        if len(facts) and width:
+            rows = row_of(facts)
+            weeks, known = week_ordinals_of(facts[:, -2])
+            firsts = first_weeks[class_site_positions(facts[:, 0])]
+            cube[rows[known], (weeks - firsts)[known] // 7] = (
+                facts[known, -1])
+        return cube
+
+    def student_rows(facts):
+        return np.searchsorted(keys, _row_keys(
+            class_site_positions(facts[:, 0]), facts[:, 1], min_student,
+            span))
+
+    arrays = {
+        'class_sites': class_sites,
+        'offsets': offsets,
+        'students': students,
+        'first_weeks': first_weeks,
+        'week_ids': week_ids,
+        'week_ordinals': week_ordinals,
+        'scores': fill(scores, len(students), student_rows),
+        'event_percentiles': fill(events, len(students), student_rows),
+        'class_scores': fill(
+            class_scores, len(class_sites),
+            lambda facts: class_site_positions(facts[:, 0])),
+    }
+
+    path = os.path.join(directory, version)
+    building = tempfile.mkdtemp(dir=directory, prefix='.cube-')
+    try:
+        for name in ARRAYS:
+            np.save(os.path.join(building, name + '.npy'), arrays[name])
+        with open(os.path.join(building, 'cube.json'), 'w') as f:
+            json.dump({'version': version, 'built': time.time(),
+                       'rows': len(students),
+                       'class_sites': len(class_sites),
+                       'weeks': width}, f)
+        os.rename(building, path)
+    except Exception:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    return path
+
+
+class FactCube(object):
+    '''A cube built by build_cube(), memory-mapped read only so every
+    process reading it shares the pages of the files.'''
+
+    def __init__(self, path):
+        self.path = path
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'),
+                                        mmap_mode='r'))
+        # Date id of every week with facts, by the ordinal of its Saturday.
+        self.week_index = dict(zip(_saturdays(self.week_ordinals).tolist(),
+                                   self.week_ids.tolist()))
+
+    def _rows(self, class_site_id):
+        i = int(np.searchsorted(self.class_sites, class_site_id))
+        if i == len(self.class_sites) or self.class_sites[i] != class_site_id:
+            return None, None
+        return i, slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def row(self, class_site_id, student_id):
+        '''The row of a student in a class site, or None.'''
+        i, rows = self._rows(class_site_id)
+        if rows is None:
+            return None
+        students = self.students[rows]
+        j = int(np.searchsorted(students, student_id))
+        if j == len(students) or students[j] != student_id:
+            return None
+        return rows.start + j
+
+    def week(self, class_site_id, week_end_date):
+        '''The column of the week ending on `week_end_date` in the rows of
+        a class site, or None.'''
+        i, rows = self._rows(class_site_id)
+        if i is None:
+            return None
+        j = (int(_saturdays([week_end_date.toordinal()])[0]) -
+             int(self.first_weeks[i])) // 7
+        if not 0 <= j < self.scores.shape[1]:
+            return None
+        return j
+
+    def class_site(self, class_site_id):
+        '''The ClassSiteSlice of a class site, views of the cube, or None.'''
+        i, rows = self._rows(class_site_id)
+        if rows is None:
+            return None
+        return ClassSiteSlice(students=self.students[rows],
+                              first_week=date.fromordinal(
+                                  int(self.first_weeks[i])),
+                              scores=self.scores[rows],
+                              event_percentiles=self.event_percentiles[rows],
+                              class_scores=self.class_scores[i])
+
+    def weekly_values(self, class_site_id, student_id):
+        '''The weekly scores and event percentiles of a student and the
+        weekly class scores of the class site, as dicts by Date id without
+        the weeks that have no value.'''
+        i, rows = self._rows(class_site_id)
+
+        def by_week(values):
+            if values is None:
+                return {}
+            first = int(self.first_weeks[i])
+            return dict((self.week_index[first + 7 * int(j)],
+                         float(values[j]))
+                        for j in np.flatnonzero(~np.isnan(values)))
+
+        row = self.row(class_site_id, student_id)
+        return (by_week(None if row is None else self.scores[row]),
+                by_week(None if row is None
+                        else self.event_percentiles[row]),
+                by_week(None if i is None else self.class_scores[i]))
+
+
+def fact_cube():
+    '''The FactCube of the current data version in SEUMICH_FACT_CUBE_DIR, or
+    None when it was not built.'''
+    global _cube
+    directory = settings.SEUMICH_FACT_CUBE_DIR
+    if not directory:
+        return None
+    path = os.path.join(directory, data_version())
+    if _cube is None or _cube.path != path:
+        if not os.path.isdir(path):
+            return None
+        with _lock:
+            if _cube is None or _cube.path != path:
+                _cube = FactCube(path)
+    return _cube
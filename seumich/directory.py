@@ -0,0 +1,57 @@
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, When
+
+from seumich.models import Status, StudentCohortMentor
+from seumich.warehouse import current_term, data_version, dimensions
+
+
+StudentCounts = namedtuple('StudentCounts', ['students', 'red', 'yellow'])
+
+NO_STUDENTS = StudentCounts(students=0, red=0, yellow=0)
+
+
+def _status_ids(description):
+    return [status.id for status in dimensions().all(Status)
+            if status.description == description]
+
+
+def _count_students_with_status(description, term):
+    conditions = {
+        'student__studentclasssitestatus__status__in':
+            _status_ids(description),
+    }
+    if term is not None:
+        conditions['student__studentclasssitestatus__class_site__terms'] = (
+            term)
+    return Count(Case(When(then='student', **conditions)), distinct=True)
+
+
+def _compute_student_counts(field, term):
+    rows = (StudentCohortMentor.objects
+            .order_by()
+            .values(field)
+            .annotate(students=Count('student', distinct=True),
+                      red=_count_students_with_status('Red', term),
+                      yellow=_count_students_with_status('Yellow', term)))
+    return dict((row[field], StudentCounts(students=row['students'],
+                                           red=row['red'],
+                                           yellow=row['yellow']))
+                for row in rows)
+
+
+def student_counts(field, term=None):
+    '''StudentCounts by mentor or cohort key (`field` is 'mentor' or
+    'cohort'): how many students each has, and how many of those have a
+    Red or a Yellow status in a class site of `term`, by default the
+    current one, like the advisor and cohort pages show. One grouped query
+    over the bridge tables, cached per data version and term.'''
+    if term is None:
+        term = current_term()
+    return cache.get_or_set(
+        'student_counts:%s:%s:%s' % (field, term.pk if term is not None
+                                     else '', data_version()),
+        lambda: _compute_student_counts(field, term),
+        settings.SEUMICH_FRAGMENT_CACHE_TIMEOUT)
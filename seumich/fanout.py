@@ -0,0 +1,54 @@
+from multiprocessing.pool import ThreadPool
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+from seumich.identity import current_identity_map, shared_identity_map
+from seumich.statement_timeout import current_statement_timer, joined
+from student_explorer.query_stats import active_query_stats, recorded_for
+
+
+_lock = threading.Lock()
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ThreadPool(settings.SEUMICH_QUERY_FANOUT_THREADS)
+    return _pool
+
+
+def _call(func, timer, mapped, stats):
+    try:
+        # The statement time limit, the identity map and the query stats of
+        # the calling thread apply here too.
+        with joined(timer), shared_identity_map(mapped), recorded_for(stats):
+            return func()
+    finally:
+        # Pool threads have connections of their own, treat each call like
+        # a request that ended.
+        for connection in connections.all():
+            connection.close_if_unusable_or_obsolete()
+
+
+def fan_out(*funcs):
+    '''Call functions that do not depend on each other and return their
+    results in order. With SEUMICH_QUERY_FANOUT_THREADS set all but the
+    first run on a shared thread pool while the first runs on the calling
+    thread, so their queries overlap; exceptions are raised here.
+
+    The functions must finish their queries, return lists rather than
+    querysets.'''
+    if settings.SEUMICH_QUERY_FANOUT_THREADS < 1 or len(funcs) < 2:
+        return [func() for func in funcs]
+    pool = _get_pool()
+    context = (current_statement_timer(), current_identity_map(),
+               active_query_stats())
+    pending = [pool.apply_async(_call, (func,) + context)
+               for func in funcs[1:]]
+    first = funcs[0]()
+    return [first] + [result.get() for result in pending]
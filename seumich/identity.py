@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+import threading
+
+from django.core.exceptions import ValidationError
+from django.db.models import Model
+from django.db.models.expressions import Col
+from django.db.models.lookups import Exact
+from django.db.models.query import ModelIterable
+
+
+_local = threading.local()
+
+
+def _mapped(model):
+    # The fact tables use a foreign key that is not unique as their primary
+    # key, their rows have no identity.
+    return not model._meta.pk.is_relation
+
+
+class IdentityMap(object):
+    '''The warehouse model instances loaded so far, by (model, alias,
+    field, value) of the lookups that found them and of their primary
+    key. The instances of models whose primary key is a relation are left
+    out.'''
+
+    def __init__(self):
+        self.instances = {}
+        self.hits = 0
+
+    def get(self, key):
+        instance = self.instances.get(key)
+        if instance is not None:
+            self.hits += 1
+        return instance
+
+    def add(self, instance, using, key=None):
+        if not _mapped(type(instance)):
+            return
+        if key is not None:
+            self.instances[key] = instance
+        meta = instance._meta
+        self.instances.setdefault(
+            (meta.concrete_model, using, meta.pk.attname, instance.pk),
+            instance)
+
+
+def current_identity_map():
+    '''The IdentityMap of this thread, None outside of identity_map().'''
+    return getattr(_local, 'identity_map', None)
+
+
+@contextmanager
+def identity_map():
+    '''Share the instances of the warehouse models looked up by primary key
+    or by another single field, in this thread, until the block exits.
+    The warehouse is read only between loads, so a row looked up twice is
+    the same row.'''
+    outer = current_identity_map()
+    _local.identity_map = outer or IdentityMap()
+    try:
+        yield _local.identity_map
+    finally:
+        _local.identity_map = outer
+
+
+@contextmanager
+def shared_identity_map(mapped):
+    '''Use the IdentityMap `mapped` of the thread that started the block of
+    another thread, like fan_out() does. None shares nothing.'''
+    outer = current_identity_map()
+    _local.identity_map = mapped
+    try:
+        yield mapped
+    finally:
+        _local.identity_map = outer
+
+
+def _plain(queryset):
+    query = queryset.query
+    return (queryset._iterable_class is ModelIterable and
+            not queryset.model._deferred and
+            not query.select_related and not query.annotations and
+            not query.extra and not query.deferred_loading[0] and
+            not query.low_mark and query.high_mark is None)
+
+
+def identity_key(queryset):
+    '''The key of the one instance `queryset` can find when it only filters
+    on a field of its model for an exact value, else None.'''
+    if not _plain(queryset) or not _mapped(queryset.model):
+        return None
+    query = queryset.query
+    where = query.where
+    if (where.negated or len(where.children) != 1 or
+            len(query.alias_map) > 1):
+        return None
+    lookup = where.children[0]
+    if not isinstance(lookup, Exact) or not isinstance(lookup.lhs, Col):
+        return None
+    field = lookup.lhs.target
+    value = lookup.rhs
+    if isinstance(value, Model):
+        value = value.pk
+    if hasattr(value, 'resolve_expression'):
+        return None
+    try:
+        value = field.to_python(value)
+        hash(value)
+    except (ValidationError, TypeError):
+        return None
+    return (queryset.model._meta.concrete_model, queryset.db, field.attname,
+            value)
+
+
+def register(queryset, instances):
+    '''Add the instances a plain queryset loaded to the identity map by
+    primary key, keeping the ones already there.'''
+    mapped = current_identity_map()
+    if mapped is not None and _plain(queryset):
+        for instance in instances:
+            mapped.add(instance, queryset.db)
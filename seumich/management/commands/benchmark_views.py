@@ -0,0 +1,268 @@
+from datetime import datetime
+from multiprocessing import Pipe, Process
+import json
+import resource
+import time
+
+import numpy as np
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connections, transaction
+from django.db.models import Count
+from django.test.client import Client
+from django.utils.http import urlencode
+
+from seumich.models import (Student, ClassSite,
+                            StudentCohortMentor,
+                            StudentClassSiteStatus,
+                            WeeklyStudentClassSiteEvent,
+                            WeeklyStudentClassSiteScore)
+from student_explorer.query_stats import QueryStats
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def _busiest(queryset, field):
+    row = (queryset.values(field).annotate(rows=Count('pk'))
+           .order_by('-rows', field).first())
+    if row is None:
+        raise CommandError('The seumich database has no %s rows, load the '
+                           'development data or run generate_warehouse_data '
+                           'first.' % queryset.model._meta.object_name)
+    return row[field]
+
+
+def _close_connections():
+    for connection in connections.all():
+        connection.close()
+
+
+def _allowed_host():
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.')
+    return 'localhost'
+
+
+def _max_rss_kb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Command(BaseCommand):
+    help = ('Measures latency percentiles, query counts and peak memory of '
+            'every seumich page against the configured seumich database, '
+            'optionally failing when a page regressed against a baseline. '
+            'Use generate_warehouse_data to build a larger local dataset.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Timed requests per page.')
+        parser.add_argument('--warmup', type=int, default=2,
+                            help='Untimed requests per page.')
+        parser.add_argument('--output', help='Write the results as JSON.')
+        parser.add_argument('--baseline',
+                            help='Results JSON of an earlier run to compare '
+                                 'against.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative slowdown of the median '
+                                 'latency and of peak memory.')
+        parser.add_argument('--min-delta-ms', type=float, default=5.0,
+                            help='Ignore median slowdowns below this.')
+        parser.add_argument('--route', action='append', dest='routes',
+                            help='Only benchmark this url name, may be '
+                                 'repeated.')
+        parser.add_argument('--advisor', help='Mentor username.')
+        parser.add_argument('--cohort', help='Cohort code.')
+        parser.add_argument('--class-site', help='Class site id.')
+        parser.add_argument('--student', help='Student username.')
+        parser.add_argument('--class-code', help='Class site code of the '
+                                                 'student class page.')
+        parser.add_argument('--search', help='Students search terms.')
+
+    def handle(self, *args, **options):
+        routes = self.get_routes(options)
+        if options['routes']:
+            unknown = set(options['routes']) - set(name for name, u in routes)
+            if unknown:
+                raise CommandError('Unknown routes: %s' %
+                                   ', '.join(sorted(unknown)))
+            routes = [(name, url) for name, url in routes
+                      if name in options['routes']]
+
+        results = {
+            'created': datetime.now().isoformat(),
+            'repeat': options['repeat'],
+            'dataset': self.get_dataset_size(),
+            'routes': {},
+        }
+        for name, url in routes:
+            result = self.run_isolated(url, options)
+            results['routes'][name] = result
+            self.stdout.write(
+                '%-16s %3d  p50 %8.1fms  p90 %8.1fms  p99 %8.1fms  '
+                'queries %s  peak +%dKB' % (
+                    name, result['status'],
+                    result['latency_ms']['p50'], result['latency_ms']['p90'],
+                    result['latency_ms']['p99'],
+                    ' '.join('%s=%d' % item for item in
+                             sorted(result['queries'].items())),
+                    result['peak_memory_kb']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = self.compare(results, baseline, options)
+            if regressions:
+                raise CommandError('Performance regressions:\n' +
+                                   '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS(
+                'No regressions against %s' % options['baseline']))
+
+    def get_routes(self, options):
+        '''The url of every seumich page, filled in with the mentor, cohort,
+        class site and student that have the most data unless given.'''
+        advisor = options['advisor'] or _busiest(
+            StudentCohortMentor.objects.all(), 'mentor__username')
+        cohort = options['cohort'] or _busiest(
+            StudentCohortMentor.objects.all(), 'cohort__code')
+        class_site = options['class_site'] or _busiest(
+            StudentClassSiteStatus.objects.all(), 'class_site_id')
+        student = options['student'] or _busiest(
+            WeeklyStudentClassSiteScore.objects.all(), 'student__username')
+        class_code = options['class_code'] or _busiest(
+            WeeklyStudentClassSiteScore.objects.filter(
+                student__username=student), 'class_site__code')
+        search = (options['search'] or
+                  Student.objects.get(username=student).last_name)
+
+        self.username = advisor
+        return [
+            ('index', reverse('seumich:index')),
+            ('advisors_list', reverse('seumich:advisors_list')),
+            ('cohorts_list', reverse('seumich:cohorts_list')),
+            ('class_list', reverse('seumich:class_list')),
+            ('advisor', reverse('seumich:advisor', args=[advisor])),
+            ('advisor_trends', reverse('seumich:advisor_trends',
+                                       args=[advisor])),
+            ('cohort', reverse('seumich:cohort', args=[cohort])),
+            ('class_site', reverse('seumich:class_site', args=[class_site])),
+            ('students_list', '%s?%s' % (reverse('seumich:students_list'),
+                                         urlencode({'search': search}))),
+            ('student', reverse('seumich:student', args=[student])),
+            ('student_class', reverse('seumich:student_class',
+                                      args=[student, class_code])),
+        ]
+
+    def get_dataset_size(self):
+        return {
+            'students': Student.objects.count(),
+            'class_sites': ClassSite.objects.count(),
+            'weekly_student_scores':
+                WeeklyStudentClassSiteScore.objects.count(),
+            'weekly_student_events':
+                WeeklyStudentClassSiteEvent.objects.count(),
+        }
+
+    def run_isolated(self, url, options):
+        '''Benchmark a page in a forked process, so its peak memory is not
+        hidden by the pages that ran before it.'''
+        _close_connections()
+        receiver, sender = Pipe(duplex=False)
+        process = Process(target=self.run_child, args=(sender, url, options))
+        process.start()
+        result = receiver.recv()
+        process.join()
+        if isinstance(result, Exception):
+            raise CommandError('%s failed: %s' % (url, result))
+        return result
+
+    def run_child(self, sender, url, options):
+        try:
+            sender.send(self.benchmark(url, options))
+        except Exception, e:
+            sender.send(e)
+        finally:
+            _close_connections()
+            sender.close()
+
+    def benchmark(self, url, options):
+        '''Request the page `repeat` times after `warmup` requests. The user,
+        sessions and tracking events the requests write are rolled back, so
+        the run leaves the default database as it found it.'''
+        with transaction.atomic():
+            try:
+                return self.measure(url, options)
+            finally:
+                transaction.set_rollback(True)
+
+    def measure(self, url, options):
+        # Measured from the fork, the warmup requests load the templates and
+        # fill the caches the page needs.
+        start_rss = _max_rss_kb()
+        user, created = get_user_model().objects.get_or_create(
+            username=self.username)
+        client = Client(HTTP_HOST=_allowed_host())
+        client.force_login(user)
+
+        for i in range(options['warmup']):
+            client.get(url)
+
+        latencies = []
+        queries = {}
+        db_ms = {}
+        for i in range(options['repeat']):
+            with QueryStats(slowest=0) as stats:
+                started = time.time()
+                response = client.get(url)
+                latencies.append((time.time() - started) * 1000)
+            for alias_stats in stats:
+                queries[alias_stats.alias] = alias_stats.queries
+                db_ms.setdefault(alias_stats.alias, []).append(
+                    alias_stats.time * 1000)
+
+        latency_ms = dict(('p%d' % p, float(np.percentile(latencies, p)))
+                          for p in PERCENTILES)
+        latency_ms['max'] = max(latencies)
+        return {
+            'url': url,
+            'status': response.status_code,
+            'latency_ms': latency_ms,
+            'queries': queries,
+            'db_ms': dict((alias, float(np.median(times)))
+                          for alias, times in db_ms.items()),
+            'peak_memory_kb': _max_rss_kb() - start_rss,
+        }
+
+    def compare(self, results, baseline, options):
+        tolerance = 1 + options['tolerance']
+        regressions = []
+        for name, result in sorted(results['routes'].items()):
+            before = baseline['routes'].get(name)
+            if before is None:
+                continue
+            p50, before_p50 = (result['latency_ms']['p50'],
+                               before['latency_ms']['p50'])
+            if (p50 > before_p50 * tolerance and
+                    p50 - before_p50 > options['min_delta_ms']):
+                regressions.append('%s: median latency %.1fms, was %.1fms' %
+                                   (name, p50, before_p50))
+            for alias, count in sorted(result['queries'].items()):
+                before_count = before['queries'].get(alias)
+                if before_count is not None and count > before_count:
+                    regressions.append('%s: %d %s queries, was %d' %
+                                       (name, count, alias, before_count))
+            memory, before_memory = (result['peak_memory_kb'],
+                                     before['peak_memory_kb'])
+            if memory > max(before_memory, 1024) * tolerance:
+                regressions.append('%s: peak memory +%dKB, was +%dKB' %
+                                   (name, memory, before_memory))
+        return regressions
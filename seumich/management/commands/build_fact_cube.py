@@ -0,0 +1,68 @@
+import os
+import shutil
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from seumich.cube import FactCube, build_cube
+from seumich.warehouse import data_version
+
+
+class Command(BaseCommand):
+    help = ('Exports the weekly student scores, event percentiles and class '
+            'scores of the current warehouse load to a memory-mapped fact '
+            'cube the class charts are read from. Run it after each '
+            'warehouse load.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory',
+                            default=settings.SEUMICH_FACT_CUBE_DIR,
+                            help='Where to write the cube, by default '
+                                 'SEUMICH_FACT_CUBE_DIR.')
+        parser.add_argument('--keep', type=int, default=2,
+                            help='Cubes of earlier data versions to keep, '
+                                 'workers may still read them until they '
+                                 'notice the new data version.')
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild the cube of the current data '
+                                 'version if it exists.')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not directory:
+            raise CommandError('Set SEUMICH_FACT_CUBE_DIR or --directory.')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        version = data_version()
+        path = os.path.join(directory, version)
+        if os.path.isdir(path):
+            if not options['force']:
+                self.stdout.write('The cube of data version %s exists' %
+                                  version)
+                return
+            shutil.rmtree(path)
+
+        started = time.time()
+        cube = FactCube(build_cube(directory, version))
+        self.stdout.write(
+            'Built the cube of data version %s in %.1fs: %d class sites, '
+            '%d student rows, %d weeks per class site, %.1f MB' % (
+                version, time.time() - started, len(cube.class_sites),
+                len(cube.students), cube.scores.shape[1],
+                sum(os.path.getsize(os.path.join(path, name))
+                    for name in os.listdir(path)) / 1048576.0))
+        self.prune(directory, version, options['keep'])
+
+    def prune(self, directory, version, keep):
+        '''Remove all but the `keep` latest cubes before this one.'''
+        older = sorted((name for name in os.listdir(directory)
+                        if name != version and not name.startswith('.') and
+                        os.path.isdir(os.path.join(directory, name))),
+                       key=lambda name: os.path.getmtime(
+                           os.path.join(directory, name)),
+                       reverse=True)
+        for name in older[keep:]:
+            shutil.rmtree(os.path.join(directory, name))
+            self.stdout.write('Removed the cube of data version %s' % name)
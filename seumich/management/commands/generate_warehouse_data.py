@@ -0,0 +1,495 @@
+from datetime import date, timedelta
+import time
+
+import numpy as np
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections, transaction
+
+from seumich.models import (Advisor, AdvisorRole, Assignment, ClassSite,
+                            ClassSiteScore, ClassSiteTerm, Cohort, Date,
+                            EventType, Mentor, SourceSystem, Status,
+                            Student, StudentAdvisorRole,
+                            StudentClassSiteAssignment,
+                            StudentClassSiteScore, StudentClassSiteStatus,
+                            StudentCohortMentor, Term, WeeklyClassSiteScore,
+                            WeeklyStudentClassSiteEvent,
+                            WeeklyStudentClassSiteScore,
+                            WeeklyStudentClassSiteStatus)
+
+
+# In load order, dimensions before the bridges and facts that refer to them.
+WAREHOUSE_MODELS = (
+    Date, Term, SourceSystem, Status, AdvisorRole, EventType,
+    Student, Mentor, Advisor, Cohort, ClassSite, Assignment,
+    ClassSiteTerm, StudentCohortMentor, StudentAdvisorRole,
+    ClassSiteScore, StudentClassSiteScore, StudentClassSiteStatus,
+    StudentClassSiteAssignment,
+    WeeklyClassSiteScore, WeeklyStudentClassSiteScore,
+    WeeklyStudentClassSiteEvent, WeeklyStudentClassSiteStatus,
+)
+
+# Columns the views look rows up by, indexed besides the foreign keys.
+LOOKUP_FIELDS = {
+    Date: ('date',),
+    Student: ('username',),
+    Mentor: ('username',),
+    Cohort: ('code',),
+    ClassSite: ('code',),
+}
+
+FIRST_NAMES = ('Grace', 'James', 'May', 'Burl', 'Zander', 'Lavera', 'Ada',
+               'Omar', 'Priya', 'Chen', 'Lucia', 'Kwame', 'Ingrid', 'Tariq',
+               'Mei', 'Diego', 'Hannah', 'Yusuf', 'Nora', 'Emeka')
+LAST_NAMES = ('Agrippa', 'Chandler', 'Rumore', 'Okafor', 'Nguyen', 'Smith',
+              'Garcia', 'Kowalski', 'Haddad', 'Johansson', 'Patel', 'Kim',
+              'Moreau', 'Rossi', 'Tanaka', 'Silva', 'Novak', 'Brown')
+SUBJECTS = ('Math', 'Physics', 'English', 'History', 'Chemistry', 'Biology',
+            'Economics', 'Psychology', 'Spanish', 'Statistics')
+COHORT_GROUPS = ('CSP', 'Athletics', 'Honors')
+
+# Status keys as in the development data.
+GREEN, YELLOW, RED, NOT_APPLICABLE = 1, 2, 3, 4
+
+WEEKS_PER_TERM = 15
+ASSIGNMENTS_PER_CLASS_SITE = 12
+
+
+def _key_columns(model):
+    '''The warehouse keys bridge and fact tables on all of their
+    unique_together columns, see migration 0002.'''
+    opts = model._meta
+    if opts.pk.is_relation and opts.unique_together:
+        return [opts.get_field(name).column
+                for name in opts.unique_together[0]]
+    return [opts.pk.column]
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _group_starts(groups):
+    '''For sorted group ids, the index of the first row of each row's
+    group.'''
+    starts = np.r_[True, groups[1:] != groups[:-1]]
+    return np.flatnonzero(starts)[np.cumsum(starts) - 1]
+
+
+def _percentile_ranks(groups, values):
+    '''Rank of every value within its group, scaled to 0..1.'''
+    order = np.lexsort((values, groups))
+    sorted_groups = groups[order]
+    starts = _group_starts(sorted_groups)
+    sizes = np.bincount(sorted_groups)[sorted_groups]
+    ranks = np.empty(len(values))
+    ranks[order] = ((np.arange(len(values)) - starts) /
+                    np.maximum(sizes - 1, 1).astype(np.float64))
+    return np.round(ranks, 2)
+
+
+class Command(BaseCommand):
+    help = ('Fills the seumich database with a consistent synthetic '
+            'CNLYR001/CNLYR002 dataset for profiling and load tests. At '
+            'scale 1 there are 1000 students and about 200,000 rows in each '
+            'weekly fact table; the same scale and seed always produce the '
+            'same data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--terms', type=int, default=4,
+                            help='Number of terms, the last one is current.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows per INSERT statement.')
+        parser.add_argument('--create-tables', action='store_true',
+                            help='Create missing warehouse tables.')
+        parser.add_argument('--replace', action='store_true',
+                            help='Delete existing warehouse rows first.')
+        parser.add_argument('--database', default='seumich')
+
+    def handle(self, *args, **options):
+        self.connection = connections[options['database']]
+        self.batch_size = options['batch_size']
+        self.rng = np.random.RandomState(options['seed'])
+        self.today = date.today()
+        scale = options['scale']
+
+        def scaled(n):
+            return max(1, int(round(n * scale)))
+
+        self.num_students = scaled(1000)
+        self.num_mentors = scaled(20)
+        self.num_advisors = scaled(30)
+        self.num_cohorts = scaled(10)
+        self.num_terms = options['terms']
+        self.class_sites_per_term = scaled(50)
+        self.class_sites_per_student = min(4, self.class_sites_per_term)
+
+        if options['create_tables']:
+            self.create_tables()
+        self.check_empty(options['replace'])
+
+        started = time.time()
+        with transaction.atomic(using=self.connection.alias):
+            self.load_dimensions()
+            self.load_bridges()
+            self.load_facts()
+        self.stdout.write(self.style.SUCCESS(
+            'Loaded the warehouse in %.1fs' % (time.time() - started)))
+
+    # Schema
+
+    def table_exists(self, model):
+        qn = self.connection.ops.quote_name
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT 1 FROM %s WHERE 1 = 0' %
+                               qn(model._meta.db_table))
+        except DatabaseError:
+            return False
+        return True
+
+    def create_tables(self):
+        qn = self.connection.ops.quote_name
+        for model in WAREHOUSE_MODELS:
+            if self.table_exists(model):
+                continue
+            table = model._meta.db_table
+            keys = _key_columns(model)
+            definitions = ['%s %s %s' % (qn(field.column),
+                                         field.db_type(self.connection),
+                                         'NULL' if field.null else 'NOT NULL')
+                           for field in model._meta.concrete_fields]
+            definitions.append('PRIMARY KEY (%s)' %
+                               ', '.join(qn(column) for column in keys))
+            indexed = [field.column for field in model._meta.concrete_fields
+                       if field.is_relation and field.column != keys[0]]
+            indexed += [model._meta.get_field(name).column
+                        for name in LOOKUP_FIELDS.get(model, ())]
+            with self.connection.cursor() as cursor:
+                cursor.execute('CREATE TABLE %s (%s)' % (
+                    qn(table), ', '.join(definitions)))
+                for column in indexed:
+                    cursor.execute(self.create_index_sql(table, column))
+            self.stdout.write('Created %s' % table)
+
+    def create_index_sql(self, table, column):
+        qn = self.connection.ops.quote_name
+        schema, name = table.replace('"', '').split('.')
+        index = ('%s_%s' % (name, column)).lower()
+        if self.connection.vendor == 'sqlite':
+            # SQLite wants the schema on the index name, not the table.
+            return 'CREATE INDEX "%s".%s ON %s (%s)' % (
+                schema, qn(index), qn(name), qn(column))
+        return 'CREATE INDEX %s ON %s (%s)' % (qn(index), qn(table),
+                                               qn(column))
+
+    def check_empty(self, replace):
+        qn = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            for model in reversed(WAREHOUSE_MODELS):
+                table = qn(model._meta.db_table)
+                if replace:
+                    cursor.execute('DELETE FROM %s' % table)
+                    continue
+                cursor.execute('SELECT COUNT(*) FROM %s' % table)
+                if cursor.fetchone()[0]:
+                    raise CommandError(
+                        '%s already has rows, pass --replace to delete the '
+                        'existing warehouse data.' % model._meta.db_table)
+
+    def insert(self, model, fields, rows):
+        '''Load rows, tuples of values for `fields`, with multi-row
+        INSERTs.'''
+        qn = self.connection.ops.quote_name
+        columns = [model._meta.get_field(name).column for name in fields]
+        batch_size = max(1, min(self.batch_size,
+                                self.connection.ops.bulk_batch_size(
+                                    columns, range(self.batch_size))))
+        prefix = 'INSERT INTO %s (%s) VALUES ' % (
+            qn(model._meta.db_table), ', '.join(qn(c) for c in columns))
+        placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+        full_batch_sql = prefix + ', '.join([placeholders] * batch_size)
+
+        count = 0
+        with self.connection.cursor() as cursor:
+            for chunk in _chunks(rows, batch_size):
+                sql = (full_batch_sql if len(chunk) == batch_size else
+                       prefix + ', '.join([placeholders] * len(chunk)))
+                cursor.execute(sql, [value for row in chunk
+                                     for value in row])
+                count += len(chunk)
+        self.stdout.write('%-45s %9d rows' % (model._meta.db_table, count))
+
+    # Dimensions
+
+    def date_id(self, day):
+        return (day - self.first_date).days + 1
+
+    def name(self, i):
+        return (FIRST_NAMES[i % len(FIRST_NAMES)],
+                LAST_NAMES[(i * 7 + i // len(FIRST_NAMES)) % len(LAST_NAMES)])
+
+    def people(self, count, id_prefix):
+        for i in range(1, count + 1):
+            first_name, last_name = self.name(i + id_prefix)
+            username = ('%s%d' % (first_name[:8], i)).upper()
+            yield (i, username, '%d%07d' % (id_prefix, i), first_name,
+                   last_name)
+
+    def load_dimensions(self):
+        # Terms of WEEKS_PER_TERM weeks with two week breaks, the last one
+        # about half way through.
+        monday = self.today - timedelta(days=self.today.weekday())
+        current_begin = monday - timedelta(weeks=WEEKS_PER_TERM // 2)
+        self.terms = []
+        for i in range(self.num_terms):
+            begin = current_begin - timedelta(
+                weeks=(WEEKS_PER_TERM + 2) * (self.num_terms - 1 - i))
+            end = begin + timedelta(weeks=WEEKS_PER_TERM, days=-1)
+            season = ('Winter' if begin.month <= 4 else
+                      'Summer' if begin.month <= 8 else 'Fall')
+            self.terms.append((i + 1, '%d' % (2000 + 10 * i),
+                               '%s %d' % (season, begin.year), begin, end))
+
+        self.first_date = self.terms[0][3] - timedelta(days=7)
+        last_date = self.today + timedelta(days=365)
+        self.insert(Date, ('id', 'date'), (
+            (self.date_id(self.first_date + timedelta(days=i)),
+             self.first_date + timedelta(days=i))
+            for i in range((last_date - self.first_date).days + 1)))
+        self.insert(Term, ('id', 'code', 'description', '_begin_date',
+                           '_end_date'), self.terms)
+
+        # Saturdays of every term, and whether they have passed.
+        self.week_end_dates = np.array([
+            [term[3] + timedelta(days=(5 - term[3].weekday()) % 7 + 7 * week)
+             for week in range(WEEKS_PER_TERM)] for term in self.terms])
+        self.week_end_ids = np.vectorize(self.date_id)(self.week_end_dates)
+        self.weeks_passed = (self.week_end_dates <= self.today).sum(axis=1)
+
+        self.insert(SourceSystem, ('id', 'code', 'description',
+                                   'long_description'), [
+            (1, 'CTLS', 'CTools', 'CTools Application'),
+            (2, 'CNVS', 'Canvas', 'Canvas Application')])
+        self.insert(Status, ('id', 'code', 'description', 'order'), [
+            (GREEN, 'G', 'Green', 1),
+            (YELLOW, 'Y', 'Yellow', 2),
+            (RED, 'R', 'Red', 3),
+            (NOT_APPLICABLE, '', 'Not Applicable', None)])
+        self.insert(AdvisorRole, ('id', 'code', 'description'), [
+            (1, 'DEPT', 'Department Advisor'),
+            (2, 'ATHL', 'Athletics Advisor'),
+            (3, 'HNRS', 'Honors Advisor')])
+        self.insert(EventType, ('id', 'description', 'source_system'), [
+            (1, 'session start', 1),
+            (2, 'session start', 2)])
+
+        person = ('id', 'username', 'univ_id', 'first_name', 'last_name')
+        self.insert(Student, person, self.people(self.num_students, 1))
+        self.insert(Mentor, person, self.people(self.num_mentors, 2))
+        self.insert(Advisor, person, self.people(self.num_advisors, 3))
+        self.insert(Cohort, ('id', 'code', 'description', 'group'), (
+            (i, 'CHRT-%03d' % i, 'Cohort %d' % i,
+             COHORT_GROUPS[i % len(COHORT_GROUPS)])
+            for i in range(1, self.num_cohorts + 1)))
+
+        # Class site ids are numbered term by term.
+        num_class_sites = self.num_terms * self.class_sites_per_term
+        self.class_site_term = (np.arange(num_class_sites) //
+                                self.class_sites_per_term)
+        self.class_site_source = self.rng.randint(1, 3, num_class_sites)
+        subjects = self.rng.randint(len(SUBJECTS), size=num_class_sites)
+        numbers = self.rng.randint(100, 500, num_class_sites)
+        self.insert(ClassSite, ('id', 'code', 'description', 'source_system'),
+                    ((i + 1, str(i + 1),
+                      '%s %d' % (SUBJECTS[subjects[i]], numbers[i]),
+                      int(self.class_site_source[i]))
+                     for i in range(num_class_sites)))
+
+        assignments = ASSIGNMENTS_PER_CLASS_SITE
+        self.insert(Assignment, ('id', 'code', 'description',
+                                 'source_system'),
+                    ((i * assignments + j + 1,
+                      str(1000 + i * assignments + j),
+                      'Exam' if j == assignments - 1 else
+                      ('Quiz %d' % (j // 2 + 1) if j % 2 else
+                       'Homework %d' % (j // 2 + 1)),
+                      int(self.class_site_source[i]))
+                     for i in range(num_class_sites)
+                     for j in range(assignments)))
+
+    # Bridges
+
+    def load_bridges(self):
+        self.insert(ClassSiteTerm, ('id', 'class_site', 'term'), (
+            (i + 1, i + 1, int(term) + 1)
+            for i, term in enumerate(self.class_site_term)))
+
+        students = np.arange(1, self.num_students + 1)
+        cohorts = self.rng.randint(1, self.num_cohorts + 1, self.num_students)
+        mentors = self.rng.randint(1, self.num_mentors + 1, self.num_students)
+        self.insert(StudentCohortMentor, ('student', 'mentor', 'cohort'),
+                    zip(students.tolist(), mentors.tolist(),
+                        cohorts.tolist()))
+
+        advisors = self.rng.randint(1, self.num_advisors + 1,
+                                    (self.num_students, 2))
+        roles = self.rng.randint(1, 4, self.num_students)
+        second = self.rng.rand(self.num_students) < 0.3
+        rows = zip(students.tolist(), advisors[:, 0].tolist(), roles.tolist())
+        rows += zip(students[second].tolist(), advisors[second, 1].tolist(),
+                    (roles[second] % 3 + 1).tolist())
+        self.insert(StudentAdvisorRole, ('student', 'advisor', 'role'),
+                    sorted(rows))
+
+    # Facts
+
+    def load_facts(self):
+        rng = self.rng
+        per_term = self.class_sites_per_term
+        per_student = self.class_sites_per_student
+
+        # Every student takes a few class sites of every term.
+        student, class_site = [], []
+        for term in range(self.num_terms):
+            for s in range(self.num_students):
+                student.extend([s + 1] * per_student)
+                class_site.extend(term * per_term + 1 +
+                                  rng.choice(per_term, per_student,
+                                             replace=False))
+        student = np.array(student)
+        class_site = np.array(class_site)
+        term = self.class_site_term[class_site - 1]
+        num_enrollments = len(student)
+
+        ability = rng.normal(78, 10, self.num_students + 1)
+        difficulty = rng.normal(0, 5, len(self.class_site_term) + 1)
+        base = (ability[student] + difficulty[class_site] +
+                rng.normal(0, 4, num_enrollments))
+        drift = rng.normal(0, 0.8, num_enrollments)
+        activity = np.exp(rng.normal(1.5, 0.5, num_enrollments))
+
+        # One row per enrollment and week that has passed, sorted by
+        # enrollment then week.
+        weeks = self.weeks_passed[term]
+        enrollment = np.repeat(np.arange(num_enrollments), weeks)
+        week = np.arange(len(enrollment)) - _group_starts(enrollment)
+        w_student = student[enrollment]
+        w_class_site = class_site[enrollment]
+        w_date = self.week_end_ids[term[enrollment], week]
+        score = np.clip(base[enrollment] + drift[enrollment] * week +
+                        rng.normal(0, 2, len(enrollment)), 0, 100).round(1)
+        status = np.where(score >= 80, GREEN,
+                          np.where(score >= 70, YELLOW, RED))
+
+        events = rng.poisson(activity[enrollment])
+        cumulative_events = np.cumsum(events)
+        cumulative_events -= (cumulative_events - events)[
+            _group_starts(enrollment)]
+        class_week = w_class_site * WEEKS_PER_TERM + week
+        class_week_ids = np.unique(class_week, return_inverse=True)[1]
+
+        self.insert(WeeklyStudentClassSiteScore,
+                    ('student', 'class_site', 'week_end_date', 'score'),
+                    zip(w_student.tolist(), w_class_site.tolist(),
+                        w_date.tolist(), score.tolist()))
+        self.insert(WeeklyStudentClassSiteStatus,
+                    ('student', 'class_site', 'week_end_date', 'status'),
+                    zip(w_student.tolist(), w_class_site.tolist(),
+                        w_date.tolist(), status.tolist()))
+        self.insert(WeeklyStudentClassSiteEvent,
+                    ('student', 'class_site', 'week_end_date', 'event_type',
+                     'event_count', 'cumulative_event_count',
+                     'percentile_rank', 'cumulative_percentile_rank'),
+                    zip(w_student.tolist(), w_class_site.tolist(),
+                        w_date.tolist(),
+                        self.class_site_source[w_class_site - 1].tolist(),
+                        events.tolist(), cumulative_events.tolist(),
+                        _percentile_ranks(class_week_ids, events).tolist(),
+                        _percentile_ranks(class_week_ids,
+                                          cumulative_events).tolist()))
+
+        totals = np.bincount(class_week_ids, score)
+        counts = np.bincount(class_week_ids)
+        first = np.unique(class_week_ids, return_index=True)[1]
+        self.insert(WeeklyClassSiteScore,
+                    ('class_site', 'week_end_date', 'score'),
+                    sorted(zip(w_class_site[first].tolist(),
+                               w_date[first].tolist(),
+                               (totals / counts).round(1).tolist())))
+
+        # The current scores and statuses are those of the latest week.
+        has_weeks = weeks > 0
+        last = np.cumsum(weeks)[has_weeks] - 1
+        current_status = np.full(num_enrollments, NOT_APPLICABLE, dtype=int)
+        current_status[has_weeks] = status[last]
+        self.insert(StudentClassSiteStatus,
+                    ('student', 'class_site', 'status'),
+                    zip(student.tolist(), class_site.tolist(),
+                        current_status.tolist()))
+        self.insert(StudentClassSiteScore,
+                    ('student', 'class_site', 'current_score_average'),
+                    zip(student[has_weeks].tolist(),
+                        class_site[has_weeks].tolist(),
+                        score[last].tolist()))
+        class_totals = np.bincount(class_site[has_weeks], score[last])
+        class_counts = np.bincount(class_site[has_weeks])
+        scored = np.flatnonzero(class_counts)
+        self.insert(ClassSiteScore, ('class_site', 'current_score_average'),
+                    zip(scored.tolist(),
+                        (class_totals[scored] /
+                         class_counts[scored]).round(1).tolist()))
+
+        self.load_assignments(student, class_site, term, base)
+
+    def load_assignments(self, student, class_site, term, base):
+        rng = self.rng
+        assignments = ASSIGNMENTS_PER_CLASS_SITE
+        num_class_sites = len(self.class_site_term)
+
+        points = np.array([10, 20, 50, 100])[
+            rng.randint(4, size=(num_class_sites + 1, assignments))]
+        points[:, -1] = 100
+        weights = (points / points.sum(axis=1, keepdims=True).astype(
+            np.float64)).round(3)
+        # Due dates spread over the term, assignments due in the future
+        # have no rows yet.
+        offsets = (np.arange(1, assignments + 1) * WEEKS_PER_TERM * 7 //
+                   (assignments + 1))
+        begin = np.array([t[3] for t in self.terms])
+        due = begin[:, None] + np.vectorize(timedelta)(offsets)[None, :]
+        due_ids = np.vectorize(self.date_id)(due)
+        passed = due <= self.today
+
+        enrollment, j = np.nonzero(passed[term])
+        e_class_site = class_site[enrollment]
+        possible = points[e_class_site, j]
+        earned = (possible * np.clip(base[enrollment] / 100 +
+                                     rng.normal(0, 0.08, len(enrollment)),
+                                     0, 1)).round(1)
+        assignment = (e_class_site - 1) * assignments + j + 1
+        class_earned = (np.bincount(assignment, earned) /
+                        np.maximum(np.bincount(assignment), 1))[assignment]
+
+        self.insert(StudentClassSiteAssignment,
+                    ('student', 'class_site', 'assignment',
+                     'points_possible', 'points_earned',
+                     'class_points_possible', 'class_points_earned',
+                     'included_in_grade', 'grader_comment', 'weight',
+                     '_due_date'),
+                    zip(student[enrollment].tolist(), e_class_site.tolist(),
+                        assignment.tolist(), possible.tolist(),
+                        earned.tolist(), possible.tolist(),
+                        class_earned.round(1).tolist(),
+                        ['Y'] * len(enrollment), [None] * len(enrollment),
+                        weights[e_class_site, j].tolist(),
+                        due_ids[term[enrollment], j].tolist()))
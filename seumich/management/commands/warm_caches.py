@@ -0,0 +1,211 @@
+from datetime import timedelta
+from multiprocessing import Pool
+import time
+
+import numpy as np
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import (NoReverseMatch, Resolver404, resolve,
+                                      reverse)
+from django.db import connections
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from seumich.identity import identity_map
+from seumich.models import (Cohort, Student, StudentClassSiteStatus,
+                            StudentCohortMentor)
+from seumich.warehouse import data_version, dimensions
+from tracking.eventnames import EventNames
+from tracking.models import Event
+
+
+# Seconds between two pages rendered by the same worker, set per worker by
+# _init_worker().
+_interval = 0
+_last_render = 0
+
+
+def _init_worker(interval):
+    global _interval
+    _interval = interval
+    # Forked workers must not share the parent's database connections.
+    for connection in connections.all():
+        connection.close()
+
+
+def render_page(path):
+    '''Render a seumich page the way its view would for a signed in user,
+    without the login, page view logging and conditional GET layers but
+    with an identity map like a request, so its cached parts are computed
+    and stored. Pages with a paginator are rendered page by page.'''
+    match = resolve(path)
+    view = match.func.view_class(**match.func.view_initkwargs)
+    page, num_pages, statuses = 1, 1, []
+    while page <= num_pages:
+        request = RequestFactory().get(path, {'page': page} if page > 1
+                                       else {})
+        request.user = AnonymousUser()
+        view.request, view.args, view.kwargs = (request, match.args,
+                                                match.kwargs)
+        with identity_map():
+            response = view.get(request, *match.args, **match.kwargs)
+            response.render()
+        statuses.append(response.status_code)
+        paginator = (response.context_data or {}).get('paginator')
+        if paginator is not None:
+            num_pages = paginator.num_pages
+        page += 1
+    return statuses
+
+
+def warm(target):
+    '''Render one target in a pool worker, at most once per interval.'''
+    global _last_render
+    kind, path = target
+    wait = _last_render + _interval - time.time()
+    if wait > 0:
+        time.sleep(wait)
+    _last_render = started = time.time()
+    try:
+        statuses = render_page(path)
+    except Exception, e:
+        return kind, path, False, time.time() - started, repr(e)
+    ok = all(status == 200 for status in statuses)
+    return (kind, path, ok, time.time() - started,
+            None if ok else 'status %s' % statuses)
+
+
+def _event_path(note):
+    script_name = settings.FORCE_SCRIPT_NAME
+    if script_name and note.startswith(script_name):
+        note = note[len(script_name.rstrip('/')):]
+    return note
+
+
+class Command(BaseCommand):
+    help = ('Renders the pages of the active mentors and cohorts and of the '
+            'recently viewed students so their cached fragments and chart '
+            'data are in the shared cache before advisors open them. Run it '
+            'after each warehouse load; it only helps other processes when '
+            'the shared cache is memcached or Redis.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=14,
+                            help='Warm the students viewed in the last DAYS '
+                                 'days.')
+        parser.add_argument('--processes', type=int, default=4,
+                            help='Pages rendered in parallel.')
+        parser.add_argument('--rate', type=float, default=10.0,
+                            help='Pages rendered per second at most, 0 for '
+                                 'no limit.')
+        parser.add_argument('--skip-mentors', action='store_true')
+        parser.add_argument('--skip-cohorts', action='store_true')
+        parser.add_argument('--skip-students', action='store_true')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Warming data version %s' % data_version())
+        targets = self.get_targets(options)
+
+        interval = (options['processes'] / options['rate']
+                    if options['rate'] > 0 else 0)
+        # Load the dimension tables before forking so the workers start
+        # with them.
+        dimensions()
+        for connection in connections.all():
+            connection.close()
+
+        started = time.time()
+        pool = Pool(options['processes'], _init_worker, (interval,))
+        try:
+            results = []
+            for result in pool.imap_unordered(warm, targets):
+                kind, path, ok, seconds, error = result
+                if not ok:
+                    self.stderr.write('%s failed: %s' % (path, error))
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+        self.write_summary(results, time.time() - started)
+
+    def get_targets(self, options):
+        '''(kind, path) of every page to warm, most important first.'''
+        targets = [('directory', reverse('seumich:advisors_list')),
+                   ('directory', reverse('seumich:cohorts_list'))]
+        if not options['skip_mentors']:
+            mentors = (StudentCohortMentor.objects.filter(mentor__id__gte=0)
+                       .values_list('mentor__username', flat=True)
+                       .order_by('mentor__username').distinct())
+            for username in mentors:
+                targets.append(('advisor', reverse('seumich:advisor',
+                                                   args=[username])))
+                targets.append(('advisor_trends',
+                                reverse('seumich:advisor_trends',
+                                        args=[username])))
+        if not options['skip_cohorts']:
+            cohorts = (Cohort.objects.filter(id__gte=0,
+                                             studentcohortmentor__isnull=False)
+                       .values_list('code', flat=True)
+                       .order_by('code').distinct())
+            for code in cohorts:
+                targets.append(('cohort', reverse('seumich:cohort',
+                                                  args=[code])))
+        if not options['skip_students']:
+            for username in self.get_recent_students(options['days']):
+                targets.append(('student', reverse('seumich:student',
+                                                   args=[username])))
+                class_sites = (StudentClassSiteStatus.objects
+                               .filter(student__username=username)
+                               .values_list('class_site__code', flat=True)
+                               .order_by('class_site__code'))
+                for code in class_sites:
+                    try:
+                        path = reverse('seumich:student_class',
+                                       args=[username, code])
+                    except NoReverseMatch:
+                        continue
+                    targets.append(('student_class', path))
+        return targets
+
+    def get_recent_students(self, days):
+        '''Usernames of the students whose pages were viewed in the last
+        `days` days, most viewed first.'''
+        since = timezone.now() - timedelta(days=days)
+        notes = (Event.objects
+                 .filter(name=EventNames.PageViewed, timestamp__gte=since)
+                 .values_list('note', flat=True))
+        views = {}
+        for note in notes.iterator():
+            try:
+                match = resolve(_event_path(note))
+            except Resolver404:
+                continue
+            if match.url_name in ('student', 'student_class'):
+                username = match.kwargs['student']
+                views[username] = views.get(username, 0) + 1
+        existing = set(Student.objects.filter(username__in=list(views))
+                       .values_list('username', flat=True))
+        return sorted(existing, key=lambda username: (-views[username],
+                                                      username))
+
+    def write_summary(self, results, seconds):
+        self.stdout.write('%-16s %7s %7s %9s %9s' % (
+            'kind', 'pages', 'warmed', 'p50', 'max'))
+        kinds = []
+        for kind, path, ok, elapsed, error in results:
+            if kind not in kinds:
+                kinds.append(kind)
+        for kind in kinds:
+            times = [elapsed for k, path, ok, elapsed, error in results
+                     if k == kind]
+            warmed = sum(1 for k, path, ok, elapsed, error in results
+                         if k == kind and ok)
+            self.stdout.write('%-16s %7d %7d %8.1fms %8.1fms' % (
+                kind, len(times), warmed, np.median(times) * 1000,
+                max(times) * 1000))
+        warmed = sum(1 for result in results if result[2])
+        self.stdout.write('Warmed %d of %d pages (%.0f%%) in %.1fs' % (
+            warmed, len(results),
+            100.0 * warmed / len(results) if results else 100.0, seconds))
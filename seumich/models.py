@@ -1,5 +1,14 @@
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.db import models
+from django.db.models.query import ModelIterable
+from django.db.models import (Case, When, F, Q, Value, Count, Sum, Func,
+                              ExpressionWrapper)
+from seumich.identity import (current_identity_map, identity_key,
+                              register)
 from seumich.mixins import SeumichDataMixin
+from seumich.query_cache import default_timeout, resolve_timeout
+from seumich.query_hints import TunedQuery
 
 import logging
 
@@ -22,6 +31,79 @@ class UsernameField(models.CharField):
         return value
 
 
+class SeumichQuerySet(models.QuerySet):
+    '''The queryset of the warehouse models, its results can be read
+    through the cache with cache_results(). Querysets of the models named
+    in SEUMICH_RESULT_CACHE_MODELS start with it enabled. Within
+    seumich.identity.identity_map() the instances it loads are shared.
+    fetch_size() and optimizer_hints() tune how the warehouse runs it.'''
+
+    def __init__(self, model=None, query=None, using=None, hints=None):
+        if query is None:
+            query = TunedQuery(model)
+            query.result_cache_timeout = default_timeout(model)
+        super(SeumichQuerySet, self).__init__(model, query, using, hints)
+
+    def cache_results(self, enabled=True, timeout=DEFAULT_TIMEOUT):
+        '''Read the results of this queryset, and of the querysets made
+        from it, through the cache for `timeout` seconds, by default
+        SEUMICH_RESULT_CACHE_TIMEOUT. The cache keys include the data
+        version, so a warehouse load invalidates them.'''
+        clone = self._clone()
+        clone.query.result_cache_timeout = (resolve_timeout(timeout)
+                                            if enabled else False)
+        return clone
+
+    def fetch_size(self, arraysize=None, prefetchrows=None):
+        '''Fetch the rows of this queryset `arraysize` at a time, by default
+        SEUMICH_FETCH_ARRAYSIZE, with the first `prefetchrows`, by default as
+        many, coming back with the execute itself on cx_Oracle 8 and later.
+        For querysets of many rows, it saves round trips to the warehouse.'''
+        if arraysize is None:
+            arraysize = settings.SEUMICH_FETCH_ARRAYSIZE
+        clone = self._clone()
+        clone.query.arraysize = arraysize
+        clone.query.prefetchrows = prefetchrows or arraysize
+        return clone
+
+    def optimizer_hints(self, *names):
+        '''Add the optimizer hints of SEUMICH_QUERY_HINTS named by `names`
+        to the SELECT of this queryset, in a /*+ */ comment. Names that are
+        not configured add nothing.'''
+        clone = self._clone()
+        clone.query.hint_names = clone.query.hint_names + names
+        return clone
+
+    def get(self, *args, **kwargs):
+        # Within identity_map(), a lookup of one instance by a single field
+        # returns the instance an earlier lookup found.
+        mapped = current_identity_map()
+        if mapped is None:
+            return super(SeumichQuerySet, self).get(*args, **kwargs)
+        key = identity_key(self.filter(*args, **kwargs)
+                           if args or kwargs else self)
+        if key is not None:
+            instance = mapped.get(key)
+            if instance is not None:
+                return instance
+        instance = super(SeumichQuerySet, self).get(*args, **kwargs)
+        if key is not None:
+            mapped.add(instance, self.db, key)
+        return instance
+
+    def _fetch_all(self):
+        loading = self._result_cache is None
+        super(SeumichQuerySet, self)._fetch_all()
+        if loading:
+            register(self, self._result_cache)
+
+
+class SeumichManager(models.Manager.from_queryset(SeumichQuerySet)):
+    # Foreign keys to warehouse models are loaded by SeumichQuerySet too,
+    # so they go through the identity map.
+    use_for_related_fields = True
+
+
 # "Dimension" models
 
 
@@ -34,6 +116,8 @@ class Advisor(models.Model):
     last_name = models.CharField(max_length=500, db_column='ADVSR_PREF_SURNM')
     students = models.ManyToManyField('Student', through='StudentAdvisorRole')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.username
 
@@ -45,6 +129,8 @@ class Date(models.Model):
     id = models.IntegerField(primary_key=True, db_column='DT_KEY')
     date = models.DateField(db_column='CAL_DT')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.date.isoformat()
 
@@ -61,6 +147,8 @@ class Mentor(models.Model):
     last_name = models.CharField(max_length=500, db_column='MNTR_PREF_SURNM')
     students = models.ManyToManyField('Student', through='StudentCohortMentor')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.username
 
@@ -78,6 +166,8 @@ class Status(models.Model):
     description = models.CharField(max_length=50, db_column='ACAD_PERF_TXT')
     order = models.IntegerField(db_column='ACAD_PERF_ORDNL_NBR', null=True)
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.description
 
@@ -100,6 +190,8 @@ class Student(models.Model, SeumichDataMixin):
     statuses = models.ManyToManyField('Status',
                                       through='StudentClassSiteStatus')
 
+    objects = SeumichManager()
+
     @property
     def advisors(self):
         return self.aggrate_relationships(self.studentadvisorrole_set.all(),
@@ -122,6 +214,8 @@ class Term(models.Model):
     _begin_date = models.DateField(db_column='TERM_BEGIN_DT')
     _end_date = models.DateField(db_column='ACAD_TERM_END_DT')
 
+    objects = SeumichManager()
+
     @property
     def begin_date(self):
         return Date.objects.get(date=self._begin_date)
@@ -132,19 +226,20 @@ class Term(models.Model):
 
     def week_end_dates(self):
         from datetime import timedelta
-        from datetime import datetime
-
-        begin_date = datetime.strptime(str(self.begin_date), '%Y-%m-%d').date()
-        end_date = datetime.strptime(str(self.end_date), '%Y-%m-%d').date()
 
-        delta = end_date - begin_date
-        dates = []
-        for i in range(delta.days + 1):
-            date = begin_date + timedelta(days=i)
-            if date.weekday() == 5:
-                dates.append(Date.objects.get(date=date))
+        saturdays = []
+        day = self._begin_date
+        day += timedelta(days=(5 - day.weekday()) % 7)
+        while day <= self._end_date:
+            saturdays.append(day)
+            day += timedelta(days=7)
 
-        return dates
+        dates = dict((d.date, d)
+                     for d in Date.objects.filter(date__in=saturdays))
+        missing = [day for day in saturdays if day not in dates]
+        if missing:
+            raise Date.DoesNotExist('No Date %s' % missing[0].isoformat())
+        return [dates[day] for day in saturdays]
 
     def todays_week_end_date(self):
         from datetime import date, timedelta
@@ -167,6 +262,8 @@ class SourceSystem(models.Model):
     description = models.CharField(max_length=30, db_column='SRC_SYS_NM')
     long_description = models.CharField(max_length=30, db_column='SRC_SYS_DES')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.description
 
@@ -182,6 +279,8 @@ class AdvisorRole(models.Model):
     code = models.CharField(max_length=4, db_column='ADVSR_ROLE_CD')
     description = models.CharField(max_length=30, db_column='ADVSR_ROLE_DES')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.description
 
@@ -196,6 +295,8 @@ class Assignment(models.Model):
     source_system = models.ForeignKey(SourceSystem, db_column='SRC_SYS_KEY',
                                       null=True)
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.description
 
@@ -211,6 +312,8 @@ class ClassSite(models.Model):
     source_system = models.ForeignKey(SourceSystem, db_column='SRC_SYS_KEY',
                                       null=True)
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.description
 
@@ -226,6 +329,8 @@ class Cohort(models.Model):
     source_system = models.ForeignKey(SourceSystem, db_column='SRC_SYS_KEY',
                                       null=True)
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.description
 
@@ -239,6 +344,8 @@ class EventType(models.Model):
                                       null=True)
     description = models.CharField(max_length=50, db_column='EVENT_TYP_NM')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return self.description
 
@@ -246,6 +353,34 @@ class EventType(models.Model):
         db_table = '"CNLYR002"."DM_EVENT_TYP"'
 
 
+class DimensionQuerySet(SeumichQuerySet):
+    '''A queryset that can take foreign keys to the small dimension tables
+    from the process-wide dimension cache instead of joining or
+    prefetching them.'''
+
+    _dimension_paths = ()
+
+    def attach_dimensions(self, *paths):
+        '''Attach the dimension objects `paths` point to once the results
+        are loaded, see seumich.warehouse.attach_dimensions.'''
+        clone = self._clone()
+        clone._dimension_paths = self._dimension_paths + paths
+        return clone
+
+    def _clone(self, **kwargs):
+        clone = super(DimensionQuerySet, self)._clone(**kwargs)
+        clone._dimension_paths = self._dimension_paths
+        return clone
+
+    def _fetch_all(self):
+        loading = self._result_cache is None
+        super(DimensionQuerySet, self)._fetch_all()
+        if (loading and self._dimension_paths and
+                self._iterable_class is ModelIterable):
+            from seumich.warehouse import attach_dimensions
+            attach_dimensions(self._result_cache, *self._dimension_paths)
+
+
 # "Bridge" models
 
 
@@ -254,6 +389,8 @@ class ClassSiteTerm(models.Model):
     class_site = models.ForeignKey(ClassSite, db_column='CLASS_SITE_KEY')
     term = models.ForeignKey(Term, db_column='TERM_KEY')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s was held in %s' % (self.class_site, self.term)
 
@@ -267,6 +404,8 @@ class StudentAdvisorRole(models.Model):
     advisor = models.ForeignKey(Advisor, db_column='ADVSR_KEY')
     role = models.ForeignKey(AdvisorRole, db_column='ADVSR_ROLE_KEY')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s advises %s as %s' % (self.advisor, self.student, self.role)
 
@@ -281,6 +420,8 @@ class StudentCohortMentor(models.Model):
     mentor = models.ForeignKey(Mentor, db_column='MNTR_KEY')
     cohort = models.ForeignKey(Cohort, db_column='CHRT_KEY')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s is in the %s cohort' % (self.student, self.cohort)
 
@@ -297,6 +438,8 @@ class ClassSiteScore(models.Model):
                                    db_column='CLASS_SITE_KEY')
     current_score_average = models.FloatField(db_column="CLASS_CURR_SCR_AVG")
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s has an average score of %s' % (
             self.class_site, self.current_score_average)
@@ -311,6 +454,8 @@ class StudentClassSiteScore(models.Model):
     class_site = models.ForeignKey(ClassSite, db_column='CLASS_SITE_KEY')
     current_score_average = models.FloatField(db_column="STDNT_CURR_SCR_AVG")
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s has an average score of %s in %s' % (
             self.student, self.current_score_average, self.class_site)
@@ -320,6 +465,110 @@ class StudentClassSiteScore(models.Model):
         db_table = '"CNLYR002"."FC_STDNT_CLASS_SCR"'
 
 
+class NullIf(Func):
+    function = 'NULLIF'
+
+
+def _percentage_expression(earned, possible):
+    return ExpressionWrapper(F(earned) / NullIf(F(possible), Value(0)) * 100,
+                             output_field=models.FloatField())
+
+
+def _relative_to_average_expression(near='near', above='above',
+                                    below='below', missing=None,
+                                    output_field=None):
+    # Compare points earned against the class percentage scaled to the
+    # student's points possible, so the conditions are plain field lookups
+    # and can be used inside aggregates as well as annotations.
+    def bound(offset):
+        return ((_percentage_expression('class_points_earned',
+                                        'class_points_possible') + offset) *
+                F('points_possible') / 100)
+
+    incomplete = (Q(points_earned__isnull=True) |
+                  Q(points_possible__isnull=True) |
+                  Q(points_possible=0) |
+                  Q(class_points_earned__isnull=True) |
+                  Q(class_points_possible__isnull=True) |
+                  Q(class_points_possible=0))
+    is_near = (Q(points_possible__gt=0,
+                 points_earned__gte=bound(-5.0),
+                 points_earned__lte=bound(5.0)) |
+               Q(points_possible__lt=0,
+                 points_earned__lte=bound(-5.0),
+                 points_earned__gte=bound(5.0)))
+    is_above = (Q(points_possible__gt=0, points_earned__gt=bound(0.0)) |
+                Q(points_possible__lt=0, points_earned__lt=bound(0.0)))
+
+    return Case(When(incomplete, then=Value(missing)),
+                When(is_near, then=Value(near)),
+                When(is_above, then=Value(above)),
+                default=Value(below),
+                output_field=output_field or models.CharField())
+
+
+class StudentClassSiteAssignmentQuerySet(SeumichQuerySet):
+
+    def with_metrics(self):
+        '''Compute the values behind the percentage, class_percentage,
+        relative_to_average and due_date properties in the database, in
+        the same query that loads the assignments.'''
+        return (self
+                .select_related('assignment', '_due_date')
+                .annotate(
+                    student_percentage=_percentage_expression(
+                        'points_earned', 'points_possible'),
+                    class_average_percentage=_percentage_expression(
+                        'class_points_earned', 'class_points_possible'),
+                    relative_category=_relative_to_average_expression(),
+                    due_on=Case(
+                        When(_due_date__id__gte=0,
+                             then=F('_due_date__date')),
+                        default=Value(None),
+                        output_field=models.DateField())))
+
+    def course_summaries(self):
+        '''Per-course aggregates over the assignments in this queryset,
+        computed in a single grouped query and keyed by class site id.'''
+        def count_category(category):
+            counts = dict(near=0, above=0, below=0, missing=0)
+            counts[category] = 1
+            return Sum(_relative_to_average_expression(
+                output_field=models.IntegerField(), **counts))
+
+        graded = Q(points_possible__isnull=False, points_earned__isnull=False)
+        graded &= ~Q(points_possible=0)
+
+        rows = (self
+                .order_by()
+                .values('class_site')
+                .annotate(
+                    assignments=Count('assignment'),
+                    below_average=count_category('below'),
+                    near_average=count_category('near'),
+                    above_average=count_category('above'),
+                    total_points_earned=Sum('points_earned'),
+                    total_points_possible=Sum('points_possible'),
+                    weighted_points=Sum(Case(
+                        When(graded, then=F('weight') * _percentage_expression(
+                            'points_earned', 'points_possible')),
+                        default=Value(0.0),
+                        output_field=models.FloatField())),
+                    weight_total=Sum(Case(
+                        When(graded, then=F('weight')),
+                        default=Value(0.0),
+                        output_field=models.FloatField()))))
+
+        summaries = {}
+        for row in rows:
+            weighted_points = row.pop('weighted_points')
+            weight_total = row.pop('weight_total')
+            row['weighted_percentage'] = (
+                weighted_points / weight_total if weight_total else None)
+            summaries[row.pop('class_site')] = row
+        return summaries
+
+
 class StudentClassSiteAssignment(models.Model, SeumichDataMixin):
     student = models.ForeignKey(Student, db_column='STDNT_KEY',
                                 primary_key=True)
@@ -344,26 +593,39 @@ class StudentClassSiteAssignment(models.Model, SeumichDataMixin):
     _due_date = models.ForeignKey(Date, db_column='ASSGN_DUE_SBMT_DT_KEY',
                                   null=True)
 
+    objects = SeumichManager.from_queryset(
+        StudentClassSiteAssignmentQuerySet)()
+
     def __unicode__(self):
         return '%s has assignment %s in %s' % (self.student, self.assignment,
                                                self.class_site)
 
+    # The properties below prefer values annotated by
+    # StudentClassSiteAssignmentQuerySet.with_metrics() when present.
+
     @property
     def due_date(self):
         return self.valid_date_or_none(self._due_date)
 
     @property
     def percentage(self):
+        if 'student_percentage' in self.__dict__:
+            return self.student_percentage
         return self._percentage(self.points_earned,
                                 self.points_possible)
 
     @property
     def class_percentage(self):
+        if 'class_average_percentage' in self.__dict__:
+            return self.class_average_percentage
         return self._percentage(self.class_points_earned,
                                 self.class_points_possible)
 
     @property
     def relative_to_average(self):
+        if 'relative_category' in self.__dict__:
+            return self.relative_category
+
         percentage = self.percentage
         class_percentage = self.class_percentage
 
@@ -398,6 +660,8 @@ class StudentClassSiteStatus(models.Model):
     class_site = models.ForeignKey(ClassSite, db_column='CLASS_SITE_KEY')
     status = models.ForeignKey(Status, db_column='ACAD_PERF_KEY')
 
+    objects = SeumichManager.from_queryset(DimensionQuerySet)()
+
     def __unicode__(self):
         return '%s has status %s in %s' % (self.student, self.status,
                                            self.class_site)
@@ -414,6 +678,8 @@ class WeeklyClassSiteScore(models.Model):
     week_end_date = models.ForeignKey(Date, db_column='WEEK_END_DT_KEY')
     score = models.FloatField(db_column='CLASS_CURR_SCR_AVG')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return 'Average score is %s in %s on %s' % (
             self.score, self.class_site, self.week_end_date)
@@ -438,6 +704,8 @@ class WeeklyStudentClassSiteEvent(models.Model):
     cumulative_percentile_rank = models.FloatField(
         db_column='STDNT_CUM_PCTL_RNK')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s in %s on %s had %s events (%s %%ile)' % (
             self.student, self.class_site, self.week_end_date,
@@ -456,6 +724,8 @@ class WeeklyStudentClassSiteScore(models.Model):
     week_end_date = models.ForeignKey(Date, db_column='WEEK_END_DT_KEY')
     score = models.FloatField(db_column='STDNT_CURR_SCR_AVG')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s has score %s in %s on %s' % (
             self.student, self.score, self.class_site, self.week_end_date)
@@ -473,6 +743,8 @@ class WeeklyStudentClassSiteStatus(models.Model):
     week_end_date = models.ForeignKey(Date, db_column='WEEK_END_DT_KEY')
     status = models.ForeignKey(Status, db_column='ACAD_PERF_KEY')
 
+    objects = SeumichManager()
+
     def __unicode__(self):
         return '%s has status %s in %s on %s' % (
             self.student, self.status, self.class_site, self.week_end_date)
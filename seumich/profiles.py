@@ -0,0 +1,65 @@
+from collections import namedtuple
+
+from django.shortcuts import get_object_or_404
+
+from seumich.models import (Student, ClassSiteScore,
+                            StudentCohortMentor,
+                            StudentClassSiteScore,
+                            StudentClassSiteStatus)
+
+
+ClassSiteSummary = namedtuple('ClassSiteSummary', [
+    'class_site', 'status', 'student_score', 'class_score'])
+
+
+class StudentProfile(namedtuple('StudentProfile', [
+        'student', 'class_sites', 'cohort_mentors'])):
+    '''Everything the student pages show about a student, loaded up front
+    by load_student_profile().'''
+
+    __slots__ = ()
+
+    def class_site(self, code):
+        for summary in self.class_sites:
+            if summary.class_site.code == code:
+                return summary
+        return None
+
+
+def load_student_profile(username, term=None):
+    '''Load a student's class sites with their statuses and scores, only
+    the class sites of `term` when given, and the student's mentors and
+    cohorts, in five queries regardless of how many class sites the
+    student has.'''
+    student = get_object_or_404(Student, username=username)
+
+    statuses = (StudentClassSiteStatus.objects
+                .filter(student=student)
+                .select_related('class_site')
+                .attach_dimensions('status', 'class_site__source_system'))
+    if term is not None:
+        statuses = statuses.filter(class_site__terms=term)
+    student_scores = dict(StudentClassSiteScore.objects
+                          .filter(student=student)
+                          .values_list('class_site_id',
+                                       'current_score_average'))
+    class_scores = dict(ClassSiteScore.objects
+                        .filter(class_site__studentclasssitestatus__student=(
+                            student))
+                        .values_list('class_site_id',
+                                     'current_score_average'))
+    class_sites = tuple(
+        ClassSiteSummary(class_site=element.class_site,
+                         status=element.status,
+                         student_score=student_scores.get(
+                             element.class_site_id),
+                         class_score=class_scores.get(element.class_site_id))
+        for element in statuses)
+
+    cohort_mentors = tuple(StudentCohortMentor.objects
+                           .filter(student=student)
+                           .select_related('mentor', 'cohort'))
+
+    return StudentProfile(student=student,
+                          class_sites=class_sites,
+                          cohort_mentors=cohort_mentors)
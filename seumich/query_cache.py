@@ -0,0 +1,99 @@
+import hashlib
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models.sql.compiler import MULTI, SINGLE
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.sql.query import Query
+
+try:
+    from django.utils.six.moves import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# The alias whose results can be cached, it is only written by the
+# warehouse loads.
+CACHED_ALIAS = 'seumich'
+
+
+def result_cache_key(using, sql, params, result_type):
+    from seumich.warehouse import data_version
+    digest = hashlib.md5(repr((using, sql, params, result_type)))
+    return 'query:%s:%s' % (data_version(), digest.hexdigest())
+
+
+def _read_through(compiler, execute_sql, timeout):
+    def cached_execute_sql(result_type=MULTI):
+        if result_type not in (MULTI, SINGLE):
+            return execute_sql(result_type)
+        try:
+            sql, params = compiler.as_sql()
+        except EmptyResultSet:
+            return execute_sql(result_type)
+        if not sql:
+            return execute_sql(result_type)
+        key = result_cache_key(compiler.using, sql, params, result_type)
+        stored = cache.get(key)
+        if stored is not None:
+            rows = pickle.loads(zlib.decompress(stored))
+        else:
+            result = execute_sql(result_type)
+            if result_type == SINGLE:
+                rows = result
+            else:
+                rows = [tuple(row) for chunk in result for row in chunk]
+            try:
+                stored = zlib.compress(
+                    pickle.dumps(rows, pickle.HIGHEST_PROTOCOL))
+            except (pickle.PicklingError, TypeError):
+                # Values like LOB locators only live as long as the cursor.
+                pass
+            else:
+                cache.set(key, stored, timeout)
+        if result_type == SINGLE:
+            return rows
+        return iter([rows])
+    return cached_execute_sql
+
+
+class CachedResultsQuery(Query):
+    '''A Query whose SELECTs on the seumich alias read through the cache
+    when result_cache_timeout is not False. The raw rows are stored
+    pickled and compressed, by data version, SQL and parameters, and turned
+    into results as if they came from the database.'''
+
+    result_cache_timeout = False
+
+    def clone(self, klass=None, memo=None, **kwargs):
+        obj = super(CachedResultsQuery, self).clone(klass, memo, **kwargs)
+        if isinstance(obj, CachedResultsQuery):
+            obj.result_cache_timeout = self.result_cache_timeout
+        return obj
+
+    def get_compiler(self, using=None, connection=None):
+        compiler = super(CachedResultsQuery, self).get_compiler(using,
+                                                                connection)
+        if (self.result_cache_timeout is not False and
+                compiler.using == CACHED_ALIAS):
+            compiler.execute_sql = _read_through(
+                compiler, compiler.execute_sql, self.result_cache_timeout)
+        return compiler
+
+
+def default_timeout(model):
+    '''The result_cache_timeout of the querysets of `model`: the
+    SEUMICH_RESULT_CACHE_TIMEOUT for the models named in
+    SEUMICH_RESULT_CACHE_MODELS, False for the others.'''
+    if model is not None and (model._meta.object_name in
+                              settings.SEUMICH_RESULT_CACHE_MODELS):
+        return resolve_timeout(DEFAULT_TIMEOUT)
+    return False
+
+
+def resolve_timeout(timeout):
+    if timeout is DEFAULT_TIMEOUT:
+        return settings.SEUMICH_RESULT_CACHE_TIMEOUT
+    return timeout
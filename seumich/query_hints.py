@@ -0,0 +1,96 @@
+import re
+
+from django.conf import settings
+
+from seumich.query_cache import CachedResultsQuery
+from seumich.statement_timeout import current_statement_timer
+
+
+# The SELECT of a query, past the outer SELECT the Oracle backend wraps
+# sliced queries in, which a hint would not apply to.
+_SELECT = re.compile(
+    r'^(SELECT \* FROM \(SELECT "_SUB"\.\*, ROWNUM AS "_RN" FROM \()?'
+    r'SELECT\b')
+
+
+def hint_text(names):
+    '''The SEUMICH_QUERY_HINTS named by `names`, the ones not configured
+    left out.'''
+    hints = settings.SEUMICH_QUERY_HINTS
+    return ' '.join(hints[name] for name in names if hints.get(name))
+
+
+def add_hint(sql, hint):
+    '''Put the optimizer hint comment after the SELECT keyword of `sql`.'''
+    return _SELECT.sub(lambda match: '%sSELECT /*+ %s */' % (
+        match.group(1) or '', hint), sql, count=1)
+
+
+def tune_cursor(cursor, arraysize=None, prefetchrows=None):
+    '''Set the DB-API arraysize, and prefetchrows where the driver has it
+    like cx_Oracle 8, on the driver cursor under Django's cursor
+    wrappers. They must be set before the statement is executed.'''
+    # Django's cursor wrappers, and the Oracle backend's, keep the cursor
+    # they wrap in .cursor.
+    raw, wrapped = cursor, getattr(cursor, 'cursor', None)
+    while wrapped is not None and not callable(wrapped):
+        raw, wrapped = wrapped, getattr(wrapped, 'cursor', None)
+    if arraysize:
+        raw.arraysize = arraysize
+    if prefetchrows and hasattr(raw, 'prefetchrows'):
+        raw.prefetchrows = prefetchrows
+    return cursor
+
+
+class _TunedConnection(object):
+    # The connection of a compiler, whose cursors are tuned.
+
+    def __init__(self, connection, arraysize, prefetchrows):
+        self._connection = connection
+        self._arraysize = arraysize
+        self._prefetchrows = prefetchrows
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self):
+        return tune_cursor(self._connection.cursor(), self._arraysize,
+                           self._prefetchrows)
+
+
+class TunedQuery(CachedResultsQuery):
+    '''A CachedResultsQuery that can fetch its rows `arraysize` at a time,
+    with the first `prefetchrows` returned by the execute round trip, and
+    whose SELECT can carry the optimizer hints of SEUMICH_QUERY_HINTS named
+    by `hint_names`. Under seumich.statement_timeout.statement_timeout() it
+    is refused once the time limit ran out.'''
+
+    arraysize = None
+    prefetchrows = None
+    hint_names = ()
+
+    def clone(self, klass=None, memo=None, **kwargs):
+        obj = super(TunedQuery, self).clone(klass, memo, **kwargs)
+        if isinstance(obj, TunedQuery):
+            obj.arraysize = self.arraysize
+            obj.prefetchrows = self.prefetchrows
+            obj.hint_names = self.hint_names
+        return obj
+
+    def get_compiler(self, using=None, connection=None):
+        compiler = super(TunedQuery, self).get_compiler(using, connection)
+        hint = hint_text(self.hint_names)
+        if hint:
+            as_sql = compiler.as_sql
+
+            def hinted_as_sql(*args, **kwargs):
+                sql, params = as_sql(*args, **kwargs)
+                return add_hint(sql, hint), params
+            compiler.as_sql = hinted_as_sql
+        if self.arraysize or self.prefetchrows:
+            compiler.connection = _TunedConnection(
+                compiler.connection, self.arraysize, self.prefetchrows)
+        timer = current_statement_timer()
+        if timer is not None and compiler.using == timer.using:
+            compiler.execute_sql = timer.guard(compiler.execute_sql)
+        return compiler
@@ -0,0 +1,234 @@
+from contextlib import contextmanager
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.db.utils import DatabaseError
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import add_never_cache_headers
+from django.http import HttpResponse
+
+from student_explorer.metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+# The alias whose statements are limited.
+LIMITED_ALIAS = 'seumich'
+
+# The cache the copies of the pages are kept in.
+STALE_PAGE_CACHE = 'stale_pages'
+
+# Where the pages have the notice of a stale copy put in, see
+# student_explorer/index.html.
+NOTICE_MARKER = '<!-- seumich:notice -->'
+
+_local = threading.local()
+
+
+class StatementTimeout(DatabaseError):
+    '''A warehouse statement was refused because the time limit it ran
+    under had run out.'''
+
+
+def cancel_statement(connection):
+    '''Cancel the statement a Django connection is running, from another
+    thread. Does nothing when it is not connected.'''
+    raw = connection.connection
+    if raw is None:
+        return
+    if connection.vendor == 'sqlite':
+        raw.interrupt()
+    elif connection.vendor == 'mysql':
+        # MySQL cancels a statement from another connection.
+        killer = connection.get_new_connection(
+            connection.get_connection_params())
+        try:
+            killer.cursor().execute('KILL QUERY %d' % raw.thread_id())
+        finally:
+            killer.close()
+    else:
+        # cx_Oracle and psycopg2 connections cancel their running call.
+        raw.cancel()
+
+
+class StatementTimer(object):
+    '''Cancels the statements of the `using` connections that joined it
+    once `seconds` have passed, and runs out with its parent.'''
+
+    def __init__(self, seconds, using=LIMITED_ALIAS, parent=None):
+        self.seconds = seconds
+        self.using = using
+        self.parent = parent
+        self.connections = []
+        self.expired = False
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def timed_out(self):
+        return self.expired or (self.parent is not None and
+                                self.parent.timed_out)
+
+    def start(self):
+        if self.seconds:
+            self._timer = threading.Timer(self.seconds, self.expire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def expire(self):
+        '''Refuse the statements still to come and cancel the running
+        ones.'''
+        with self._lock:
+            if self._stopped or self.expired:
+                return
+            self.expired = True
+            joined = list(self.connections)
+        for connection in joined:
+            try:
+                cancel_statement(connection)
+            except Exception:
+                logger.exception('Could not cancel the statement running '
+                                 'on %s', connection.alias)
+
+    def join(self, connection):
+        with self._lock:
+            if connection not in self.connections:
+                self.connections.append(connection)
+        if self.parent is not None:
+            self.parent.join(connection)
+
+    def check(self):
+        if self.timed_out:
+            raise StatementTimeout('The time limit of the %s statements '
+                                   'ran out' % self.using)
+
+    def guard(self, execute_sql):
+        '''Wrap a compiler's execute_sql to refuse the statement once the
+        time limit ran out.'''
+        def guarded_execute_sql(*args, **kwargs):
+            self.check()
+            return execute_sql(*args, **kwargs)
+        return guarded_execute_sql
+
+
+def current_statement_timer():
+    '''The StatementTimer of this thread, None outside of
+    statement_timeout().'''
+    return getattr(_local, 'statement_timer', None)
+
+
+@contextmanager
+def joined(timer):
+    '''Run the block of another thread under the `timer` of the thread
+    that started it, like fan_out() does.'''
+    if timer is None:
+        yield None
+        return
+    outer = current_statement_timer()
+    _local.statement_timer = timer
+    connection = connections[timer.using]
+    timer.join(connection)
+    try:
+        yield timer
+    finally:
+        _local.statement_timer = outer
+        if timer.timed_out and not connection.in_atomic_block:
+            # A cancel can leave a break pending on an idle connection.
+            connection.close()
+
+
+@contextmanager
+def statement_timeout(seconds, using=LIMITED_ALIAS):
+    '''Cancel the statement running on the `using` connection of this
+    thread, or of the fan_out() calls made from it, once `seconds` have
+    passed, and refuse the statements of SeumichQuerySet querysets from then
+    on with StatementTimeout. Runs out with the time limit it is nested in.
+    Without `seconds` only the outer limit applies.'''
+    timer = StatementTimer(seconds, using, parent=current_statement_timer())
+    with joined(timer.start()):
+        try:
+            yield timer
+        finally:
+            timer.stop()
+
+
+def stale_page_key(request):
+    key = u'%s\n%s' % (request.user.get_username(), request.get_full_path())
+    return 'stale_page:%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+class StatementTimeoutMixin(object):
+    '''Limit the time the warehouse statements of the view and of its
+    template may take to `statement_timeout` seconds, by default
+    SEUMICH_STATEMENT_TIMEOUT. When it runs out the running statement is
+    cancelled and degraded_response() answers instead: the copy of the
+    page kept from its last successful GET with a notice, or
+    timed_out_response(). The copies are kept in the stale_pages cache,
+    not the default one, for SEUMICH_STALE_PAGE_TIMEOUT seconds.
+
+    Must come before ConditionalGetMixin, degraded responses are not
+    validated.'''
+
+    statement_timeout = None
+
+    def dispatch(self, request, *args, **kwargs):
+        seconds = self.statement_timeout
+        if seconds is None:
+            seconds = settings.SEUMICH_STATEMENT_TIMEOUT
+        try:
+            with statement_timeout(seconds) as timer:
+                response = super(StatementTimeoutMixin, self).dispatch(
+                    request, *args, **kwargs)
+                # Templates run queries too.
+                if not getattr(response, 'is_rendered', True):
+                    response.render()
+        except DatabaseError:
+            if not timer.timed_out:
+                raise
+            match = getattr(request, 'resolver_match', None)
+            view = match.view_name if match is not None else 'unresolved'
+            logger.warning('%s ran out of its %s statement time limit',
+                           request.path, timer.using)
+            registry.inc('student_explorer_db_statement_timeouts_total',
+                         {'view': view, 'alias': timer.using})
+            response = self.degraded_response(request, *args, **kwargs)
+            add_never_cache_headers(response)
+            return response
+        if (request.method == 'GET' and response.status_code == 200 and
+                not response.streaming and
+                settings.SEUMICH_STALE_PAGE_TIMEOUT):
+            caches[STALE_PAGE_CACHE].set(stale_page_key(request),
+                                         (timezone.now(),
+                                          response['Content-Type'],
+                                          response.content),
+                                         settings.SEUMICH_STALE_PAGE_TIMEOUT)
+        return response
+
+    def degraded_response(self, request, *args, **kwargs):
+        stale = caches[STALE_PAGE_CACHE].get(stale_page_key(request))
+        if stale is None:
+            return self.timed_out_response(request, *args, **kwargs)
+        stored, content_type, content = stale
+        notice = render_to_string('seumich/timed_out_notice.html',
+                                  {'stored': stored}, request=request)
+        return HttpResponse(
+            content.replace(NOTICE_MARKER, notice.encode('utf-8'), 1),
+            content_type=content_type)
+
+    def timed_out_response(self, request, *args, **kwargs):
+        '''The answer when there is no copy of the page.'''
+        return render(request, 'seumich/timed_out.html', status=503)
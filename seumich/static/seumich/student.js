@@ -6,3 +6,20 @@ $(function() {
     $('div[id^=student-menu-' + currentClassCode + ']').css('background-color', '#CCCCCC');
 
 });
+
+// Turns a columnar chart payload, a weeks axis shared by its series and
+// their values with a bit mask of the weeks without a value, into the
+// series of [week, value] points nvd3 charts take.
+function seumichChartData(payload) {
+    return payload.series.map(function (series) {
+        var nulls = atob(series.nulls);
+        return {
+            key: series.key,
+            color: series.color,
+            values: payload.weeks.map(function (week, i) {
+                var isNull = (nulls.charCodeAt(i >> 3) >> (7 - (i & 7))) & 1;
+                return isNull ? [week] : [week, series.values[i]];
+            })
+        };
+    });
+}
@@ -3,6 +3,8 @@ from django.utils.safestring import mark_safe
 import json
 import decimal
 
+from seumich.charts import encode_json
+
 register = template.Library()
 
 # Source:
@@ -32,6 +34,12 @@ def jsonify(list):
     return mark_safe(json.dumps(list, default=decimal_default))
 
 
+@register.filter
+def chart_json(payload):
+    '''A chart payload of seumich.charts for seumichChartData().'''
+    return mark_safe(encode_json(payload))
+
+
 @register.filter
 def divide(value, arg):
     try:
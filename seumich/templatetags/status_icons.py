@@ -0,0 +1,52 @@
+from collections import namedtuple
+from django import template
+from django.contrib.staticfiles.templatetags.staticfiles import static
+
+from seumich.models import Status
+from seumich.warehouse import dimensions
+
+register = template.Library()
+
+StatusIcon = namedtuple('StatusIcon', ['url', 'tooltip', 'alt', 'label'])
+
+# Icon file, tooltip and alt text by Status description.
+ICONS = {
+    'Green': ('Status_Icons_Green.png', 'Encourage',
+              'Green encourage status icon'),
+    'Yellow': ('Status_Icons_Yellow.png', 'Explore',
+               'Yellow explore status icon'),
+    'Red': ('Status_Icons_Red.png', 'Engage',
+            'Red engage status icon'),
+    'Not Applicable': ('Status_Icons_Not Applicable.png', 'No data',
+                       'no status available for this course icon'),
+}
+
+_status_icons = (None, {})
+
+
+def status_icons():
+    '''Map every Status key to its StatusIcon, rebuilt from the dimension
+    cache when that is reloaded.'''
+    global _status_icons
+    cache = dimensions()
+    built_from, icons = _status_icons
+    if built_from is not cache:
+        icons = {}
+        for status in cache.all(Status):
+            if status.description in ICONS:
+                filename, tooltip, alt = ICONS[status.description]
+                icons[status.id] = StatusIcon(
+                    url=static('seumich/images/' + filename),
+                    tooltip=tooltip, alt=alt, label=status.description)
+        _status_icons = (cache, icons)
+    return icons
+
+
+@register.simple_tag
+def status_icon(status):
+    '''The StatusIcon of a Status, or None for statuses without an icon.
+
+    {% status_icon element.status as icon %}'''
+    if status is None:
+        return None
+    return status_icons().get(status.id)
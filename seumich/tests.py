@@ -1,8 +1,17 @@
 import os
 from django.test import TestCase
 from django.conf import settings
+from django.core.exceptions import MultipleObjectsReturned
+from django.core.cache import cache, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management import call_command
+from django.shortcuts import get_object_or_404
+from django.test.utils import override_settings
 from django.test.client import Client
 from django.core.urlresolvers import reverse
+from django.db import connections
+from django.db.utils import DatabaseError
+from django.test.utils import CaptureQueriesContext
 from seumich.models import (UsernameField,
                             Advisor,
                             Date,
@@ -28,7 +37,42 @@ from seumich.models import (UsernameField,
                             WeeklyStudentClassSiteStatus,
                             WeeklyStudentClassSiteScore)
 from seumich.views import PaginationMixin
+from seumich import urls as seumich_urls
+from seumich.management.commands.benchmark_views import (
+    Command as BenchmarkCommand)
+from seumich.management.commands.generate_warehouse_data import (
+    _key_columns, _percentile_ranks)
+from seumich.management.commands.warm_caches import (
+    Command as WarmCachesCommand, render_page)
 from seumich.mixins import SeumichDataMixin
+from seumich.trends import mentor_trends, _series_trends
+from seumich.trajectory import load_trajectory
+from seumich.profiles import load_student_profile
+from seumich.directory import StudentCounts, student_counts
+from seumich.typeahead import prefix_index, typeahead
+from seumich.templatetags.status_icons import status_icon, status_icons
+from seumich.conditional import template_version
+from seumich.charts import (chart_payload, encode_json, weekly_values,
+                            msgpack as charts_msgpack)
+from seumich.cube import FactCube, build_cube, fact_cube
+from seumich.identity import current_identity_map, identity_map
+from seumich.query_hints import add_hint, tune_cursor
+from seumich.statement_timeout import (StatementTimeout,
+                                       current_statement_timer,
+                                       statement_timeout)
+from seumich.warehouse import (_compute_data_version, _current_term,
+                               attach_dimensions, class_site_terms,
+                               current_term, data_version, dimensions)
+from student_explorer.metrics import registry as metrics_registry
+from student_explorer.query_stats import QueryStats
+from tracking.eventnames import EventNames
+from tracking.models import Event
+from datetime import date, timedelta
+import json
+import logging
+import numpy as np
+import shutil
+import tempfile
 
 
 class SeumichTest(TestCase):
@@ -155,7 +199,8 @@ class SeumichTest(TestCase):
                       Date.objects.get(date='2015-11-28'),
                       Date.objects.get(date='2015-12-05'),
                       Date.objects.get(date='2015-12-12')]
-        self.assertEqual(self.term.week_end_dates(), dates_list)
+        with self.assertNumQueries(1, using='seumich'):
+            self.assertEqual(self.term.week_end_dates(), dates_list)
 
     def test_term_string_representation(self):
         """
@@ -333,6 +378,43 @@ class SeumichTest(TestCase):
         self.assertEqual(
             student_class_site_assignment[0].relative_to_average, 'near')
 
+    def test_studentclasssiteassignment_with_metrics(self):
+        """
+        Testing whether the database-side assignment metrics
+        match the values computed by the model properties
+        """
+        annotated = StudentClassSiteAssignment.objects.with_metrics()
+        self.assertEqual(len(annotated),
+                         StudentClassSiteAssignment.objects.count())
+        for assignment in annotated:
+            expected = StudentClassSiteAssignment.objects.get(
+                student=assignment.student_id,
+                class_site=assignment.class_site_id,
+                assignment=assignment.assignment_id)
+            self.assertEqual(assignment.relative_to_average,
+                             expected.relative_to_average)
+            if expected.percentage is None:
+                self.assertIsNone(assignment.percentage)
+            else:
+                self.assertAlmostEqual(assignment.percentage,
+                                       expected.percentage)
+            due_date = expected.due_date
+            self.assertEqual(assignment.due_on,
+                             due_date.date if due_date else None)
+
+    def test_studentclasssiteassignment_course_summaries(self):
+        summaries = (StudentClassSiteAssignment.objects
+                     .filter(student=self.student)
+                     .course_summaries())
+        self.assertEqual(sorted(summaries.keys()), [1, 2])
+        summary = summaries[self.class_site.id]
+        self.assertEqual(summary['assignments'], 15)
+        self.assertEqual(summary['below_average'], 6)
+        self.assertEqual(summary['near_average'], 5)
+        self.assertEqual(summary['above_average'], 1)
+        self.assertEqual(summary['weighted_percentage'], None)
+        self.assertEqual(summaries[1]['weighted_percentage'], 41.0)
+
     def test_studentclasssiteassignment__percentage(self):
         obj = StudentClassSiteAssignment()
 
@@ -489,6 +571,32 @@ class SeumichTest(TestCase):
                                  '<Mentor: burl>',
                                  '<Mentor: lavera>'])
 
+    def test_directory_student_counts(self):
+        # Red in a class site of an earlier term.
+        fall_2014 = Term.objects.create(id=2, code='2010',
+                                        description='Fall 2014',
+                                        _begin_date=date(2014, 9, 2),
+                                        _end_date=date(2014, 12, 15))
+        self.addCleanup(fall_2014.delete)
+        ClassSiteTerm.objects.create(id=3, class_site_id=3, term=fall_2014)
+        self.addCleanup(ClassSiteTerm.objects.filter(id=3).delete)
+        current_term()
+        cache.clear()
+        with self.assertNumQueries(1, using='seumich'):
+            counts = student_counts('mentor')
+        self.assertEqual(counts[self.mentor.id],
+                         StudentCounts(students=7, red=1, yellow=2))
+        with self.assertNumQueries(0, using='seumich'):
+            self.assertEqual(student_counts('mentor'), counts)
+
+        self.client.login(username='burl', password='burl')
+        response = self.client.get(reverse('seumich:cohorts_list'))
+        cohort = response.context['cohorts'][0]
+        self.assertEqual(cohort.student_counts,
+                         student_counts('cohort')[cohort.id])
+        self.assertContains(response,
+                            '<td>%d</td>' % cohort.student_counts.students)
+
     def test_student_list_view_redirect(self):
         url = reverse('seumich:students_list')
         response = self.client.get(url)
@@ -548,7 +656,7 @@ class SeumichTest(TestCase):
         self.assertContains(response, '81.9')
         self.assertNotContains(response, '87.1')
         url = reverse('seumich:student', kwargs={'student': 'james'})
-        response = self.client.get(url)
+        response = self.client.get(url, {'term': 'all'})
         self.assertContains(response, '150.0')
         self.assertContains(response, '100.0')
         self.assertContains(response, '95.0')
@@ -556,6 +664,29 @@ class SeumichTest(TestCase):
         self.assertContains(response, '81.9')
         self.assertContains(response, 'N/A')
 
+    def test_load_student_profile(self):
+        dimensions()
+        with self.assertNumQueries(5, using='seumich'):
+            profile = load_student_profile('grace')
+            self.assertEqual(
+                [(str(s.class_site), str(s.status), s.student_score,
+                  s.class_score) for s in profile.class_sites],
+                [('Math 101 Lab', 'Green', 86.3, 81.9),
+                 ('Math 101', 'Yellow', 83.8, 88.1)])
+            self.assertEqual(str(profile.class_site('2').class_site),
+                             'Math 101 Lab')
+            self.assertEqual(profile.class_site('missing'), None)
+            self.assertEqual(
+                [str(c.cohort) for c in profile.cohort_mentors],
+                ['Special Probation F14'])
+
+    def test_student_class_site_view_not_found(self):
+        url = reverse('seumich:student_class',
+                      kwargs={'student': 'grace', 'classcode': 'missing'})
+        self.client.login(username='burl', password='burl')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
     def test_student_class_site_view_redirect(self):
         url = reverse('seumich:student_class',
                       kwargs={'student': 'grace', 'classcode': 1})
@@ -571,17 +702,13 @@ class SeumichTest(TestCase):
         self.assertQuerysetEqual(response.context['advisors'],
                                  [('<StudentCohortMentor: grace is in the '
                                    'Special Probation F14 cohort>')])
-        self.assertQuerysetEqual(response.context['scoreData'],
-                                 [("{'color': '#255c91', 'values': [[1, 0L], "
-                                   "[2, 0L], [3, 0L], [4, 0L], [5, 65L], "
-                                   "[6, 68L], [7, 68L], [8, 68L], [9], [10], "
-                                   "[11], [12], [13], [14]], "
-                                   "'key': 'Student'}"),
-                                  ("{'color': '#F0D654', 'values': [[1, 0L], "
-                                   "[2, 0L], [3, 0L], [4, 0L], [5, 58L], "
-                                   "[6, 58L], [7, 58L], [8, 57L], [9], [10], "
-                                   "[11], [12], [13], [14]], 'key': 'Class'}")
-                                  ])
+        self.assertEqual(self.chart_points(response.context['scoreData']), [
+            ('Student', '#255c91', [[1, 0], [2, 0], [3, 0], [4, 0], [5, 65],
+                                    [6, 68], [7, 68], [8, 68], [9], [10],
+                                    [11], [12], [13], [14]]),
+            ('Class', '#F0D654', [[1, 0], [2, 0], [3, 0], [4, 0], [5, 58],
+                                  [6, 58], [7, 58], [8, 57], [9], [10],
+                                  [11], [12], [13], [14]])])
         self.assertQuerysetEqual(response.context['assignments'],
                                  [('<StudentClassSiteAssignment: grace has '
                                    'assignment Assessment in Math 101>'),
@@ -591,12 +718,547 @@ class SeumichTest(TestCase):
                       kwargs={'student': 'james', 'classcode': 3})
         self.client.login(username='burl', password='burl')
         response = self.client.get(url)
-        self.assertQuerysetEqual(response.context['scoreData'],
-                                 [("{'color': '#255c91', 'values': [], "
-                                   "'key': 'Student'}"),
-                                  ("{'color': '#F0D654', 'values': [], "
-                                   "'key': 'Class'}")
-                                  ])
+        self.assertEqual(self.chart_points(response.context['scoreData']), [
+            ('Student', '#255c91', []), ('Class', '#F0D654', [])])
+
+    def chart_points(self, payload):
+        # The [week, value] points seumichChartData() makes of a payload.
+        points = []
+        for series in payload['series']:
+            nulls = np.unpackbits(np.fromstring(series['nulls'],
+                                                dtype=np.uint8))
+            points.append((series['key'], series['color'], [
+                [week] if nulls[i] else [week, series['values'][i]]
+                for i, week in enumerate(payload['weeks'])]))
+        return points
+
+    def test_chart_payload(self):
+        payload = chart_payload([1, 2, 3, 4, 5, 6, 7, 8, 9],
+                                [('Student', '#255c91',
+                                  [0, None, 62.5, None, 1, 2, 3, 4, None])])
+        self.assertEqual(payload['series'][0]['values'],
+                         [0.0, 0.0, 62.5, 0.0, 1.0, 2.0, 3.0, 4.0, 0.0])
+        self.assertEqual(payload['series'][0]['nulls'], '\x50\x80')
+        self.assertEqual(json.loads(encode_json(payload)), {
+            'weeks': [1, 2, 3, 4, 5, 6, 7, 8, 9],
+            'series': [{'key': 'Student', 'color': '#255c91',
+                        'values': [0, 0, 62.5, 0, 1, 2, 3, 4, 0],
+                        'nulls': 'UIA='}]})
+
+        self.client.login(username='burl', password='burl')
+        url = reverse('seumich:student_class_charts',
+                      kwargs={'student': 'grace', 'classcode': 1})
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        page = self.client.get(reverse('seumich:student_class', kwargs={
+            'student': 'grace', 'classcode': 1}))
+        self.assertEqual(json.loads(response.content), json.loads(
+            encode_json({'scores': page.context['scoreData'],
+                         'events': page.context['eventPercentileData']})))
+        response = self.client.get(url, {'format': 'msgpack'})
+        self.assertEqual(response.status_code,
+                         406 if charts_msgpack is None else 200)
+        self.assertEqual(self.client.get(reverse(
+            'seumich:student_class_charts',
+            kwargs={'student': 'grace', 'classcode': 'missing'})).status_code,
+            404)
+
+    def assertWithinQueryBudget(self, url):
+        # Budgets are for a cold page in a warm process.
+        dimensions()
+        cache.clear()
+        with QueryStats(aliases=['seumich']) as stats:
+            response = self.client.get(url)
+        view = response.resolver_match.func.view_class
+        self.assertIn(response.status_code, (200, 302))
+        self.assertLessEqual(
+            stats['seumich'].queries, view.query_budget,
+            '%s ran %d seumich queries, its budget is %d:\n%s' % (
+                url, stats['seumich'].queries, view.query_budget,
+                '\n'.join(sql for time, sql in stats['seumich'].slowest)))
+
+    def test_query_budgets(self):
+        self.client.login(username='burl', password='burl')
+        for url in ['/', '/advisors/', '/cohorts/', '/classes/',
+                    '/advisors/burl/', '/advisors/burl/trends/',
+                    '/cohorts/SPPRO-W15/', '/classes/2/',
+                    '/students/?search=grace', '/students/grace/',
+                    '/students/grace/class_sites/1/',
+                    '/students/grace/class_sites/2/',
+                    '/students/grace/class_sites/2/charts/',
+                    '/students/grace/trajectory/',
+                    '/students/grace/trajectory/data/']:
+            self.assertWithinQueryBudget(url)
+        for pattern in seumich_urls.urlpatterns:
+            self.assertIsInstance(pattern.callback.view_class.query_budget,
+                                  int)
+
+    def test_query_stats_middleware(self):
+        self.client.login(username='burl', password='burl')
+        dimensions()
+        response = self.client.get('/students/grace/')
+        stats = response.wsgi_request.query_stats
+        self.assertEqual(stats['seumich'].queries, 5)
+        self.assertLessEqual(len(stats['seumich'].slowest),
+                             settings.QUERY_STATS_SLOWEST)
+        self.assertGreater(stats['default'].queries, 0)
+        fields = stats.log_fields()
+        self.assertIn('db.seumich.queries=5', fields)
+        self.assertEqual([f.split('=')[0] for f in fields],
+                         ['db.default.queries', 'db.default.ms',
+                          'db.seumich.queries', 'db.seumich.ms'])
+
+    def test_access_log_fields(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        access_logger = logging.getLogger('access_logs')
+        level = access_logger.level
+        access_logger.addHandler(handler)
+        access_logger.setLevel(logging.INFO)
+        try:
+            self.client.login(username='burl', password='burl')
+            response = self.client.get('/students/grace/')
+        finally:
+            access_logger.removeHandler(handler)
+            access_logger.setLevel(level)
+        record, = records
+        self.assertEqual(record.view_name, 'seumich:student')
+        self.assertEqual(record.response_bytes, len(response.content))
+        self.assertGreater(record.latency_ms, 0)
+        self.assertGreaterEqual(record.cache_hits + record.cache_misses, 0)
+        self.assertEqual(record.query_stats['seumich'].queries,
+                         response.wsgi_request.query_stats['seumich'].queries)
+        self.assertIn('view=seumich:student', record.getMessage())
+
+    def test_statement_timeout(self):
+        with statement_timeout(60) as timer:
+            self.assertIs(current_statement_timer(), timer)
+            self.assertEqual(len(Date.objects.all()[:1]), 1)
+            timer.expire()
+            with self.assertRaises(StatementTimeout):
+                list(Date.objects.all())
+            with statement_timeout(60) as inner:
+                self.assertTrue(inner.timed_out)
+        self.assertEqual(current_statement_timer(), None)
+
+        connection = connections['seumich']
+        if connection.vendor == 'sqlite':
+            # The running statement is cancelled.
+            with self.assertRaises(DatabaseError):
+                with statement_timeout(0.1) as timer:
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL '
+                            'SELECT x + 1 FROM c) SELECT COUNT(*) FROM c')
+            self.assertTrue(timer.expired)
+
+        # Without a copy of the page, the timed out page.
+        metrics_registry.reset()
+        cache.clear()
+        caches['stale_pages'].clear()
+        self.client.login(username='burl', password='burl')
+        url = reverse('seumich:student', kwargs={'student': 'grace'})
+        with statement_timeout(60) as timer:
+            timer.expire()
+            response = self.client.get(url)
+        self.assertContains(response, 'slow to respond', status_code=503)
+        self.assertNotIn('ETag', response)
+        self.assertIn('student_explorer_db_statement_timeouts_total'
+                      '{alias="seumich",view="seumich:student"} 1',
+                      metrics_registry.render())
+
+        # With one, the copy and a notice. It is not kept in the default
+        # cache.
+        cache.clear()
+        self.assertNotContains(self.client.get(url), 'slow to respond')
+        self.assertFalse(any('stale_page:' in key
+                             for key in cache.local.entries))
+        with statement_timeout(60) as timer:
+            timer.expire()
+            response = self.client.get(url)
+        self.assertContains(response, 'as it was')
+        self.assertContains(response, 'Math 101 Lab')
+
+        # The charts are empty.
+        with statement_timeout(60) as timer:
+            timer.expire()
+            response = self.client.get(reverse(
+                'seumich:student_class_charts',
+                kwargs={'student': 'grace', 'classcode': '2'}))
+        charts = json.loads(response.content)
+        self.assertTrue(charts['timed_out'])
+        self.assertEqual(charts['scores']['weeks'], [])
+
+    def test_student_class_site_view_fan_out(self):
+        self.client.login(username='burl', password='burl')
+        url = reverse('seumich:student_class',
+                      kwargs={'student': 'grace', 'classcode': 2})
+        dimensions()
+        cache.clear()
+        response = self.client.get(url)
+        with override_settings(SEUMICH_QUERY_FANOUT_THREADS=2):
+            cache.clear()
+            fanned_out = self.client.get(url)
+            self.assertWithinQueryBudget(url)
+        self.assertEqual(fanned_out.status_code, 200)
+        for key in ('scoreData', 'eventPercentileData', 'assignments',
+                    'assignment_summary'):
+            self.assertEqual(repr(fanned_out.context[key]),
+                             repr(response.context[key]))
+        # The queries of the pool threads are counted for the request.
+        queries = response.wsgi_request.query_stats['seumich'].queries
+        self.assertEqual(
+            fanned_out.wsgi_request.query_stats['seumich'].queries, queries)
+        self.assertIn('db.seumich.queries=%d' % queries,
+                      fanned_out.wsgi_request.query_stats.log_fields())
+
+    def test_fact_cube(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cube = FactCube(build_cube(directory, 'test'))
+        orm = weekly_values(self.student, self.class_site)
+        self.assertEqual(cube.weekly_values(2, self.student.id), orm)
+        self.assertTrue(orm[0] and orm[1] and orm[2])
+        self.assertEqual(cube.weekly_values(-42, self.student.id),
+                         ({}, {}, {}))
+        self.assertEqual(cube.row(2, -42), None)
+        class_site = cube.class_site(2)
+        row = list(class_site.students).index(self.student.id)
+        week = cube.week(2, self.week_end_date.date)
+        self.assertEqual(class_site.scores[row, week], 62)
+        self.assertEqual(class_site.first_week + timedelta(weeks=week),
+                         self.week_end_date.date)
+        self.assertEqual(class_site.class_scores[week], 81)
+        self.assertEqual(cube.week(2, date(2016, 1, 9)), None)
+
+        self.assertEqual(fact_cube(), None)
+        self.client.login(username='burl', password='burl')
+        url = reverse('seumich:student_class',
+                      kwargs={'student': 'grace', 'classcode': 2})
+        response = self.client.get(url)
+        with override_settings(SEUMICH_FACT_CUBE_DIR=directory):
+            call_command('build_fact_cube', stdout=open(os.devnull, 'w'))
+            self.assertIsInstance(fact_cube(), FactCube)
+            self.assertIs(fact_cube(), fact_cube())
+            cache.clear()
+            from_cube = self.client.get(url)
+        for key in ('scoreData', 'eventPercentileData'):
+            self.assertEqual(from_cube.context[key], response.context[key])
+
+    def test_fact_cube_weeks_of_terms(self):
+        spring = Term.objects.create(id=2, code='2080', description='W 2016',
+                                     _begin_date=date(2016, 1, 4),
+                                     _end_date=date(2016, 2, 29))
+        self.addCleanup(spring.delete)
+        ClassSiteTerm.objects.create(id=3, class_site_id=3, term=spring)
+        self.addCleanup(ClassSiteTerm.objects.filter(id=3).delete)
+        weeks = spring.week_end_dates()
+        for i, week in enumerate(weeks):
+            WeeklyClassSiteScore.objects.create(class_site_id=3,
+                                                week_end_date=week,
+                                                score=50 + i)
+        self.addCleanup(
+            WeeklyClassSiteScore.objects.filter(class_site_id=3).delete)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(SEUMICH_DATA_VERSION='two-terms'):
+            cube = FactCube(build_cube(directory, 'test'))
+        # The weeks of the longest term, not every week of both terms.
+        self.assertEqual(len(cube.week_ids), 16)
+        self.assertEqual(cube.scores.shape[1], len(self.term.week_end_dates()))
+        self.assertEqual(cube.class_scores.shape[1], 14)
+        self.assertEqual(cube.class_site(3).first_week, weeks[0].date)
+        self.assertEqual(cube.week(3, weeks[-1].date), 7)
+        self.assertEqual(cube.weekly_values(3, self.student.id)[2],
+                         dict((week.id, 50.0 + i)
+                              for i, week in enumerate(weeks)))
+        self.assertEqual(cube.class_site(2).first_week,
+                         self.term.week_end_dates()[0].date)
+
+    def test_typeahead(self):
+        self.assertEqual(typeahead(''), [])
+        prefix_index()
+        with self.assertNumQueries(0, using='seumich'):
+            results = typeahead('GRA')
+        self.assertIn({'type': 'student', 'url': '/students/grace/',
+                       'label': 'Grace Devilbiss (grace)'}, results)
+        self.assertEqual(typeahead('grace')[0]['url'], '/students/grace/')
+        self.assertLessEqual(len(typeahead('a')), 10)
+        self.assertEqual([r['url'] for r in typeahead('sppro-w15')],
+                         ['/cohorts/SPPRO-W15/'])
+        self.assertEqual(typeahead('math lab')[0]['type'], 'class_site')
+        self.assertEqual(typeahead('no such thing'), [])
+
+        self.client.login(username='burl', password='burl')
+        response = self.client.get(reverse('seumich:typeahead'),
+                                   {'q': 'burl'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['results'][0]['url'],
+                         '/advisors/burl/')
+
+    def test_benchmark_compare(self):
+        def result(p50, queries, memory):
+            return {'routes': {'student': {
+                'latency_ms': {'p50': p50},
+                'queries': {'default': 6, 'seumich': queries},
+                'peak_memory_kb': memory}}}
+
+        options = {'tolerance': 0.25, 'min_delta_ms': 5.0}
+        compare = BenchmarkCommand().compare
+        baseline = result(20.0, 6, 4000)
+        self.assertEqual(compare(result(24.0, 6, 4500), baseline, options),
+                         [])
+        self.assertEqual(compare(result(1.0, 6, 100), result(0.5, 6, 50),
+                                 options), [])
+        self.assertEqual(
+            compare(result(30.0, 8, 6000), baseline, options),
+            ['student: median latency 30.0ms, was 20.0ms',
+             'student: 8 seumich queries, was 6',
+             'student: peak memory +6000KB, was +4000KB'])
+
+    def test_generate_warehouse_data_helpers(self):
+        self.assertEqual(_key_columns(Student), ['STDNT_KEY'])
+        self.assertEqual(_key_columns(WeeklyStudentClassSiteScore),
+                         ['STDNT_KEY', 'CLASS_SITE_KEY', 'WEEK_END_DT_KEY'])
+        self.assertEqual(
+            _percentile_ranks(np.array([0, 0, 0, 1, 1, 2]),
+                              np.array([5, 1, 3, 2, 7, 4])).tolist(),
+            [1.0, 0.0, 0.5, 0.0, 1.0, 0.0])
+
+    def test_status_icons(self):
+        status_icons()
+        with self.assertNumQueries(0, using='seumich'):
+            icon = status_icon(self.status)
+        self.assertEqual(icon.label, 'Green')
+        self.assertEqual(icon.tooltip, 'Encourage')
+        self.assertTrue(icon.url.endswith('Status_Icons_Green.png'))
+        self.assertEqual(status_icon(Status.objects.get(id=4)).tooltip,
+                         'No data')
+        self.assertEqual(status_icon(None), None)
+
+    def test_data_version(self):
+        version = data_version()
+        self.assertEqual(len(version), 12)
+        with self.assertNumQueries(0, using='seumich'):
+            self.assertEqual(data_version(), version)
+        with override_settings(SEUMICH_DATA_VERSION='pinned'):
+            self.assertEqual(data_version(), 'pinned')
+
+        # A load that only adds statuses changes it too.
+        computed = _compute_data_version()
+        WeeklyStudentClassSiteStatus.objects.create(
+            student_id=6, class_site=self.class_site,
+            week_end_date=self.week_end_date, status=self.status)
+        self.addCleanup(
+            WeeklyStudentClassSiteStatus.objects.filter(student_id=6).delete)
+        self.assertNotEqual(_compute_data_version(), computed)
+
+    def test_dimensions(self):
+        cache = dimensions()
+        self.assertIs(dimensions(), cache)
+        self.assertEqual(cache.get(Status, 1).description, 'Green')
+        self.assertEqual(cache.get(Status, -42), None)
+        self.assertEqual(cache.version, data_version())
+        statuses = list(StudentClassSiteStatus.objects
+                        .filter(student=self.student)
+                        .select_related('class_site')
+                        .attach_dimensions('status',
+                                           'class_site__source_system'))
+        with self.assertNumQueries(0, using='seumich'):
+            for status in statuses:
+                self.assertIs(status.status, cache.get(Status,
+                                                       status.status_id))
+                self.assertIsNotNone(status.class_site.source_system)
+        with self.assertRaises(ValueError):
+            attach_dimensions(statuses, 'class_site')
+
+    def test_result_cache(self):
+        cache.clear()
+        expected = list(Status.objects.order_by('id'))
+        statuses = Status.objects.cache_results().order_by('id')
+        with self.assertNumQueries(1, using='seumich'):
+            self.assertEqual(list(statuses), expected)
+        with self.assertNumQueries(0, using='seumich'):
+            self.assertEqual(list(statuses.all()),
+                             list(Status.objects.order_by('id')
+                                  .cache_results()))
+        with self.assertNumQueries(2, using='seumich'):
+            for repeat in range(2):
+                self.assertEqual(statuses.filter(id=1).get().description,
+                                 'Green')
+                self.assertEqual(statuses.all().count(), len(expected))
+        with self.assertNumQueries(2, using='seumich'):
+            list(Status.objects.all())
+            list(statuses.cache_results(False))
+
+        assignments = (StudentClassSiteAssignment.objects
+                       .filter(student=self.student).with_metrics()
+                       .order_by('assignment'))
+        cached = list(assignments.cache_results())
+        with self.assertNumQueries(0, using='seumich'):
+            self.assertEqual(
+                [(a.assignment.description, a.student_percentage, a.due_on)
+                 for a in assignments.cache_results()],
+                [(a.assignment.description, a.student_percentage, a.due_on)
+                 for a in cached])
+
+        with override_settings(SEUMICH_RESULT_CACHE_MODELS=['Cohort']):
+            list(Cohort.objects.all())
+            with self.assertNumQueries(0, using='seumich'):
+                list(Cohort.objects.all())
+            with override_settings(SEUMICH_DATA_VERSION='next-load'):
+                with self.assertNumQueries(1, using='seumich'):
+                    list(Cohort.objects.all())
+
+    def test_identity_map(self):
+        day = self.week_end_date.date
+        with self.assertNumQueries(2, using='seumich'):
+            Date.objects.get(date=day)
+            Date.objects.get(date=day)
+        with identity_map() as mapped:
+            with self.assertNumQueries(1, using='seumich'):
+                found = Date.objects.get(date=day)
+                self.assertIs(Date.objects.get(date=day), found)
+                self.assertIs(Date.objects.filter(date=day).get(), found)
+                self.assertIs(get_object_or_404(Date, pk=found.pk), found)
+            self.assertEqual(mapped.hits, 3)
+
+            with self.assertNumQueries(2, using='seumich'):
+                class_sites = list(ClassSite.objects.all())
+                status = StudentClassSiteStatus.objects.filter(
+                    student=self.student, class_site=class_sites[0]).get()
+                self.assertIs(status.class_site, class_sites[0])
+                self.assertIs(ClassSite.objects.get(id=class_sites[1].id),
+                              class_sites[1])
+            with self.assertNumQueries(1, using='seumich'):
+                self.assertIsNot(ClassSite.objects.filter(id__gte=0)
+                                 .get(id=class_sites[1].id), class_sites[1])
+            with self.assertRaises(Date.DoesNotExist):
+                Date.objects.get(date=date(1900, 1, 1))
+
+            # The student key of the fact tables is not unique.
+            statuses = list(StudentClassSiteStatus.objects.filter(
+                student=self.student))
+            self.assertGreater(len(statuses), 1)
+            with self.assertRaises(MultipleObjectsReturned):
+                StudentClassSiteStatus.objects.get(pk=self.student.pk)
+            with self.assertRaises(MultipleObjectsReturned):
+                StudentClassSiteStatus.objects.get(student=self.student)
+            self.assertFalse([key for key in mapped.instances
+                              if key[0] is StudentClassSiteStatus])
+        self.assertEqual(current_identity_map(), None)
+
+        self.client.login(username='burl', password='burl')
+        response = self.client.get(reverse('seumich:student',
+                                           kwargs={'student': 'grace'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(current_identity_map(), None)
+
+    def test_query_hints(self):
+        self.assertEqual(
+            add_hint('SELECT DISTINCT "A"."B" FROM "A"', 'FULL(A)'),
+            'SELECT /*+ FULL(A) */ DISTINCT "A"."B" FROM "A"')
+        self.assertEqual(
+            add_hint('SELECT * FROM (SELECT "_SUB".*, ROWNUM AS "_RN" FROM '
+                     '(SELECT "A"."B" FROM "A") "_SUB" WHERE ROWNUM <= 5) '
+                     'WHERE "_RN" > 0', 'FULL(A)'),
+            'SELECT * FROM (SELECT "_SUB".*, ROWNUM AS "_RN" FROM '
+            '(SELECT /*+ FULL(A) */ "A"."B" FROM "A") "_SUB" WHERE '
+            'ROWNUM <= 5) WHERE "_RN" > 0')
+
+        hints = {'cohort_roster': 'FULL(DM_STDNT)', 'unused': 'NO_MERGE'}
+        with override_settings(SEUMICH_QUERY_HINTS=hints):
+            with CaptureQueriesContext(connections['seumich']) as queries:
+                students = list(Student.objects.optimizer_hints(
+                    'cohort_roster', 'missing').filter(id__gte=0)[:5])
+            self.assertEqual(len(students), 5)
+            self.assertTrue(queries[0]['sql'].startswith(
+                'SELECT /*+ FULL(DM_STDNT) */ '))
+            with CaptureQueriesContext(connections['seumich']) as queries:
+                list(Student.objects.all())
+            self.assertNotIn('/*+', queries[0]['sql'])
+
+            self.client.login(username='burl', password='burl')
+            with CaptureQueriesContext(connections['seumich']) as queries:
+                response = self.client.get(
+                    reverse('seumich:cohort', kwargs={'code': 'SPPRO-W15'}))
+            self.assertContains(response, 'janell')
+            self.assertTrue(any('/*+ FULL(DM_STDNT) */' in query['sql']
+                                for query in queries))
+
+        with connections['seumich'].cursor() as cursor:
+            tune_cursor(cursor, arraysize=250, prefetchrows=250)
+            self.assertEqual(cursor.cursor.arraysize, 250)
+        queryset = Date.objects.fetch_size()
+        self.assertEqual(queryset.query.arraysize,
+                         settings.SEUMICH_FETCH_ARRAYSIZE)
+        self.assertEqual(queryset.query.prefetchrows,
+                         settings.SEUMICH_FETCH_ARRAYSIZE)
+        self.assertEqual(queryset.filter(id__gte=0).query.arraysize,
+                         settings.SEUMICH_FETCH_ARRAYSIZE)
+        self.assertEqual(len(queryset), Date.objects.count())
+
+    def test_student_rows_are_cached(self):
+        self.client.login(username='burl', password='burl')
+        url = reverse('seumich:advisor', kwargs={'advisor': 'burl'})
+        cache.clear()
+        first = self.client.get(url)
+        self.assertContains(first, 'Status_Icons_Green.png')
+        self.assertTrue(cache.get(make_template_fragment_key(
+            'student_row', [self.student.id, current_term().id, '',
+                            data_version(), template_version()])))
+        second = self.client.get(url)
+        self.assertEqual(first.content, second.content)
+
+    def test_conditional_get(self):
+        self.client.login(username='burl', password='burl')
+        url = reverse('seumich:student', kwargs={'student': 'grace'})
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('private', first['Cache-Control'])
+        etag = first['ETag']
+
+        views = Event.objects.filter(name=EventNames.PageViewed).count()
+        with self.assertNumQueries(0, using='seumich'):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(
+            Event.objects.filter(name=EventNames.PageViewed).count(),
+            views + 1)
+
+        other = self.client.get(reverse('seumich:student',
+                                        kwargs={'student': 'james'}))
+        self.assertNotEqual(other['ETag'], etag)
+        with override_settings(SEUMICH_DATA_VERSION='reloaded'):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.client.login(username='lavera', password='lavera')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_warm_caches(self):
+        Event.objects.create(name=EventNames.PageViewed,
+                             note='/students/grace/class_sites/2/')
+        Event.objects.create(name=EventNames.PageViewed,
+                             note='/students/grace/')
+        Event.objects.create(name=EventNames.PageViewed,
+                             note='/students/nobody/')
+        command = WarmCachesCommand()
+        self.assertEqual(command.get_recent_students(1), ['grace'])
+        targets = command.get_targets({'days': 1, 'skip_mentors': False,
+                                       'skip_cohorts': True,
+                                       'skip_students': False})
+        self.assertIn(('advisor', '/advisors/burl/'), targets)
+        self.assertIn(('student_class', '/students/grace/class_sites/2/'),
+                      targets)
+
+        cache.clear()
+        self.assertEqual(render_page('/advisors/burl/'), [200])
+        self.assertTrue(cache.get(make_template_fragment_key(
+            'student_row', [self.student.id, current_term().id, '',
+                            data_version(), template_version()])))
 
     def test_pagination_mixin(self):
         pagination = PaginationMixin()
@@ -621,6 +1283,13 @@ class SeumichTest(TestCase):
     def test_class_list_view(self):
         self.client.login(username='burl', password='burl')
         response = self.client.get(reverse('seumich:class_list'))
+        self.assertEqual(response.context['term'].description, 'Fall 2015')
+        self.assertQuerysetEqual(list(response.context['classes']),
+                                 ['<ClassSite: Math 101>',
+                                  '<ClassSite: Math 101 Lab>'])
+        response = self.client.get(reverse('seumich:class_list'),
+                                   {'term': 'all'})
+        self.assertEqual(response.context['term'], None)
         self.assertQuerysetEqual(list(response.context['classes']),
                                  ['<ClassSite: Math 101>',
                                   '<ClassSite: Math 101 Lab>',
@@ -629,6 +1298,93 @@ class SeumichTest(TestCase):
                                   '<ClassSite: English 101>',
                                   '<ClassSite: History 101>'])
 
+    def test_class_list_view_unknown_term(self):
+        self.client.login(username='burl', password='burl')
+        for term in ['42', 'fall']:
+            response = self.client.get(reverse('seumich:class_list'),
+                                       {'term': term})
+            self.assertEqual(response.status_code, 404)
+
+    def test_class_site_terms(self):
+        terms = class_site_terms()
+        self.assertEqual([term.description for term in terms.terms],
+                         ['Fall 2015'])
+        self.assertIs(current_term(), terms.current)
+        with self.assertNumQueries(0, using='seumich'):
+            self.assertIs(class_site_terms(), terms)
+        fall = terms.terms[0]
+        self.assertIs(_current_term(terms.terms, fall._begin_date), fall)
+        self.assertIs(_current_term(terms.terms, date(2030, 1, 1)), fall)
+        self.assertIs(_current_term(terms.terms, date(2000, 1, 1)), fall)
+        self.assertEqual(_current_term([], date(2015, 9, 1)), None)
+
+    def test_series_trends(self):
+        dates = [date(2015, 9, 12), date(2015, 9, 19), date(2015, 9, 26),
+                 date(2015, 9, 12), date(2015, 9, 19), date(2015, 9, 26)]
+        trends = _series_trends([1, 1, 1, 2, 2, 2], [5, 5, 5, 5, 5, 5], dates,
+                                [90.0, 80.0, 70.0, 50.0, 60.0, 70.0],
+                                window=6)
+        self.assertEqual(trends[(1, 5)], (3, 70.0, -10.0, -15.0))
+        self.assertEqual(trends[(2, 5)], (3, 70.0, 10.0, 15.0))
+        trends = _series_trends([1, 1, 1], [5, 5, 5], dates[:3],
+                                [90.0, 80.0, 70.0], window=1)
+        self.assertEqual(trends[(1, 5)], (1, 70.0, None, None))
+        self.assertEqual(_series_trends([], [], [], [], window=6), {})
+
+    def test_mentor_trends(self):
+        trends = mentor_trends(self.mentor)
+        self.assertEqual([(str(t.student), str(t.class_site))
+                          for t in trends],
+                         [('grace', 'Math 101 Lab'), ('grace', 'Math 101')])
+        self.assertEqual(round(trends[1].score_slope, 2), 15.63)
+        self.assertEqual(round(trends[1].score_drop, 2), 27.8)
+        self.assertEqual(trends[1].latest_event_percentile, None)
+        self.assertFalse(trends[1].trending_down)
+        # Only the class sites of the term.
+        self.assertEqual(mentor_trends(self.mentor, term=Term(id=42)), [])
+
+    def test_student_trajectory(self):
+        grace = Student.objects.get(username='grace')
+        trajectory = load_trajectory(grace)
+        self.assertEqual([str(entry.term) for entry in trajectory],
+                         ['Fall 2015'])
+        fall = trajectory[0]
+        self.assertEqual([str(summary.class_site) for summary
+                          in fall.class_sites], ['Math 101', 'Math 101 Lab'])
+        self.assertEqual(round(fall.average_score, 2), 85.05)
+        self.assertEqual([(str(status), count) for status, count
+                          in fall.status_counts], [('Green', 2)])
+        self.assertEqual(fall.weeks, range(1, 9))
+        self.assertEqual(dict((str(status), counts) for status, counts
+                              in fall.status_series)['Green'],
+                         [0, 0, 0, 0, 2, 2, 2, 2])
+        # Class sites without a term come last.
+        james = Student.objects.get(username='james')
+        self.assertEqual([entry.term for entry in load_trajectory(james)],
+                         [None])
+
+        self.client.login(username='burl', password='burl')
+        response = self.client.get(reverse(
+            'seumich:student_trajectory', kwargs={'student': 'grace'}))
+        self.assertContains(response, 'Fall 2015')
+        self.assertContains(response, 'Math 101 Lab')
+        response = self.client.get(reverse(
+            'seumich:student_trajectory_data', kwargs={'student': 'grace'}))
+        data = json.loads(response.content)
+        self.assertEqual(data['terms'][0]['term']['description'],
+                         'Fall 2015')
+        self.assertEqual(data['terms'][0]['statuses']['weeks'], range(1, 9))
+        self.assertEqual(self.client.get(reverse(
+            'seumich:student_trajectory',
+            kwargs={'student': 'nobody'})).status_code, 404)
+
+    def test_advisor_trends_view(self):
+        url = reverse('seumich:advisor_trends', kwargs={'advisor': 'burl'})
+        self.client.login(username='burl', password='burl')
+        response = self.client.get(url)
+        self.assertContains(response, 'Math 101 Lab')
+        self.assertEqual(len(response.context['trends']), 2)
+
     def test_cohort_view(self):
         url = reverse('seumich:cohort',
                       kwargs={'code': 'SPPRO-W15'})
@@ -657,6 +1413,25 @@ class SeumichTest(TestCase):
         self.assertContains(response, 'mike')
         self.assertNotContains(response, 'grace')
         self.assertNotContains(response, 'wendi')
+        self.assertNotIn('term', response.context)
+        self.assertNotContains(response, 'term-filter')
+        # Without a term only the statuses of the class site itself.
+        for student in response.context['students']:
+            self.assertEqual(
+                set(status.class_site_id for status in
+                    student.studentclasssitestatus_set.all()), set([6]))
+
+    def test_class_site_view_statuses_of_its_terms(self):
+        url = reverse('seumich:class_site',
+                      kwargs={'class_site_id': 1})
+        self.client.login(username='burl', password='burl')
+        response = self.client.get(url, {'term': 'all'})
+        class_site_ids = set()
+        for student in response.context['students']:
+            class_site_ids.update(status.class_site_id for status in
+                                  student.studentclasssitestatus_set.all())
+        self.assertIn(1, class_site_ids)
+        self.assertLessEqual(class_site_ids, set([1, 2]))
 
     def test_logout(self):
         self.client.login(username='burl', password='burl')
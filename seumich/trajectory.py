@@ -0,0 +1,175 @@
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+import numpy as np
+
+from seumich.charts import chart_payload
+from seumich.models import (ClassSite, ClassSiteScore, ClassSiteTerm,
+                            Status, StudentClassSiteScore, Term,
+                            WeeklyStudentClassSiteStatus)
+from seumich.profiles import ClassSiteSummary
+from seumich.warehouse import data_version, dimensions
+
+
+# Series color by Status description, like the status icons.
+STATUS_COLORS = {
+    'Green': '#3c763d',
+    'Yellow': '#F0D654',
+    'Red': '#a94442',
+    'Not Applicable': '#999999',
+}
+
+TermTrajectory = namedtuple('TermTrajectory', [
+    'term', 'class_sites', 'average_score', 'class_average',
+    'status_counts', 'weeks', 'week_end_dates', 'status_series'])
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return float(np.mean(values)) if values else None
+
+
+def _week_number(term, week_end_date, i):
+    if term is None:
+        return i + 1
+    return (week_end_date - term._begin_date).days // 7 + 1
+
+
+def _term_trajectory(term, summaries, weekly, statuses):
+    '''The TermTrajectory of the ClassSiteSummary of a term and the
+    (class site id, week end date, status id) of their weeks.'''
+    week_end_dates = sorted(set(row[1] for row in weekly))
+    week_index = dict((d, i) for i, d in enumerate(week_end_dates))
+    status_index = dict((status.id, i) for i, status in enumerate(statuses))
+    counts = np.zeros((len(statuses), len(week_end_dates)), dtype=np.int64)
+    known = [row for row in weekly if row[2] in status_index]
+    if known:
+        np.add.at(counts, ([status_index[row[2]] for row in known],
+                           [week_index[row[1]] for row in known]), 1)
+    latest = [summary.status for summary in summaries
+              if summary.status is not None]
+    return TermTrajectory(
+        term=term,
+        class_sites=tuple(summaries),
+        average_score=_mean([s.student_score for s in summaries]),
+        class_average=_mean([s.class_score for s in summaries]),
+        status_counts=tuple((status, latest.count(status))
+                            for status in statuses if status in latest),
+        weeks=[_week_number(term, d, i)
+               for i, d in enumerate(week_end_dates)],
+        week_end_dates=week_end_dates,
+        status_series=tuple((status, counts[i].tolist())
+                            for i, status in enumerate(statuses)
+                            if counts[i].any()))
+
+
+def load_trajectory(student):
+    '''A student's class sites of every term grouped by Term, latest term
+    first and the class sites without a term last, in five queries however
+    many terms and class sites the student has. The status of a class site
+    is its latest weekly status.'''
+    weekly = list(WeeklyStudentClassSiteStatus.objects
+                  .filter(student=student)
+                  .order_by('week_end_date__date')
+                  .optimizer_hints('student_trajectory')
+                  .fetch_size()
+                  .values_list('class_site_id', 'week_end_date__date',
+                               'status_id'))
+    student_scores = dict(StudentClassSiteScore.objects
+                          .filter(student=student)
+                          .values_list('class_site_id',
+                                       'current_score_average'))
+    class_site_ids = set(student_scores) | set(row[0] for row in weekly)
+    if not class_site_ids:
+        return ()
+    class_sites = (ClassSite.objects.filter(id__in=class_site_ids)
+                   .order_by('description'))
+    class_scores = dict(ClassSiteScore.objects
+                        .filter(class_site_id__in=class_site_ids)
+                        .values_list('class_site_id',
+                                     'current_score_average'))
+    dimension_cache = dimensions()
+    terms_of = {}
+    for class_site_id, term_id in (ClassSiteTerm.objects
+                                   .filter(class_site_id__in=class_site_ids)
+                                   .values_list('class_site_id', 'term_id')):
+        term = dimension_cache.get(Term, term_id)
+        if term is not None:
+            terms_of.setdefault(class_site_id, []).append(term)
+
+    statuses = sorted(dimension_cache.all(Status),
+                      key=lambda status: (status.order is None, status.order))
+    latest_status = {}
+    for class_site_id, week_end_date, status_id in weekly:
+        latest_status[class_site_id] = status_id
+
+    by_term = {}
+    for class_site in class_sites:
+        summary = ClassSiteSummary(
+            class_site=class_site,
+            status=dimension_cache.get(Status,
+                                       latest_status.get(class_site.id)),
+            student_score=student_scores.get(class_site.id),
+            class_score=class_scores.get(class_site.id))
+        for term in terms_of.get(class_site.id) or [None]:
+            by_term.setdefault(term, []).append(summary)
+
+    terms = sorted((term for term in by_term if term is not None),
+                   key=lambda term: term._begin_date, reverse=True)
+    if None in by_term:
+        terms.append(None)
+    trajectory = []
+    for term in terms:
+        summaries = by_term[term]
+        ids = set(summary.class_site.id for summary in summaries)
+        trajectory.append(_term_trajectory(
+            term, summaries, [row for row in weekly if row[0] in ids],
+            statuses))
+    return tuple(trajectory)
+
+
+def trajectory_cache_key(student):
+    return 'trajectory:%s:%d' % (data_version(), student.id)
+
+
+def student_trajectory(student):
+    '''load_trajectory(), cached per data version.'''
+    return cache.get_or_set(trajectory_cache_key(student),
+                            lambda: load_trajectory(student),
+                            settings.SEUMICH_FRAGMENT_CACHE_TIMEOUT)
+
+
+def trajectory_payload(student, trajectory):
+    '''A trajectory for the API: the summary of every term with its weekly
+    status counts as a columnar chart payload.'''
+    terms = []
+    for entry in trajectory:
+        term = entry.term
+        terms.append({
+            'term': None if term is None else {
+                'id': term.id,
+                'code': term.code,
+                'description': term.description,
+                'begin_date': term._begin_date.isoformat(),
+                'end_date': term._end_date.isoformat(),
+            },
+            'average_score': entry.average_score,
+            'class_average': entry.class_average,
+            'status_counts': dict((status.description, count)
+                                  for status, count in entry.status_counts),
+            'class_sites': [{
+                'code': summary.class_site.code,
+                'description': summary.class_site.description,
+                'status': (summary.status.description
+                           if summary.status is not None else None),
+                'student_score': summary.student_score,
+                'class_score': summary.class_score,
+            } for summary in entry.class_sites],
+            'week_end_dates': [d.isoformat() for d in entry.week_end_dates],
+            'statuses': chart_payload(entry.weeks, [
+                (status.description,
+                 STATUS_COLORS.get(status.description, '#999999'), counts)
+                for status, counts in entry.status_series]),
+        })
+    return {'student': student.username, 'terms': terms}
@@ -0,0 +1,157 @@
+from collections import namedtuple
+
+from django.conf import settings
+import numpy as np
+
+from seumich.models import (Student, ClassSite,
+                            StudentCohortMentor,
+                            WeeklyStudentClassSiteEvent,
+                            WeeklyStudentClassSiteScore)
+from seumich.warehouse import current_term
+
+
+StudentClassSiteTrend = namedtuple('StudentClassSiteTrend', [
+    'student', 'class_site', 'weeks',
+    'latest_score', 'score_slope', 'score_drop',
+    'latest_event_percentile', 'event_slope', 'event_drop',
+    'trending_down'])
+
+
+def _series_trends(student_ids, class_site_ids, dates, values, window):
+    '''Fit a least squares line through the last `window` weekly values of
+    every (student, class site) series and measure the drop of the latest
+    value below the mean of the weeks before it.
+
+    Returns a dict mapping (student_id, class_site_id) to a tuple of
+    (points, latest value, slope per week, drop).'''
+    if not len(values):
+        return {}
+
+    student_ids = np.asarray(student_ids, dtype=np.int64)
+    class_site_ids = np.asarray(class_site_ids, dtype=np.int64)
+    weeks = np.array([d.toordinal() for d in dates], dtype=np.float64) / 7.0
+    values = np.asarray(values, dtype=np.float64)
+
+    order = np.lexsort((weeks, class_site_ids, student_ids))
+    student_ids = student_ids[order]
+    class_site_ids = class_site_ids[order]
+    weeks = weeks[order]
+    values = values[order]
+
+    starts = np.r_[True, (student_ids[1:] != student_ids[:-1]) |
+                   (class_site_ids[1:] != class_site_ids[:-1])]
+    group = np.cumsum(starts) - 1
+    num_groups = group[-1] + 1
+    last = np.r_[np.flatnonzero(starts)[1:], len(values)] - 1
+    from_end = last[group] - np.arange(len(values))
+
+    recent = from_end < window
+    g = group[recent]
+    x = weeks[recent]
+    y = values[recent]
+    # Center x per series so the normal equations stay well conditioned.
+    n = np.bincount(g, minlength=num_groups).astype(np.float64)
+    x = x - (np.bincount(g, x, num_groups) / n)[g]
+    sx = np.bincount(g, x, num_groups)
+    sy = np.bincount(g, y, num_groups)
+    sxx = np.bincount(g, x * x, num_groups)
+    sxy = np.bincount(g, x * y, num_groups)
+    denominator = n * sxx - sx * sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(denominator > 0,
+                         (n * sxy - sx * sy) / denominator, np.nan)
+
+    previous = recent & (from_end > 0)
+    previous_count = np.bincount(group[previous], minlength=num_groups)
+    previous_sum = np.bincount(group[previous], values[previous], num_groups)
+    latest = values[last]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drop = np.where(previous_count > 0,
+                        latest - previous_sum / previous_count, np.nan)
+
+    trends = {}
+    for i in range(num_groups):
+        key = (int(student_ids[last[i]]), int(class_site_ids[last[i]]))
+        trends[key] = (int(n[i]), float(latest[i]),
+                       _nan_to_none(slope[i]), _nan_to_none(drop[i]))
+    return trends
+
+
+def _nan_to_none(value):
+    return None if np.isnan(value) else float(value)
+
+
+def _is_declining(slope, drop, threshold):
+    return ((slope is not None and slope < 0) or
+            (drop is not None and drop <= -threshold))
+
+
+def mentor_trends(mentor, window=None, threshold=None, term=None):
+    '''Rank the weekly score and engagement trends of every class site of
+    `term`, by default the current one, of every student advised by
+    `mentor`, steepest declines first.'''
+    if window is None:
+        window = settings.TREND_WINDOW_WEEKS
+    if threshold is None:
+        threshold = settings.TREND_DROP_THRESHOLD
+    if term is None:
+        term = current_term()
+
+    student_ids = (StudentCohortMentor.objects
+                   .filter(mentor=mentor, student__id__gte=0)
+                   .values_list('student_id', flat=True))
+    facts = {'student__in': student_ids}
+    if term is not None:
+        facts['class_site__terms'] = term
+
+    scores = list(WeeklyStudentClassSiteScore.objects
+                  .filter(score__isnull=False, **facts)
+                  .optimizer_hints('mentor_trends')
+                  .fetch_size()
+                  .values_list('student_id', 'class_site_id',
+                               'week_end_date__date', 'score'))
+    events = list(WeeklyStudentClassSiteEvent.objects
+                  .filter(percentile_rank__isnull=False, **facts)
+                  .optimizer_hints('mentor_trends')
+                  .fetch_size()
+                  .values_list('student_id', 'class_site_id',
+                               'week_end_date__date', 'percentile_rank'))
+
+    score_trends = _series_trends(*(zip(*scores) or ([],) * 4),
+                                  window=window)
+    event_trends = _series_trends(*(zip(*events) or ([],) * 4),
+                                  window=window)
+
+    keys = set(score_trends) | set(event_trends)
+    students = Student.objects.in_bulk(set(k[0] for k in keys))
+    class_sites = ClassSite.objects.in_bulk(set(k[1] for k in keys))
+
+    rows = []
+    for key in keys:
+        weeks, latest_score, score_slope, score_drop = score_trends.get(
+            key, (0, None, None, None))
+        event_weeks, latest_event, event_slope, event_drop = event_trends.get(
+            key, (0, None, None, None))
+        if latest_event is not None:
+            latest_event = round(latest_event * 100)
+            event_slope = event_slope and event_slope * 100
+            event_drop = event_drop and event_drop * 100
+        rows.append(StudentClassSiteTrend(
+            student=students[key[0]],
+            class_site=class_sites[key[1]],
+            weeks=max(weeks, event_weeks),
+            latest_score=latest_score,
+            score_slope=score_slope,
+            score_drop=score_drop,
+            latest_event_percentile=latest_event,
+            event_slope=event_slope,
+            event_drop=event_drop,
+            trending_down=(_is_declining(score_slope, score_drop, threshold) or
+                           _is_declining(event_slope, event_drop, threshold))))
+
+    rows.sort(key=lambda row: (
+        not row.trending_down,
+        row.score_slope if row.score_slope is not None else 0.0,
+        row.event_slope if row.event_slope is not None else 0.0,
+        row.student.last_name))
+    return rows
@@ -0,0 +1,129 @@
+from bisect import bisect_left
+from collections import namedtuple
+import heapq
+import re
+import threading
+
+from django.core.urlresolvers import NoReverseMatch, reverse
+
+from seumich.models import ClassSite, Cohort, Mentor, Student
+from seumich.warehouse import data_version
+
+
+Match = namedtuple('Match', ['kind', 'key', 'label', 'tokens'])
+
+# Students come first among equally good matches.
+KINDS = ('student', 'advisor', 'cohort', 'class_site')
+URL_NAMES = {
+    'student': 'seumich:student',
+    'advisor': 'seumich:advisor',
+    'cohort': 'seumich:cohort',
+    'class_site': 'seumich:class_site',
+}
+
+_lock = threading.Lock()
+_index = None
+
+
+def _tokens(*texts):
+    tokens = set()
+    for text in texts:
+        if text:
+            text = text.lower()
+            tokens.add(text)
+            tokens.update(re.findall(r'\w+', text, re.UNICODE))
+    return frozenset(tokens)
+
+
+def _person(kind, person):
+    return Match(kind=kind, key=person.username,
+                 label=u'%s %s (%s)' % (person.first_name, person.last_name,
+                                        person.username),
+                 tokens=_tokens(person.username, person.univ_id,
+                                person.first_name, person.last_name))
+
+
+class PrefixIndex(object):
+    '''Every student, mentor, cohort and class site of one data version,
+    searchable by the prefixes of their names, usernames and codes.
+
+    The tokens of all entries are kept in one sorted list, so the entries
+    with a token starting with a prefix are a slice found by bisection.'''
+
+    def __init__(self, version):
+        self.version = version
+        self.entries = []
+        fields = ('username', 'univ_id', 'first_name', 'last_name')
+        for student in Student.objects.filter(id__gte=0).only(*fields):
+            self.entries.append(_person('student', student))
+        for mentor in Mentor.objects.filter(id__gte=0).only(*fields):
+            self.entries.append(_person('advisor', mentor))
+        for cohort in Cohort.objects.filter(id__gte=0).only('code',
+                                                            'description'):
+            self.entries.append(Match(
+                kind='cohort', key=cohort.code,
+                label=u'%s (%s)' % (cohort.description, cohort.code),
+                tokens=_tokens(cohort.code, cohort.description)))
+        for class_site in ClassSite.objects.filter(id__gte=0).only(
+                'code', 'description'):
+            self.entries.append(Match(
+                kind='class_site', key=class_site.id,
+                label=u'%s (%s)' % (class_site.description, class_site.code),
+                tokens=_tokens(class_site.code, class_site.description)))
+
+        pairs = sorted((token, i) for i, entry in enumerate(self.entries)
+                       for token in entry.tokens)
+        self.tokens = [token for token, i in pairs]
+        self.positions = [i for token, i in pairs]
+
+    def search(self, query, limit=10):
+        '''The best `limit` entries with a token starting with each word of
+        `query`: whole-token matches first, then by kind and label.'''
+        words = query.lower().split()
+        if not words:
+            return []
+        longest = max(words, key=len)
+        start = bisect_left(self.tokens, longest)
+        end = bisect_left(self.tokens, longest + u'\uffff')
+        candidates = set(self.positions[start:end])
+
+        others = [word for word in words if word != longest]
+
+        def matches(entry):
+            return all(any(token.startswith(word) for token in entry.tokens)
+                       for word in others)
+
+        def rank(i):
+            entry = self.entries[i]
+            whole = sum(1 for word in words if word in entry.tokens)
+            return (-whole, KINDS.index(entry.kind), entry.label.lower())
+
+        found = (i for i in candidates if matches(self.entries[i]))
+        return [self.entries[i] for i in heapq.nsmallest(limit, found,
+                                                         key=rank)]
+
+
+def prefix_index():
+    '''The PrefixIndex of the current data version, built at first use and
+    again whenever the data version changes.'''
+    global _index
+    version = data_version()
+    if _index is None or _index.version != version:
+        with _lock:
+            if _index is None or _index.version != version:
+                _index = PrefixIndex(version)
+    return _index
+
+
+def typeahead(query, limit=10):
+    '''Suggestions for the search box as dicts with the kind, label and url
+    of each match.'''
+    results = []
+    for match in prefix_index().search(query, limit):
+        try:
+            url = reverse(URL_NAMES[match.kind], args=[match.key])
+        except NoReverseMatch:
+            continue
+        results.append({'type': match.kind, 'label': match.label,
+                        'url': url})
+    return results
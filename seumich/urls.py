@@ -38,6 +38,10 @@ urlpatterns = [
         r'^advisors/(?P<advisor>\w+)/$',
         views.AdvisorView.as_view(),
         name='advisor'),
+    url(
+        r'^advisors/(?P<advisor>\w+)/trends/$',
+        views.AdvisorTrendsView.as_view(),
+        name='advisor_trends'),
     url(
         r'^cohorts/(?P<code>[\s\w-]+)/$',
         views.CohortView.as_view(),
@@ -49,10 +53,23 @@ urlpatterns = [
     url(r'^students/$',
         views.StudentsListView.as_view(),
         name='students_list'),
+    url(r'^typeahead/$',
+        views.TypeaheadView.as_view(),
+        name='typeahead'),
     url(r'^students/(?P<student>\w+)/$',
         views.StudentView.as_view(),
         name='student'),
+    url(r'^students/(?P<student>\w+)/trajectory/$',
+        views.StudentTrajectoryView.as_view(),
+        name='student_trajectory'),
+    url(r'^students/(?P<student>\w+)/trajectory/data/$',
+        views.StudentTrajectoryDataView.as_view(),
+        name='student_trajectory_data'),
     url(r'^students/(?P<student>\w+)/class_sites/(?P<classcode>[\w-]+)/$',
         views.StudentClassSiteView.as_view(),
         name='student_class'),
+    url(r'^students/(?P<student>\w+)/class_sites/(?P<classcode>[\w-]+)/'
+        r'charts/$',
+        views.StudentClassSiteChartsView.as_view(),
+        name='student_class_charts'),
 ]
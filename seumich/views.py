@@ -1,17 +1,27 @@
 from django.views.generic import View, ListView, TemplateView
 from seumich.models import (Student, Mentor, Cohort, ClassSite,
-                            ClassSiteScore,
-                            StudentCohortMentor,
-                            StudentClassSiteStatus,
-                            StudentClassSiteScore)
+                            ClassSiteTerm, StudentClassSiteStatus, Term)
 from django.shortcuts import get_object_or_404, redirect
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.db.models import Q
+from django.core.exceptions import MultipleObjectsReturned
+from django.db.models import Prefetch, Q
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
 from django.conf import settings
-from django.db.models import Prefetch
+from django.http import Http404, HttpResponse, JsonResponse
+from django.utils.functional import cached_property
 from tracking.utils import UserLogPageViewMixin
+from seumich.conditional import ConditionalGetMixin
+from seumich.charts import (MSGPACK_CONTENT_TYPE, class_site_charts,
+                            empty_charts, encode_json, encode_msgpack,
+                            msgpack)
+from seumich.directory import NO_STUDENTS, student_counts
+from seumich.fanout import fan_out
+from seumich.profiles import load_student_profile
+from seumich.statement_timeout import StatementTimeoutMixin
+from seumich.trajectory import student_trajectory, trajectory_payload
+from seumich.trends import mentor_trends
+from seumich.typeahead import typeahead
+from seumich.warehouse import class_site_terms, current_term, dimensions
 
 import operator
 import logging
@@ -19,6 +29,59 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# The value of the term parameter that turns the term filter off.
+ALL_TERMS = 'all'
+
+
+def prefetch_student_rows(student_list, term=None, class_site=None):
+    '''Prefetch what the student list rows show, the statuses limited to
+    class sites of `term` when given, or to `class_site` and the class sites
+    held in its terms; the statuses come from the dimension cache rather
+    than another query.'''
+    statuses = (StudentClassSiteStatus.objects
+                .select_related('class_site')
+                .attach_dimensions('status'))
+    if term is not None:
+        statuses = statuses.filter(class_site__terms=term)
+    if class_site is not None:
+        terms = (ClassSiteTerm.objects.filter(class_site=class_site)
+                 .values('term'))
+        statuses = statuses.filter(class_site__in=ClassSite.objects.filter(
+            Q(pk=class_site.pk) | Q(terms__in=terms)))
+    return student_list.prefetch_related(
+        Prefetch('studentclasssitestatus_set', queryset=statuses),
+        'cohorts')
+
+
+class TermFilterMixin(object):
+    '''Limit what a page shows to one Term: the current one, or the one
+    named by the term parameter, which can also be "all".'''
+
+    @cached_property
+    def term(self):
+        value = self.request.GET.get('term')
+        if value is None:
+            return current_term()
+        if value == ALL_TERMS:
+            return None
+        try:
+            term = dimensions().get(Term, int(value))
+        except ValueError:
+            term = None
+        if term is None:
+            raise Http404('No term %s' % value)
+        return term
+
+    def get_context_data(self, **kwargs):
+        context = super(TermFilterMixin, self).get_context_data(**kwargs)
+        context['term'] = self.term
+        context['terms'] = class_site_terms().terms
+        context['all_terms'] = ALL_TERMS
+        # Keeps the chosen term on the pagination links.
+        context['term_query'] = self.request.GET.get('term')
+        return context
+
+
 class PaginationMixin(object):
 
     paginate_by = settings.PAGINATION_RECORDS_PER_PAGE
@@ -51,24 +114,48 @@ class PaginationMixin(object):
         return range(initial, final)
 
 
-class AdvisorsListView(LoginRequiredMixin, UserLogPageViewMixin, ListView):
+class DirectoryMixin(PaginationMixin):
+    '''Paginate a directory of mentors or cohorts and give every entry on
+    the page its `student_counts`.'''
+    counts_field = None
+
+    def get_context_data(self, **kwargs):
+        context = super(DirectoryMixin, self).get_context_data(**kwargs)
+        counts = student_counts(self.counts_field)
+        for entry in context['object_list']:
+            entry.student_counts = counts.get(entry.id, NO_STUDENTS)
+        context = self.render_pagination(context)
+        return context
+
+
+class AdvisorsListView(LoginRequiredMixin, UserLogPageViewMixin,
+                       StatementTimeoutMixin, ConditionalGetMixin,
+                       DirectoryMixin, ListView):
     template_name = 'seumich/advisor_list.html'
     # Filtering for id >= 0 eliminates "Bad Value"-type results.
-    queryset = Mentor.objects.filter(id__gte=0).order_by('last_name')
+    queryset = Mentor.objects.filter(id__gte=0).order_by('last_name', 'id')
     context_object_name = 'advisors'
+    counts_field = 'mentor'
+    query_budget = 3
 
 
-class CohortsListView(LoginRequiredMixin, UserLogPageViewMixin, ListView):
+class CohortsListView(LoginRequiredMixin, UserLogPageViewMixin,
+                      StatementTimeoutMixin, ConditionalGetMixin,
+                      DirectoryMixin, ListView):
     template_name = 'seumich/cohort_list.html'
     # Filtering for id >= 0 eliminates "Bad Value"-type results.
-    queryset = Cohort.objects.filter(id__gte=0)
+    queryset = Cohort.objects.filter(id__gte=0).order_by('description', 'id')
     context_object_name = 'cohorts'
+    counts_field = 'cohort'
+    query_budget = 3
 
 
-class ClassListView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
-                    ListView):
+class ClassListView(LoginRequiredMixin, UserLogPageViewMixin,
+                    StatementTimeoutMixin, ConditionalGetMixin,
+                    TermFilterMixin, PaginationMixin, ListView):
     template_name = 'seumich/class_list.html'
     context_object_name = 'classes'
+    query_budget = 2
 
     def get_context_data(self, **kwargs):
         context = super(ClassListView, self).get_context_data(**kwargs)
@@ -77,13 +164,17 @@ class ClassListView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
 
     def get_queryset(self):
         class_list = ClassSite.objects.filter(id__gte=0)
+        if self.term is not None:
+            class_list = class_list.filter(terms=self.term)
         return class_list
 
 
 class StudentsListView(LoginRequiredMixin, UserLogPageViewMixin,
-                       PaginationMixin, ListView):
+                       StatementTimeoutMixin, ConditionalGetMixin,
+                       TermFilterMixin, PaginationMixin, ListView):
     template_name = 'seumich/student_list.html'
     context_object_name = 'students'
+    query_budget = 4
 
     def get(self, request):
         univ_id = self.request.GET.get('univ_id', None)
@@ -117,17 +208,11 @@ class StudentsListView(LoginRequiredMixin, UserLogPageViewMixin,
             student_list = (Student.objects.filter(id__gte=0)
                             .filter(reduce(operator.or_, q_list))
                             .order_by('last_name').distinct())
-            student_list = student_list.prefetch_related(
-                'studentclasssitestatus_set__status',
-                'studentclasssitestatus_set__class_site',
-                'cohorts')
+            student_list = prefetch_student_rows(student_list, self.term)
         elif self.univ_id:
             student_list = Student.objects.filter(id__gte=0).filter(
                 univ_id=self.univ_id)
-            student_list = student_list.prefetch_related(
-                'studentclasssitestatus_set__status',
-                'studentclasssitestatus_set__class_site',
-                'cohorts')
+            student_list = prefetch_student_rows(student_list, self.term)
             messages.add_message(
                 self.request,
                 messages.WARNING,
@@ -135,10 +220,12 @@ class StudentsListView(LoginRequiredMixin, UserLogPageViewMixin,
         return student_list
 
 
-class AdvisorView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
-                  ListView):
+class AdvisorView(LoginRequiredMixin, UserLogPageViewMixin,
+                  StatementTimeoutMixin, ConditionalGetMixin,
+                  TermFilterMixin, PaginationMixin, ListView):
     template_name = 'seumich/advisor_detail.html'
     context_object_name = 'students'
+    query_budget = 5
 
     def get_context_data(self, **kwargs):
         context = super(AdvisorView, self).get_context_data(**kwargs)
@@ -151,18 +238,38 @@ class AdvisorView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
     def get_queryset(self):
         self.mentor = get_object_or_404(Mentor,
                                         username=self.kwargs['advisor'])
-        student_list = self.mentor.students.order_by('last_name').distinct()
-        student_list = student_list.prefetch_related(
-            'studentclasssitestatus_set__status',
-            'studentclasssitestatus_set__class_site',
-            'cohorts')
+        student_list = (self.mentor.students.order_by('last_name')
+                        .distinct()
+                        .optimizer_hints('advisor_roster')
+                        .fetch_size(self.paginate_by))
+        student_list = prefetch_student_rows(student_list, self.term)
         return student_list
 
 
-class CohortView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
-                 ListView):
+class AdvisorTrendsView(LoginRequiredMixin, UserLogPageViewMixin,
+                        StatementTimeoutMixin, ConditionalGetMixin,
+                        TemplateView):
+    template_name = 'seumich/advisor_trends.html'
+    query_budget = 5
+    # Reads the weekly facts of the advisor's students in the current term.
+    statement_timeout = 25
+
+    def get_context_data(self, advisor, **kwargs):
+        context = super(AdvisorTrendsView, self).get_context_data(**kwargs)
+        mentor = get_object_or_404(Mentor, username=advisor)
+        context['advisor'] = mentor
+        context['studentListHeader'] = mentor.first_name + \
+            " " + mentor.last_name
+        context['trends'] = mentor_trends(mentor)
+        return context
+
+
+class CohortView(LoginRequiredMixin, UserLogPageViewMixin,
+                 StatementTimeoutMixin, ConditionalGetMixin,
+                 TermFilterMixin, PaginationMixin, ListView):
     template_name = 'seumich/cohort_detail.html'
     context_object_name = 'students'
+    query_budget = 5
 
     def get_context_data(self, **kwargs):
         context = super(CohortView, self).get_context_data(**kwargs)
@@ -176,17 +283,18 @@ class CohortView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
         student_list = Student.objects.filter(
             studentcohortmentor__cohort=self.cohort).filter(
             id__gte=0).distinct()
-        student_list = student_list.prefetch_related(
-            'studentclasssitestatus_set__status',
-            'studentclasssitestatus_set__class_site',
-            'cohorts')
+        student_list = (student_list.optimizer_hints('cohort_roster')
+                        .fetch_size(self.paginate_by))
+        student_list = prefetch_student_rows(student_list, self.term)
         return student_list
 
 
-class ClassSiteView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
-                    ListView):
+class ClassSiteView(LoginRequiredMixin, UserLogPageViewMixin,
+                    StatementTimeoutMixin, ConditionalGetMixin,
+                    PaginationMixin, ListView):
     template_name = 'seumich/class_site_detail.html'
     context_object_name = 'students'
+    query_budget = 5
 
     def get_context_data(self, **kwargs):
         context = super(ClassSiteView, self).get_context_data(**kwargs)
@@ -201,140 +309,151 @@ class ClassSiteView(LoginRequiredMixin, UserLogPageViewMixin, PaginationMixin,
         student_list = Student.objects.filter(
             studentclasssitestatus__class_site=self.class_site).filter(
             id__gte=0).distinct()
-        student_list = student_list.prefetch_related(
-            'studentclasssitestatus_set__status',
-            'studentclasssitestatus_set__class_site',
-            'cohorts')
+        student_list = (student_list.optimizer_hints('class_site_roster')
+                        .fetch_size(self.paginate_by))
+        student_list = prefetch_student_rows(student_list,
+                                             class_site=self.class_site)
         return student_list
 
 
+class TypeaheadView(LoginRequiredMixin, View):
+    # Served from the prefix index, which is built once per data version.
+    # Not logged as page views, it is called on every keystroke.
+    query_budget = 0
+
+    def get(self, request):
+        query = request.GET.get('q', '')
+        return JsonResponse({'query': query, 'results': typeahead(query)})
+
+
 class IndexView(LoginRequiredMixin, UserLogPageViewMixin, View):
+    query_budget = 0
 
     def get(self, request):
         return redirect('seumich:advisor', advisor=request.user.username)
 
 
-class StudentView(LoginRequiredMixin, UserLogPageViewMixin, TemplateView):
+def class_site_summary(profile, classcode):
+    summary = profile.class_site(classcode)
+    if summary is None:
+        raise Http404('No class site %s for student %s' % (
+            classcode, profile.student.username))
+    return summary
+
+
+class StudentView(LoginRequiredMixin, UserLogPageViewMixin,
+                  StatementTimeoutMixin, ConditionalGetMixin,
+                  TermFilterMixin, TemplateView):
     template_name = 'seumich/student_detail.html'
+    query_budget = 5
+    # Whether the courses summary is limited to the term.
+    term_scoped = True
 
     def get_context_data(self, student, **kwargs):
         context = super(StudentView, self).get_context_data(**kwargs)
-        selected_student = get_object_or_404(Student, username=student)
-        context['student'] = selected_student
-        prefetch_student_score = Prefetch(
-            'class_site__studentclasssitescore_set',
-            queryset=StudentClassSiteScore.objects.filter(
-                student=selected_student))
-        context['classSites'] = (StudentClassSiteStatus.objects
-                                 .filter(
-                                     student=selected_student
-                                 )
-                                 .prefetch_related(
-                                     'class_site__classsitescore_set',
-                                     'status',
-                                     prefetch_student_score
-                                 ))
-        context['advisors'] = (StudentCohortMentor.objects
-                               .filter(
-                                   student=selected_student)
-                               .prefetch_related('mentor', 'cohort'))
+        self.profile = load_student_profile(
+            student, self.term if self.term_scoped else None)
+        context['profile'] = self.profile
+        context['student'] = self.profile.student
+        context['classSites'] = self.profile.class_sites
+        context['advisors'] = self.profile.cohort_mentors
         return context
 
 
 class StudentClassSiteView(StudentView):
     template_name = 'seumich/student_class_site_detail.html'
+    # A class site of any term can be looked at.
+    term_scoped = False
+    # class_history() reads the weekly facts of the class site when the
+    # charts are not cached.
+    query_budget = 13
 
-    def get_class_history(self, student, class_site, format=None):
-
-        studentData = []
-        classData = []
-        activityData = []
-
-        try:
-            term = class_site.terms.get()
-        except:
-            return studentData, classData, activityData
-
-        events = class_site.weeklystudentclasssiteevent_set.filter(
-            student=student)
-        student_scores = class_site.weeklystudentclasssitescore_set.filter(
-            student=student)
-        class_scores = class_site.weeklyclasssitescore_set.all()
-        todays_week_end_date = term.todays_week_end_date()
-
-        week_number = 0
-
-        for week_end_date in term.week_end_dates():
-            tempStudentData = []
-            tempClassData = []
-            tempActivityData = []
-            week_number += 1
-
-            tempStudentData.append(week_number)
-            tempClassData.append(week_number)
-            tempActivityData.append(week_number)
-
-            try:
-                event = events.get(week_end_date=week_end_date)
-            except ObjectDoesNotExist:
-                pass
-            else:
-                tempActivityData.append(round(event.percentile_rank * 100))
+    def get_context_data(self, student, classcode, **kwargs):
+        context = super(StudentClassSiteView, self).get_context_data(
+            student, **kwargs)
+        student = self.profile.student
+        summary = class_site_summary(self.profile, classcode)
+        class_site = summary.class_site
+        assignments = student.studentclasssiteassignment_set.filter(
+            class_site=class_site)
+        charts, assignment_list, summaries = fan_out(
+            lambda: class_site_charts(student, summary),
+            lambda: list(assignments.with_metrics()),
+            assignments.course_summaries)
 
-            try:
-                score = student_scores.get(week_end_date=week_end_date)
-            except ObjectDoesNotExist:
-                pass
-            else:
-                tempStudentData.append(score.score)
+        context['classSite'] = class_site
+        context['scoreData'] = charts['scores']
+        context['eventPercentileData'] = charts['events']
+        context['assignments'] = assignment_list
+        context['assignment_summary'] = summaries.get(class_site.id)
+        context['current_status'] = summary.status
+        return context
 
-            try:
-                score = class_scores.get(week_end_date=week_end_date)
-            except ObjectDoesNotExist:
-                pass
-            else:
-                tempClassData.append(score.score)
 
-            if week_end_date == todays_week_end_date:
-                tempStudentData.append(student.studentclasssitescore_set
-                                       .get(class_site=class_site)
-                                       .current_score_average)
+class StudentClassSiteChartsView(LoginRequiredMixin, StatementTimeoutMixin,
+                                 ConditionalGetMixin, View):
+    '''The charts of the student class site page as columnar payloads,
+    in JSON or, with ?format=msgpack, in msgpack.'''
+    # Like StudentClassSiteView. Not logged as page views, the page that
+    # shows the charts is.
+    query_budget = 13
+
+    def get(self, request, student, classcode):
+        if self.msgpack_requested and msgpack is None:
+            return self.charts_response(None)
+        profile = load_student_profile(student)
+        return self.charts_response(class_site_charts(
+            profile.student, class_site_summary(profile, classcode)))
+
+    @cached_property
+    def msgpack_requested(self):
+        return self.request.GET.get('format') == 'msgpack'
+
+    def charts_response(self, charts):
+        if self.msgpack_requested:
+            if msgpack is None:
+                return HttpResponse('msgpack is not installed', status=406,
+                                    content_type='text/plain')
+            return HttpResponse(encode_msgpack(charts),
+                                content_type=MSGPACK_CONTENT_TYPE)
+        return HttpResponse(encode_json(charts),
+                            content_type='application/json')
+
+    def timed_out_response(self, request, *args, **kwargs):
+        # Empty charts, flagged for the page to say why.
+        charts = empty_charts()
+        charts['timed_out'] = True
+        return self.charts_response(charts)
+
+
+class StudentTrajectoryView(LoginRequiredMixin, UserLogPageViewMixin,
+                            StatementTimeoutMixin, ConditionalGetMixin,
+                            TemplateView):
+    '''A student's class sites, scores and weekly statuses of every term,
+    latest term first.'''
+    template_name = 'seumich/student_trajectory.html'
+    # The student, then load_trajectory() when it is not cached.
+    query_budget = 6
 
-                class_site_score = ClassSiteScore.objects.get(
-                    class_site__code=class_site.code)
-                tempClassData.append(class_site_score.current_score_average)
+    def get_context_data(self, student, **kwargs):
+        context = super(StudentTrajectoryView, self).get_context_data(
+            **kwargs)
+        student = get_object_or_404(Student, username=student)
+        context['student'] = student
+        context['trajectory'] = student_trajectory(student)
+        return context
 
-            studentData.append(tempStudentData)
-            classData.append(tempClassData)
-            activityData.append(tempActivityData)
 
-        return studentData, classData, activityData
+class StudentTrajectoryDataView(LoginRequiredMixin, StatementTimeoutMixin,
+                                ConditionalGetMixin, View):
+    '''The trajectory of a student as JSON, the weekly status counts of
+    every term as columnar chart payloads.'''
+    # Like StudentTrajectoryView. Not logged as page views.
+    query_budget = 6
 
-    def get_context_data(self, student, classcode, **kwargs):
-        context = super(StudentClassSiteView, self).get_context_data(
-            student, **kwargs)
+    def get(self, request, student):
         student = get_object_or_404(Student, username=student)
-        class_site = get_object_or_404(ClassSite, code=classcode)
-        studentData, classData, activityData = self.get_class_history(
-            student, class_site)
-
-        scoreData = []
-        eventPercentileData = []
-        scoreData.append(
-            {'key': 'Student', 'values': studentData, 'color': '#255c91'})
-        scoreData.append(
-            {'key': 'Class', 'values': classData, 'color': '#F0D654'})
-        eventPercentileData.append(
-            {
-                'key': 'Course Site Engagement',
-                'values': activityData, 'color': '#a9bdab'
-            })
-
-        context['classSite'] = class_site
-        context['scoreData'] = scoreData
-        context['eventPercentileData'] = eventPercentileData
-        context['assignments'] = student.studentclasssiteassignment_set.filter(
-            class_site=class_site).prefetch_related('assignment', '_due_date')
-        context['current_status'] = student.studentclasssitestatus_set.get(
-            class_site=class_site).status.description
-        return context
+        return HttpResponse(
+            encode_json(trajectory_payload(student,
+                                           student_trajectory(student))),
+            content_type='application/json')
@@ -0,0 +1,161 @@
+from collections import OrderedDict, namedtuple
+from datetime import date
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+
+from seumich.models import (AdvisorRole, ClassSiteScore, ClassSiteTerm,
+                            EventType, SourceSystem, Status, Term,
+                            WeeklyClassSiteScore,
+                            WeeklyStudentClassSiteStatus)
+
+
+# The small lookup tables every page joins to, they only change with a
+# warehouse load.
+DIMENSIONS = (Status, AdvisorRole, EventType, SourceSystem, Term)
+
+# Reentrant, loading the dimensions through the result cache asks for the
+# data version.
+_lock = threading.RLock()
+_data_version = None
+_data_version_expires = 0
+_dimensions = None
+_terms = None
+
+
+def _compute_data_version():
+    '''Fingerprint the current warehouse load from the class score tables,
+    a row per class site and week at most, and the weekly statuses, whose
+    count and latest week change with every load of the statuses.
+    Production sets SEUMICH_DATA_VERSION instead.'''
+    aggregates = [
+        WeeklyClassSiteScore.objects.cache_results(False).aggregate(
+            rows=Count('pk'), latest_week=Max('week_end_date')),
+        ClassSiteScore.objects.cache_results(False).aggregate(
+            rows=Count('pk'), scores=Sum('current_score_average')),
+        WeeklyStudentClassSiteStatus.objects.cache_results(False).aggregate(
+            rows=Count('pk'), latest_week=Max('week_end_date')),
+    ]
+    fingerprint = repr([sorted(a.items()) for a in aggregates])
+    return hashlib.md5(fingerprint).hexdigest()[:12]
+
+
+def data_version():
+    '''A short string that changes when the warehouse data changes, for
+    cache keys. SEUMICH_DATA_VERSION, set by the warehouse load in
+    production, pins it; otherwise it is computed at most once per
+    SEUMICH_DATA_VERSION_TTL seconds per process.'''
+    global _data_version, _data_version_expires
+    if settings.SEUMICH_DATA_VERSION:
+        return settings.SEUMICH_DATA_VERSION
+    if time.time() >= _data_version_expires:
+        with _lock:
+            if time.time() >= _data_version_expires:
+                _data_version = _compute_data_version()
+                _data_version_expires = (time.time() +
+                                         settings.SEUMICH_DATA_VERSION_TTL)
+    return _data_version
+
+
+class Dimensions(object):
+    '''Every row of the DIMENSIONS tables of one data version, by model
+    and primary key.'''
+
+    def __init__(self, version):
+        self.version = version
+        self.objects = dict(
+            (model, OrderedDict((obj.pk, obj) for obj
+                                in model.objects.cache_results()))
+            for model in DIMENSIONS)
+
+    def get(self, model, pk):
+        return self.objects[model].get(pk)
+
+    def all(self, model):
+        return self.objects[model].values()
+
+
+def dimensions():
+    '''The Dimensions of the current data version, loaded at first use and
+    again whenever the data version changes.'''
+    global _dimensions
+    version = data_version()
+    if _dimensions is None or _dimensions.version != version:
+        with _lock:
+            if _dimensions is None or _dimensions.version != version:
+                _dimensions = Dimensions(version)
+    return _dimensions
+
+
+def attach_dimensions(instances, *paths):
+    '''Set the foreign keys to DIMENSIONS tables named by `paths`, which may
+    span relations already loaded with select_related() like
+    'class_site__source_system', from the dimension cache. Keys missing from
+    the cache are left to the usual lazy lookup.'''
+    cache = dimensions()
+    for path in paths:
+        names = path.split('__')
+        objects = instances
+        for name in names[:-1]:
+            objects = [getattr(obj, name) for obj in objects]
+            objects = [obj for obj in objects if obj is not None]
+        if not objects:
+            continue
+        field = objects[0]._meta.get_field(names[-1])
+        model = field.related_model
+        if model not in DIMENSIONS:
+            raise ValueError('%s is not a dimension table' %
+                             model._meta.object_name)
+        cache_name = field.get_cache_name()
+        for obj in objects:
+            related = cache.get(model, getattr(obj, field.attname))
+            if related is not None:
+                setattr(obj, cache_name, related)
+    return instances
+
+
+Terms = namedtuple('Terms', ['version', 'day', 'terms', 'current'])
+
+
+def _current_term(terms, today):
+    in_session = [term for term in terms
+                  if term._begin_date <= today <= term._end_date]
+    if in_session:
+        return in_session[0]
+    started = [term for term in terms if term._begin_date <= today]
+    if started:
+        return started[0]
+    return terms[-1] if terms else None
+
+
+def _load_terms(version, today, cache):
+    with_class_sites = set(ClassSiteTerm.objects.cache_results().order_by()
+                           .values_list('term_id', flat=True).distinct())
+    terms = sorted((term for term in cache.all(Term)
+                    if term.id in with_class_sites),
+                   key=lambda term: term._begin_date, reverse=True)
+    return Terms(version=version, day=today, terms=terms,
+                 current=_current_term(terms, today))
+
+
+def class_site_terms():
+    '''The Terms with class sites, latest first, and the current one: the
+    term in session today, else the latest that started, else the
+    earliest. Resolved once per process per data version and day.'''
+    global _terms
+    cache, today = dimensions(), date.today()
+    version = cache.version
+    if _terms is None or (_terms.version, _terms.day) != (version, today):
+        with _lock:
+            if (_terms is None or
+                    (_terms.version, _terms.day) != (version, today)):
+                _terms = _load_terms(version, today, cache)
+    return _terms
+
+
+def current_term():
+    '''The Term pages are limited to unless another one is asked for.'''
+    return class_site_terms().current
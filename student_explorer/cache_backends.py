@@ -0,0 +1,238 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+try:
+    from django.utils.six.moves import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Per-process local tiers by cache name, so every TwoTierCache instance of
+# a name (Django makes one per thread) shares one LRU.
+_local_tiers = {}
+_local_tiers_lock = threading.Lock()
+
+
+class LocalTier(object):
+    '''A thread-safe LRU of pickled values bounded by their total size in
+    bytes, with a timeout per entry.'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Keys being computed by get_or_set() in this process.
+        self.flights = {}
+        self.counts = dict.fromkeys(
+            ['local_hits', 'shared_hits', 'misses', 'sets', 'evictions',
+             'single_flight_waits'], 0)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, pickled = entry
+            if expires <= time.time():
+                self.size -= len(pickled)
+                return None
+            self.entries[key] = entry
+            return pickled
+
+    def set(self, key, pickled, timeout):
+        if len(pickled) > self.max_size:
+            self.delete(key)
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (time.time() + timeout, pickled)
+            self.size += len(pickled)
+            while self.size > self.max_size:
+                doomed, (expires, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.counts['evictions'] += 1
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class TwoTierCache(BaseCache):
+    '''A size-bounded LRU in each process in front of a shared cache.
+
+    Reads try the local tier first and fill it from the shared cache;
+    writes go to both. The local tier keeps entries at most LOCAL_TIMEOUT
+    seconds, which bounds how long a process can miss a delete made by
+    another one, so it suits keys that embed the data version.
+
+    OPTIONS:
+        SHARED: the alias of the shared cache in CACHES.
+        LOCAL_MAX_SIZE: bytes of pickled values kept per process.
+        LOCAL_TIMEOUT: seconds an entry stays in the local tier.
+        LOCK_TIMEOUT: seconds a get_or_set() computation may hold the
+            single-flight lock before others compute the value too.
+    '''
+
+    def __init__(self, name, params):
+        super(TwoTierCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options['SHARED']
+        self.local_timeout = float(options.get('LOCAL_TIMEOUT', 60))
+        self.lock_timeout = float(options.get('LOCK_TIMEOUT', 30))
+        with _local_tiers_lock:
+            if name not in _local_tiers:
+                _local_tiers[name] = LocalTier(
+                    int(options.get('LOCAL_MAX_SIZE', 16 * 1024 * 1024)))
+            self.local = _local_tiers[name]
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def _local_timeout(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            return self.local_timeout
+        return min(self.local_timeout, timeout - time.time())
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version=version)
+        if added:
+            self.local.delete(self.make_key(key, version=version))
+        return added
+
+    def get(self, key, default=None, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        pickled = self.local.get(local_key)
+        if pickled is not None:
+            self.local.count('local_hits')
+            return pickle.loads(pickled)
+        missing = object()
+        value = self.shared.get(key, missing, version=version)
+        if value is missing:
+            self.local.count('misses')
+            return default
+        self.local.count('shared_hits')
+        self.local.set(local_key,
+                       pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                       self.local_timeout)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        self.shared.set(key, value, timeout, version=version)
+        self.local.count('sets')
+        local_timeout = self._local_timeout(timeout)
+        if local_timeout > 0:
+            self.local.set(local_key,
+                           pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                           local_timeout)
+        else:
+            self.local.delete(local_key)
+
+    def delete(self, key, version=None):
+        self.local.delete(self.make_key(key, version=version))
+        self.shared.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        if self.local.get(self.make_key(key, version=version)) is not None:
+            return True
+        return self.shared.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self.local.delete(self.make_key(key, version=version))
+        return self.shared.incr(key, delta, version=version)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def get_or_set(self, key, default=None, timeout=DEFAULT_TIMEOUT,
+                   version=None):
+        '''Like BaseCache.get_or_set(), but when the key is missing only one
+        caller computes `default`: the others in this process wait for it,
+        the ones in other processes poll the shared cache for the value
+        while the single-flight lock is held.'''
+        missing = object()
+        value = self.get(key, missing, version=version)
+        if value is not missing:
+            return value
+        if not callable(default):
+            self.add(key, default, timeout, version=version)
+            return self.get(key, default, version=version)
+
+        local_key = self.make_key(key, version=version)
+        with self.local.lock:
+            flight = self.local.flights.get(local_key)
+            leader = flight is None
+            if leader:
+                flight = self.local.flights[local_key] = threading.Event()
+        if not leader:
+            self.local.count('single_flight_waits')
+            flight.wait(self.lock_timeout)
+            value = self.get(key, missing, version=version)
+            if value is not missing:
+                return value
+            return self._compute(key, default, timeout, version)
+        try:
+            return self._single_flight(key, default, timeout, version)
+        finally:
+            with self.local.lock:
+                self.local.flights.pop(local_key, None)
+            flight.set()
+
+    def _single_flight(self, key, default, timeout, version):
+        missing = object()
+        lock_key = 'single-flight:%s' % key
+        deadline = time.time() + self.lock_timeout
+        while not self.shared.add(lock_key, 1, self.lock_timeout,
+                                  version=version):
+            self.local.count('single_flight_waits')
+            time.sleep(0.05)
+            value = self.get(key, missing, version=version)
+            if value is not missing:
+                return value
+            if time.time() >= deadline:
+                return self._compute(key, default, timeout, version)
+        try:
+            value = self.get(key, missing, version=version)
+            if value is not missing:
+                return value
+            return self._compute(key, default, timeout, version)
+        finally:
+            self.shared.delete(lock_key, version=version)
+
+    def _compute(self, key, default, timeout, version):
+        value = default()
+        self.set(key, value, timeout, version=version)
+        return value
+
+    def stats(self):
+        '''The hit, miss, set and eviction counts and the local tier size
+        of this process.'''
+        with self.local.lock:
+            stats = dict(self.local.counts)
+            stats.update(local_entries=len(self.local.entries),
+                         local_size=self.local.size,
+                         local_max_size=self.local.max_size)
+        return stats
@@ -0,0 +1,90 @@
+import atexit
+import logging
+import os
+import Queue
+import threading
+
+from django.utils.module_loading import import_string
+
+
+class QueueHandler(logging.Handler):
+    '''Hand records to a background thread that passes them on to the
+    `target` handler, so the logging thread never waits for the output.
+
+    The message is rendered on the logging thread, formatting and output
+    happen on the background thread with this handler's formatter. When
+    more than `maxsize` records are waiting new ones are dropped and
+    counted in `dropped`.'''
+
+    def __init__(self, target='logging.StreamHandler', maxsize=10000,
+                 level=logging.NOTSET):
+        super(QueueHandler, self).__init__(level)
+        self.target = (import_string(target)() if isinstance(target,
+                                                             basestring)
+                       else target)
+        self.queue = Queue.Queue(int(maxsize))
+        self.dropped = 0
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def setFormatter(self, fmt):
+        super(QueueHandler, self).setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Render the message and the traceback now: the arguments may change
+        # and the traceback is gone by the time the listener gets the
+        # record.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self._ensure_listener()
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _ensure_listener(self):
+        # Started lazily, and again in processes forked after it started.
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid != os.getpid():
+                if self._listener_pid is not None:
+                    # Records queued before the fork are the parent's.
+                    self.queue = Queue.Queue(self.queue.maxsize)
+                listener = threading.Thread(target=self._listen,
+                                            name='log-queue-listener')
+                listener.daemon = True
+                listener.start()
+                self._listener_pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''Wait until every queued record was handled.'''
+        if self._listener_pid == os.getpid():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        self.flush()
+        self.target.close()
+        super(QueueHandler, self).close()
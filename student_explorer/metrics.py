@@ -0,0 +1,234 @@
+from collections import defaultdict
+import errno
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from student_explorer.log_handlers import QueueHandler
+
+
+# Name: (type, help) of every metric.
+METRICS = {
+    'student_explorer_requests_total':
+        ('counter', 'Requests by view and status code.'),
+    'student_explorer_request_duration_seconds':
+        ('histogram', 'Request latency by view.'),
+    'student_explorer_db_queries_total':
+        ('counter', 'Database queries by alias.'),
+    'student_explorer_db_query_seconds_total':
+        ('counter', 'Time spent in database queries by alias.'),
+    'student_explorer_db_statement_timeouts_total':
+        ('counter', 'Views whose warehouse statements ran out of time, by '
+                    'view and alias.'),
+    'student_explorer_db_connections_open':
+        ('gauge', 'Open database connections by alias.'),
+    'student_explorer_cache_requests_total':
+        ('counter', 'Cache lookups by result.'),
+    'student_explorer_cache_hit_ratio':
+        ('gauge', 'Share of cache lookups that were hits.'),
+    'student_explorer_log_queue_depth':
+        ('gauge', 'Access log records waiting to be written.'),
+    'student_explorer_log_records_dropped':
+        ('gauge', 'Access log records dropped because the queue was full, '
+                  'since the worker started.'),
+}
+
+BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Registry(object):
+    '''The metrics of this process. With METRICS_DIR set they are written
+    to a file per process there, and render() adds up the files of all
+    processes; gauges only count for processes that are still running.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(float)
+            self.gauges = {}
+            self.histograms = {}
+            self.written = 0
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, _labels_key(labels))] += value
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name, labels, value):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0,
+                                                    0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        collect_process_gauges(self)
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value
+                           in self.gauges.items()],
+                'histograms': [[name, labels, [list(buckets), total, count]]
+                               for (name, labels), (buckets, total, count)
+                               in self.histograms.items()],
+            }
+
+    def write(self, force=False):
+        '''Write this process' metrics file, at most once per
+        METRICS_WRITE_INTERVAL seconds unless forced.'''
+        directory = settings.METRICS_DIR
+        if not directory:
+            return
+        now = time.time()
+        if not force and now - self.written < settings.METRICS_WRITE_INTERVAL:
+            return
+        self.written = now
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(path, os.path.join(directory,
+                                     'metrics-%d.json' % os.getpid()))
+
+    def snapshots(self):
+        if not settings.METRICS_DIR:
+            return [self.snapshot()]
+        self.write(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(settings.METRICS_DIR,
+                                           'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, ValueError):
+                # Gone or being replaced, its worker is still counted
+                # next time.
+                continue
+        return snapshots
+
+    def render(self):
+        '''All processes' metrics in the Prometheus text format.'''
+        counters = defaultdict(float)
+        gauges = defaultdict(float)
+        histograms = {}
+        for snapshot in self.snapshots():
+            for name, labels, value in snapshot['counters']:
+                counters[(name, _freeze(labels))] += value
+            if _is_running(snapshot['pid']):
+                for name, labels, value in snapshot['gauges']:
+                    gauges[(name, _freeze(labels))] += value
+            for name, labels, (buckets, total, count) in \
+                    snapshot['histograms']:
+                key = (name, _freeze(labels))
+                summed = histograms.setdefault(key, [[0] * len(BUCKETS), 0.0,
+                                                     0])
+                summed[0] = [a + b for a, b in zip(summed[0], buckets)]
+                summed[1] += total
+                summed[2] += count
+
+        hits = counters.get(('student_explorer_cache_requests_total',
+                             (('result', 'hit'),)), 0)
+        misses = counters.get(('student_explorer_cache_requests_total',
+                               (('result', 'miss'),)), 0)
+        if hits + misses:
+            gauges[('student_explorer_cache_hit_ratio', ())] = (
+                hits / (hits + misses))
+
+        samples = defaultdict(list)
+        for (name, labels), value in counters.items():
+            samples[name].append((name, labels, value))
+        for (name, labels), value in gauges.items():
+            samples[name].append((name, labels, value))
+        for (name, labels), (buckets, total, count) in sorted(
+                histograms.items()):
+            for bound, bucket in zip(BUCKETS, buckets):
+                samples[name].append((name + '_bucket',
+                                      labels + (('le', repr(bound)),),
+                                      bucket))
+            samples[name].append((name + '_bucket',
+                                  labels + (('le', '+Inf'),), count))
+            samples[name].append((name + '_sum', labels, total))
+            samples[name].append((name + '_count', labels, count))
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = METRICS.get(name, ('untyped', ''))
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if METRICS.get(name, ('untyped',))[0] != 'histogram':
+                # Histogram buckets are already in order.
+                samples[name].sort()
+            for sample, labels, value in samples[name]:
+                lines.append('%s%s %s' % (sample, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _freeze(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def _format_value(value):
+    if value == int(value):
+        return '%d' % value
+    return repr(float(value))
+
+
+def _is_running(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def collect_process_gauges(registry):
+    '''Set the gauges that describe the state of this process.'''
+    for connection in connections.all():
+        registry.set('student_explorer_db_connections_open',
+                     {'alias': connection.alias},
+                     int(connection.connection is not None))
+    for handler in logging.getLogger('access_logs').handlers:
+        if isinstance(handler, QueueHandler):
+            registry.set('student_explorer_log_queue_depth', {},
+                         handler.queue.qsize())
+            registry.set('student_explorer_log_records_dropped', {},
+                         handler.dropped)
+
+
+registry = Registry()
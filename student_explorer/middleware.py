@@ -1,10 +1,38 @@
 from datetime import datetime
 import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from seumich.identity import identity_map
+from student_explorer.metrics import registry
+from student_explorer.query_stats import QueryStats
 
 logger = logging.getLogger('access_logs')
+query_logger = logging.getLogger(__name__)
+
+
+def _cache_counts():
+    stats = getattr(cache, 'stats', None)
+    if stats is None:
+        return None
+    counts = stats()
+    return (counts['local_hits'] + counts['shared_hits'], counts['misses'])
 
 
 class LoggingMiddleware(object):
+    '''Write an access log line per request, with its latency, view, size,
+    cache and database use as key=value pairs at the end and as attributes
+    of the log record.
+
+    Cache hits and misses are counted per process, so with threaded workers
+    they include concurrent requests.'''
+
+    def process_request(self, request):
+        request.access_log_started = time.time()
+        request.access_log_cache_counts = _cache_counts()
+
     def process_response(self, request, response):
         l = []
 
@@ -30,5 +58,125 @@ class LoggingMiddleware(object):
 
         l.append('"' + request.META.get('HTTP_USER_AGENT', '-') + '"')
 
-        logger.info(' '.join(l))
+        extra = self.get_fields(request, response)
+        l.append('ms=%s' % ('-' if extra['latency_ms'] is None
+                            else '%.1f' % extra['latency_ms']))
+        l.append('view=%s' % (extra['view_name'] or '-'))
+        l.append('bytes=%s' % ('-' if extra['response_bytes'] is None
+                               else extra['response_bytes']))
+        if extra['cache_hits'] is not None:
+            l.append('cache.hits=%d' % extra['cache_hits'])
+            l.append('cache.misses=%d' % extra['cache_misses'])
+
+        query_stats = getattr(request, 'query_stats', None)
+        if query_stats is not None:
+            l.extend(query_stats.log_fields())
+            extra['query_stats'] = query_stats.results
+
+        logger.info(' '.join(l), extra=extra)
         return response
+
+    def get_fields(self, request, response):
+        started = getattr(request, 'access_log_started', None)
+        match = getattr(request, 'resolver_match', None)
+        fields = {
+            'latency_ms': (None if started is None
+                           else (time.time() - started) * 1000),
+            'view_name': match.view_name if match is not None else None,
+            'response_bytes': (None if response.streaming
+                               else len(response.content)),
+            'cache_hits': None,
+            'cache_misses': None,
+        }
+        before = getattr(request, 'access_log_cache_counts', None)
+        after = _cache_counts()
+        if before is not None and after is not None:
+            fields['cache_hits'] = after[0] - before[0]
+            fields['cache_misses'] = after[1] - before[1]
+        return fields
+
+
+class QueryStatsMiddleware(object):
+    '''Count the queries and the database time of each request per alias.
+
+    Must come after LoggingMiddleware so the stats are complete by the time
+    the access line is written.'''
+
+    def process_request(self, request):
+        if settings.QUERY_STATS_ENABLED:
+            request.query_stats = QueryStats().start()
+
+    def process_response(self, request, response):
+        query_stats = getattr(request, 'query_stats', None)
+        if query_stats is not None:
+            query_stats.stop()
+            for stats in query_stats:
+                for seconds, sql in stats.slowest:
+                    query_logger.debug('%s %s %.1fms %s', request.path,
+                                       stats.alias, seconds * 1000, sql)
+        return response
+
+
+class MetricsMiddleware(object):
+    '''Count requests, their latency, queries and cache lookups per view
+    for the /status/metrics endpoint.
+
+    Must come between LoggingMiddleware and QueryStatsMiddleware so the
+    query stats are complete when the request is counted.'''
+
+    def process_request(self, request):
+        request.metrics_started = time.time()
+        request.metrics_cache_counts = _cache_counts()
+
+    def process_response(self, request, response):
+        started = getattr(request, 'metrics_started', None)
+        if started is None:
+            return response
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else 'unresolved'
+        registry.inc('student_explorer_requests_total',
+                     {'view': view, 'status': response.status_code})
+        registry.observe('student_explorer_request_duration_seconds',
+                         {'view': view}, time.time() - started)
+
+        query_stats = getattr(request, 'query_stats', None)
+        if query_stats is not None:
+            for stats in query_stats:
+                registry.inc('student_explorer_db_queries_total',
+                             {'alias': stats.alias}, stats.queries)
+                registry.inc('student_explorer_db_query_seconds_total',
+                             {'alias': stats.alias}, stats.time)
+
+        before = request.metrics_cache_counts
+        after = _cache_counts()
+        if before is not None and after is not None:
+            registry.inc('student_explorer_cache_requests_total',
+                         {'result': 'hit'}, after[0] - before[0])
+            registry.inc('student_explorer_cache_requests_total',
+                         {'result': 'miss'}, after[1] - before[1])
+
+        registry.write()
+        return response
+
+
+class IdentityMapMiddleware(object):
+    '''Share the warehouse model instances looked up by primary key or by
+    another single field for the rest of the request, its view and its
+    template, see seumich.identity.'''
+
+    def process_request(self, request):
+        request.identity_map = identity_map()
+        request.identity_map.__enter__()
+
+    def process_response(self, request, response):
+        self._exit(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self._exit(request)
+
+    def _exit(self, request):
+        context = getattr(request, 'identity_map', None)
+        if context is not None:
+            del request.identity_map
+            context.__exit__(None, None, None)
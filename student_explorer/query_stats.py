@@ -0,0 +1,142 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from operator import itemgetter
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+
+AliasQueryStats = namedtuple('AliasQueryStats', [
+    'alias', 'queries', 'time', 'slowest'])
+
+_local = threading.local()
+
+
+def _queries_since(queries_log, marker):
+    queries = list(queries_log)
+    if marker is not None:
+        for i in range(len(queries) - 1, -1, -1):
+            if queries[i] is marker:
+                return queries[i + 1:]
+    # The log was reset (at the start of a request) or overflowed since the
+    # marker was taken, everything left in it is new.
+    return queries
+
+
+def _timed(queries):
+    return [(float(query['time']), query['sql']) for query in queries]
+
+
+def active_query_stats():
+    '''The QueryStats started on this thread and not stopped yet.'''
+    return getattr(_local, 'active', ())
+
+
+@contextmanager
+def recorded_for(stats):
+    '''Count the queries the block runs on this thread in the QueryStats
+    `stats` of the thread that started it, like fan_out() does.'''
+    aliases = sorted(set(alias for s in stats for alias in s.aliases))
+    state = {}
+    for alias in aliases:
+        connection = connections[alias]
+        # Pool threads open their own connections; setting one up is not a
+        # query the block runs.
+        connection.ensure_connection()
+        log = connection.queries_log
+        state[alias] = (connection.force_debug_cursor,
+                        log[-1] if log else None)
+        connection.force_debug_cursor = True
+    try:
+        yield
+    finally:
+        for alias in aliases:
+            connection = connections[alias]
+            force_debug_cursor, marker = state[alias]
+            connection.force_debug_cursor = force_debug_cursor
+            timed = _timed(_queries_since(connection.queries_log, marker))
+            for s in stats:
+                s.merge(alias, timed)
+
+
+class QueryStats(object):
+    '''Record the number of queries, the total time spent in the database
+    and the slowest statements for each database alias.
+
+    Use it as a context manager, or call start() and stop(); afterwards
+    `stats[alias]` is an AliasQueryStats with the time in seconds. The
+    queries other threads ran for this one under recorded_for() are
+    counted too.'''
+
+    def __init__(self, aliases=None, slowest=None):
+        self.aliases = tuple(aliases or settings.QUERY_STATS_ALIASES)
+        self.slowest = (settings.QUERY_STATS_SLOWEST if slowest is None
+                        else slowest)
+        self.started = False
+        self.results = {}
+        self._lock = threading.Lock()
+        self._merged = {}
+
+    def start(self):
+        self._state = {}
+        self._merged = dict((alias, []) for alias in self.aliases)
+        for alias in self.aliases:
+            connection = connections[alias]
+            log = connection.queries_log
+            self._state[alias] = (connection.force_debug_cursor,
+                                  log[-1] if log else None)
+            connection.force_debug_cursor = True
+        self.started = True
+        _local.active = active_query_stats() + (self,)
+        return self
+
+    def merge(self, alias, timed):
+        '''Count the (seconds, sql) of queries another thread ran for this
+        one.'''
+        if alias in self.aliases:
+            with self._lock:
+                self._merged[alias].extend(timed)
+
+    def stop(self):
+        if not self.started:
+            return self
+        _local.active = tuple(stats for stats in active_query_stats()
+                              if stats is not self)
+        for alias in self.aliases:
+            connection = connections[alias]
+            force_debug_cursor, marker = self._state[alias]
+            connection.force_debug_cursor = force_debug_cursor
+            with self._lock:
+                timed = (_timed(_queries_since(connection.queries_log,
+                                               marker)) +
+                         self._merged[alias])
+            self.results[alias] = AliasQueryStats(
+                alias=alias,
+                queries=len(timed),
+                time=sum(t for t, sql in timed),
+                slowest=sorted(timed, key=itemgetter(0),
+                               reverse=True)[:self.slowest])
+        self.started = False
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __getitem__(self, alias):
+        return self.results[alias]
+
+    def __iter__(self):
+        return (self.results[alias] for alias in self.aliases
+                if alias in self.results)
+
+    def log_fields(self):
+        '''The stats as key=value pairs for the access log.'''
+        fields = []
+        for stats in self:
+            fields.append('db.%s.queries=%d' % (stats.alias, stats.queries))
+            fields.append('db.%s.ms=%.1f' % (stats.alias, stats.time * 1000))
+        return fields
@@ -0,0 +1,62 @@
+from datetime import timedelta
+import copy
+import logging
+
+from django.conf import settings
+from django.contrib.sessions.backends import db
+from django.core.exceptions import SuspiciousOperation
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+
+class SessionStore(db.SessionStore):
+    '''A database session store that skips writes that would only slide the
+    expiry a little.
+
+    With SESSION_SAVE_EVERY_REQUEST every page view saves the session; this
+    store writes the row only when the session data changed or the expiry
+    moved by more than SESSION_SAVE_THRESHOLD times SESSION_COOKIE_AGE, so
+    an idle session still expires at most that much earlier than its
+    cookie.'''
+
+    _stored = None
+
+    def load(self):
+        try:
+            s = self.model.objects.get(
+                session_key=self.session_key,
+                expire_date__gt=timezone.now()
+            )
+            data = self.decode(s.session_data)
+        except (self.model.DoesNotExist, SuspiciousOperation) as e:
+            if isinstance(e, SuspiciousOperation):
+                logger = logging.getLogger('django.security.%s' %
+                                           e.__class__.__name__)
+                logger.warning(force_text(e))
+            self._session_key = None
+            self._stored = None
+            return {}
+        # Decoded separately from the data the session hands out, which may be
+        # changed in place.
+        self._stored = (s.session_key, self.decode(s.session_data),
+                        s.expire_date)
+        return data
+
+    def save(self, must_create=False):
+        if not must_create and self._is_unchanged():
+            return
+        super(SessionStore, self).save(must_create=must_create)
+        if self.session_key is not None:
+            self._stored = (self.session_key,
+                            copy.deepcopy(self._get_session()),
+                            self.get_expiry_date())
+
+    def _is_unchanged(self):
+        if self._stored is None or self.session_key is None:
+            return False
+        session_key, data, expire_date = self._stored
+        if session_key != self.session_key or self._get_session() != data:
+            return False
+        threshold = timedelta(seconds=settings.SESSION_SAVE_THRESHOLD *
+                              settings.SESSION_COOKIE_AGE)
+        return self.get_expiry_date() - expire_date < threshold
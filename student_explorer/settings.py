@@ -8,6 +8,7 @@ to the top, then override settings initialized in this module.
 """
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
+import json
 import os
 from os import getenv
 
@@ -29,6 +30,10 @@ SECRET_KEY = getenv('DJANGO_SECRET_KEY', 'I need to be changed!')
 SESSION_COOKIE_AGE = int(getenv('DJANGO_SESSION_COOKIE_AGE', 36000))
 SESSION_SAVE_EVERY_REQUEST = getenv_bool('DJANGO_SESSION_SAVE_EVERY_REQUEST',
                                          'on')
+# Sessions whose data did not change are only written when their expiry
+# moved by more than this fraction of SESSION_COOKIE_AGE.
+SESSION_ENGINE = 'student_explorer.sessions'
+SESSION_SAVE_THRESHOLD = float(getenv('DJANGO_SESSION_SAVE_THRESHOLD', '0.1'))
 
 SILENCED_SYSTEM_CHECKS = []
 
@@ -65,6 +70,9 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'student_explorer.middleware.LoggingMiddleware',
+    'student_explorer.middleware.MetricsMiddleware',
+    'student_explorer.middleware.QueryStatsMiddleware',
+    'student_explorer.middleware.IdentityMapMiddleware',
 ]
 
 TEMPLATES = [
@@ -78,11 +86,44 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'seumich.context_processors.warehouse',
             ],
         },
     },
 ]
 
+# Each worker keeps recently used cache entries in a bounded LRU in front of
+# the shared cache, by default a per-process stand-in; point
+# DJANGO_SHARED_CACHE_BACKEND and DJANGO_SHARED_CACHE_LOCATION at memcached
+# or Redis in production.
+CACHES = {
+    'default': {
+        'BACKEND': 'student_explorer.cache_backends.TwoTierCache',
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'LOCAL_MAX_SIZE': int(getenv(
+                'DJANGO_LOCAL_CACHE_MAX_SIZE', str(32 * 1024 * 1024))),
+            'LOCAL_TIMEOUT': int(getenv('DJANGO_LOCAL_CACHE_TIMEOUT', '60')),
+        },
+    },
+    'shared': {
+        'BACKEND': getenv('DJANGO_SHARED_CACHE_BACKEND',
+                          'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': getenv('DJANGO_SHARED_CACHE_LOCATION', 'shared'),
+    },
+    # The copies of the seumich pages served when the warehouse is too slow,
+    # kept apart so they do not push the other entries out.
+    'stale_pages': {
+        'BACKEND': getenv('DJANGO_STALE_PAGE_CACHE_BACKEND',
+                          'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': getenv('DJANGO_STALE_PAGE_CACHE_LOCATION', 'stale_pages'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(getenv('DJANGO_STALE_PAGE_CACHE_MAX_ENTRIES',
+                                      '200')),
+        },
+    },
+}
+
 ROOT_URLCONF = 'student_explorer.urls'
 
 WSGI_APPLICATION = 'student_explorer.wsgi.application'
@@ -107,6 +148,76 @@ SERVER_EMAIL = getenv('DJANGO_SERVER_EMAIL',
 USAGE_PAST_WEEKS = int(getenv(
     'DJANGO_USAGE_PAST_WEEKS', '8'))
 
+TREND_WINDOW_WEEKS = int(getenv(
+    'DJANGO_TREND_WINDOW_WEEKS', '6'))
+TREND_DROP_THRESHOLD = float(getenv(
+    'DJANGO_TREND_DROP_THRESHOLD', '5'))
+
+# The warehouse data version used in cache keys. In production the warehouse
+# load sets it, e.g. to its load id or date, and restarts the workers; without
+# it the version is computed from the class score and weekly status tables
+# every DJANGO_SEUMICH_DATA_VERSION_TTL seconds.
+SEUMICH_DATA_VERSION = getenv('DJANGO_SEUMICH_DATA_VERSION', None)
+SEUMICH_DATA_VERSION_TTL = int(getenv(
+    'DJANGO_SEUMICH_DATA_VERSION_TTL', '300'))
+SEUMICH_FRAGMENT_CACHE_TIMEOUT = int(getenv(
+    'DJANGO_SEUMICH_FRAGMENT_CACHE_TIMEOUT', '3600'))
+# Pins the template version used in cache keys and page validators, by
+# default it is a digest of the templates.
+SEUMICH_TEMPLATE_VERSION = getenv('DJANGO_SEUMICH_TEMPLATE_VERSION', None)
+# Threads that run the independent warehouse queries of a page
+# concurrently, 0 runs them in order. Each thread keeps its own connection
+# for DJANGO_SEUMICH_DB_CONN_MAX_AGE seconds, and the queries on these
+# threads are not in the query stats of the request.
+SEUMICH_QUERY_FANOUT_THREADS = int(getenv(
+    'DJANGO_SEUMICH_QUERY_FANOUT_THREADS', '0'))
+# Models whose query results are read through the cache, for
+# DJANGO_SEUMICH_RESULT_CACHE_TIMEOUT seconds, like the querysets that ask
+# for it with cache_results(). Comma separated model names, e.g. "Student,
+# ClassSite".
+SEUMICH_RESULT_CACHE_MODELS = [
+    name for name in getenv('DJANGO_SEUMICH_RESULT_CACHE_MODELS',
+                            '').split(',') if name]
+SEUMICH_RESULT_CACHE_TIMEOUT = int(getenv(
+    'DJANGO_SEUMICH_RESULT_CACHE_TIMEOUT', '3600'))
+# Directory of the fact cubes written by the build_fact_cube command, the
+# class charts are read from the cube of the current data version when it
+# was built.
+SEUMICH_FACT_CUBE_DIR = getenv('DJANGO_SEUMICH_FACT_CUBE_DIR', None)
+# Rows fetched per round trip by the warehouse querysets that ask for it
+# with fetch_size(), the large fact and roster queries.
+SEUMICH_FETCH_ARRAYSIZE = int(getenv(
+    'DJANGO_SEUMICH_FETCH_ARRAYSIZE', '500'))
+# Optimizer hints by name, added to the querysets that name them with
+# optimizer_hints(), in the SQL of the seumich database. A JSON object, e.g.
+# '{"cohort_roster": "LEADING(BG_STDNT_CHRT_MNTR) USE_HASH(DM_STDNT)"}'.
+# The queries name "cohort_roster", "class_site_roster", "advisor_roster",
+# "mentor_trends" and "student_trajectory".
+SEUMICH_QUERY_HINTS = json.loads(getenv('DJANGO_SEUMICH_QUERY_HINTS', '{}'))
+# Seconds the warehouse statements of a seumich page may take altogether
+# before the running one is cancelled and a degraded page is served, 0 for
+# no limit. Keep it below the gunicorn worker timeout.
+SEUMICH_STATEMENT_TIMEOUT = float(getenv(
+    'DJANGO_SEUMICH_STATEMENT_TIMEOUT', '15'))
+# Seconds a copy of every seumich page is kept in the stale_pages cache to
+# be served, with a notice, when the page runs out of time; 0 keeps no
+# copies.
+SEUMICH_STALE_PAGE_TIMEOUT = int(getenv(
+    'DJANGO_SEUMICH_STALE_PAGE_TIMEOUT', '86400'))
+
+QUERY_STATS_ENABLED = getenv_bool('DJANGO_QUERY_STATS_ENABLED', 'on')
+QUERY_STATS_ALIASES = getenv('DJANGO_QUERY_STATS_ALIASES',
+                             'default,seumich').split(',')
+QUERY_STATS_SLOWEST = int(getenv(
+    'DJANGO_QUERY_STATS_SLOWEST', '3'))
+
+# Directory shared by the workers for /status/metrics, each writes its
+# metrics there at most every DJANGO_METRICS_WRITE_INTERVAL seconds. Without
+# it the endpoint only shows the worker that answers.
+METRICS_DIR = getenv('DJANGO_METRICS_DIR', None)
+METRICS_WRITE_INTERVAL = float(getenv(
+    'DJANGO_METRICS_WRITE_INTERVAL', '5'))
+
 # Internationalization
 
 LANGUAGE_CODE = getenv('DJANGO_LANGUAGE_CODE', 'en-us')
@@ -169,7 +280,7 @@ DATABASES['seumich'] = {
     'HOST': getenv('DJANGO_SEUMICH_DB_HOST', ''),
     'PORT': getenv('DJANGO_SEUMICH_DB_PORT', ''),
     'MIGRATE': getenv_bool('DJANGO_SEUMICH_DB_MIGRATE', 'no'),
-
+    'CONN_MAX_AGE': int(getenv('DJANGO_SEUMICH_DB_CONN_MAX_AGE', '0')),
 }
 DATABASE_ROUTERS += ['seumich.routers.SeumichRouter']
 
@@ -289,8 +400,11 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'simple',
         },
+        # Written by a background thread so requests do not wait for it.
         'access_logs': {
-            'class': 'logging.StreamHandler',
+            'class': 'student_explorer.log_handlers.QueueHandler',
+            'target': 'logging.StreamHandler',
+            'maxsize': int(getenv('DJANGO_ACCESS_LOG_QUEUE_SIZE', '10000')),
             'formatter': 'access_logs',
         },
     },
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from django.contrib.sessions.models import Session
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+
+from student_explorer.cache_backends import TwoTierCache
+from student_explorer.log_handlers import QueueHandler
+from student_explorer.metrics import registry as metrics_registry
+
+
+class QueueHandlerTest(SimpleTestCase):
+
+    def test_queue_handler(self):
+        handled = []
+        target = logging.Handler()
+        target.emit = lambda record: handled.append(target.format(record))
+        handler = QueueHandler(target, maxsize=100)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        queue_logger = logging.getLogger('test_queue_handler')
+        queue_logger.propagate = False
+        queue_logger.setLevel(logging.INFO)
+        queue_logger.addHandler(handler)
+        try:
+            args = {'n': 1}
+            queue_logger.warning('record %(n)d', args)
+            args['n'] = 2
+            handler.flush()
+        finally:
+            queue_logger.removeHandler(handler)
+        self.assertEqual(handled, ['WARNING record 1'])
+        self.assertEqual(handler.dropped, 0)
+
+
+class TwoTierCacheTest(SimpleTestCase):
+
+    def test_two_tier_cache(self):
+        two_tier = TwoTierCache('test-two-tier', {
+            'OPTIONS': {'SHARED': 'shared', 'LOCAL_MAX_SIZE': 1000}})
+        two_tier.clear()
+        two_tier.set('a', 'x' * 400)
+        self.assertEqual(two_tier.get('a'), 'x' * 400)
+        self.assertEqual(two_tier.stats()['local_hits'], 1)
+
+        # Evicted from the local tier, still in the shared one.
+        two_tier.set('b', 'y' * 400)
+        two_tier.set('c', 'z' * 400)
+        stats = two_tier.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertLessEqual(stats['local_size'], 1000)
+        self.assertEqual(two_tier.get('a'), 'x' * 400)
+        self.assertEqual(two_tier.stats()['shared_hits'], 1)
+
+        two_tier.delete('a')
+        self.assertEqual(two_tier.get('a'), None)
+        self.assertEqual(two_tier.stats()['misses'], 1)
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return 42
+        self.assertEqual(two_tier.get_or_set('answer', compute), 42)
+        self.assertEqual(two_tier.get_or_set('answer', compute), 42)
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(two_tier.shared.has_key('single-flight:answer'))
+        two_tier.clear()
+
+
+class MetricsTest(TestCase):
+
+    fixtures = ['dev_users.json']
+
+    def test_metrics(self):
+        metrics_registry.reset()
+        self.client.login(username='burl', password='burl')
+        self.client.get('/about')
+        response = self.client.get('/status/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'student_explorer_requests_total{status="200",'
+            'view="about"} 1', response.content)
+        self.assertIn(
+            'student_explorer_request_duration_seconds_count'
+            '{view="about"} 1', response.content)
+        self.assertIn('student_explorer_db_queries_total{alias="default"}',
+                      response.content)
+        with override_settings(WATCHMAN_TOKEN='secret'):
+            self.client.logout()
+            self.assertEqual(self.client.get('/status/metrics').status_code,
+                             403)
+            self.assertEqual(
+                self.client.get('/status/metrics?token=secret').status_code,
+                200)
+
+        # Other workers' files are added up, their gauges only while they
+        # run.
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'metrics-1.json'), 'w') as f:
+                json.dump({'pid': 2 ** 22 + 1,
+                           'counters': [['student_explorer_requests_total',
+                                         [['status', 200],
+                                          ['view', 'about']],
+                                         2]],
+                           'gauges': [['student_explorer_log_queue_depth',
+                                       [], 5]],
+                           'histograms': []}, f)
+            with override_settings(METRICS_DIR=directory):
+                text = metrics_registry.render()
+        finally:
+            shutil.rmtree(directory)
+        self.assertIn('student_explorer_requests_total{status="200",'
+                      'view="about"} 3', text)
+        self.assertNotIn('student_explorer_log_queue_depth 5', text)
+
+
+class SessionStoreTest(TestCase):
+
+    fixtures = ['dev_users.json']
+
+    def test_session_writes_are_coalesced(self):
+        self.client.login(username='burl', password='burl')
+        session_key = self.client.session.session_key
+
+        def expire_date():
+            return Session.objects.get(session_key=session_key).expire_date
+        stored = expire_date()
+        self.client.get('/about')
+        self.assertEqual(expire_date(), stored)
+
+        session = self.client.session
+        self.assertEqual(session.get('changed'), None)
+        with self.assertNumQueries(0, using='default'):
+            session.save()
+        session['changed'] = True
+        session.save()
+        self.assertGreater(expire_date(), stored)
+
+        stored = expire_date()
+        with override_settings(SESSION_SAVE_THRESHOLD=0):
+            self.client.get('/about')
+        self.assertGreater(expire_date(), stored)
@@ -23,6 +23,7 @@ urlpatterns = [
     url(r'^robots.txt$', TemplateView.as_view(template_name="robots.txt", content_type="text/plain"), name="robots_file"),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^', include('seumich.urls', namespace='seumich')),
+    url(r'^status/metrics$', views.metrics, name='metrics'),
     url(r'^status/', include('watchman.urls')),
     url(r'^manage/', include('management.urls')),
     url(r'^feedback/', include('feedback.urls', namespace='feedback')),
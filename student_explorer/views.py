@@ -1,6 +1,9 @@
 from django.contrib import auth
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
 from django.shortcuts import redirect, render
 from django.conf import settings
+from student_explorer.metrics import registry
 import os
 import logging
 
@@ -16,3 +19,15 @@ def logout(request):
 def about(request):
     context = {'build_number': os.getenv('OPENSHIFT_BUILD_NAME')}
     return render(request, 'student_explorer/about.html', context)
+
+
+def metrics(request):
+    '''The metrics of all workers in the Prometheus text format, behind
+    the watchman token when one is set.'''
+    token = settings.WATCHMAN_TOKEN
+    if (token and request.GET.get(settings.WATCHMAN_TOKEN_NAME) != token and
+            not request.user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4; '
+                                     'charset=utf-8')
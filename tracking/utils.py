@@ -39,7 +39,9 @@ def user_log_page_view(f):
     def wrapper(request, *args, **kwargs):
         user = request.user if request.user.is_authenticated() else None
         response = f(request, *args, **kwargs)
-        if response.status_code != 200:
+        # A 304 Not Modified is a page view the browser rendered from its
+        # cache.
+        if response.status_code not in (200, 304):
             if response.status_code == 302:
                 create_event(EventNames.Redirected, request, user=user,
                              note='From: %s \tTo: %s' % (request.path, response['Location']))